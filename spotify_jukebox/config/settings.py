@@ -59,6 +59,110 @@ SESSION_COOKIE_SAMESITE = 'Lax'
 # УБЕДИСЬ, ЧТО ЭТОТ URI УКАЗАН В SPOTIFY DASHBOARD:
 SPOTIPY_REDIRECT_URI = 'https://room-spotify.ru/api/spotify/callback/'
 
+SPOTIFY_API_URL = os.getenv('SPOTIFY_API_URL', 'https://api.spotify.com/v1/')
+SPOTIFY_TOKEN_URL = os.getenv('SPOTIFY_TOKEN_URL', 'https://accounts.spotify.com/api/token')
+# Таймауты запросов к Spotify (сек): (соединение, чтение).
+# HOT — для запросов на горячем пути (плеер, поиск): при превышении отдаем последний известный результат
+SPOTIFY_TIMEOUT = (3.05, 10)
+SPOTIFY_HOT_TIMEOUT = (1, float(os.getenv('SPOTIFY_HOT_TIMEOUT', 1.5)))
+# Сколько хранить последний удачный результат поиска на случай сбоя Spotify
+SEARCH_STALE_TTL = 60 * 60 * 24
+# Локальный индекс подсказок поиска (jukebox/typeahead.py)
+TYPEAHEAD_REFRESH = int(os.getenv('TYPEAHEAD_REFRESH', 30))  # Как часто догружать новые треки, сек
+TYPEAHEAD_MAX_TRACKS = int(os.getenv('TYPEAHEAD_MAX_TRACKS', 50000))
+
+# Фоновые задачи (jukebox/background.py)
+BACKGROUND_WORKERS = int(os.getenv('BACKGROUND_WORKERS', 4))
+BACKGROUND_TASKS_EAGER = False  # True — выполнять сразу (тесты)
+
+# Метаданные треков почти не меняются — храним их долго (30 дней)
+TRACK_METADATA_TTL = int(os.getenv('TRACK_METADATA_TTL', 60 * 60 * 24 * 30))
+# Результаты поиска (список id треков) кэшируем на 10 минут
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', 60 * 10))
+# Окно (сек), в котором повторные play/pause/skip/prev одной комнаты схлопываются
+PLAYER_COMMAND_WINDOW = float(os.getenv('PLAYER_COMMAND_WINDOW', 1.5))
+# Максимум гостей в одной комнате (jukebox/presence.py); 0 — без ограничения
+ROOM_MAX_LISTENERS = int(os.getenv('ROOM_MAX_LISTENERS', 0))
+# Как часто (сек) хост записывает в БД свой "пульс" last_active
+HOST_HEARTBEAT_INTERVAL = int(os.getenv('HOST_HEARTBEAT_INTERVAL', 30))
+
+# Фоновый опрос плееров комнат (jukebox/poller.py), поделенный между воркерами через WorkerLease.
+# Работает только в отдельных процессах: python manage.py poll_rooms.
+# ROOM_POLLER_ENABLED=True сообщает веб-воркерам, что опросчик запущен (запросы дают ему ROOM_POLLER_GRACE).
+# Нужен общий кэш (REDIS_URL): без него poll_rooms не запускается, а флаг игнорируется
+ROOM_POLLER_ENABLED = os.getenv('ROOM_POLLER_ENABLED', 'False') == 'True'
+ROOM_POLLER_TICK = float(os.getenv('ROOM_POLLER_TICK', 1))  # Секунды между проходами
+ROOM_LEASE_TTL = int(os.getenv('ROOM_LEASE_TTL', 15))  # Через сколько комната упавшего воркера освободится
+ROOM_POLLER_GRACE = float(os.getenv('ROOM_POLLER_GRACE', 3))  # Сколько запрос ждет опросчика, прежде чем идти в Spotify сам
+
+# Заблаговременное обновление токенов хостов (jukebox/tokens.py), работает вместе с опросчиком
+TOKEN_REFRESH_INTERVAL = int(os.getenv('TOKEN_REFRESH_INTERVAL', 60))  # Как часто искать истекающие токены, сек
+TOKEN_REFRESH_MARGIN = int(os.getenv('TOKEN_REFRESH_MARGIN', 60 * 10))  # За сколько до истечения обновлять
+TOKEN_REFRESH_WORKERS = int(os.getenv('TOKEN_REFRESH_WORKERS', 4))  # Параллельных запросов к Spotify
+TOKEN_REFRESH_BATCH = int(os.getenv('TOKEN_REFRESH_BATCH', 200))  # Токенов за один проход
+
+# Рассылка изменений комнат через Postgres LISTEN/NOTIFY (jukebox/events.py), выключена по умолчанию.
+# С ней каждый воркер записывает версии очереди из уведомлений; без нее версии совпадают у всех воркеров
+# только при общем кэше (REDIS_URL)
+ROOM_EVENTS_ENABLED = os.getenv('ROOM_EVENTS_ENABLED', 'False') == 'True'
+ROOM_EVENTS_RETRY = float(os.getenv('ROOM_EVENTS_RETRY', 5))  # Пауза перед переподключением слушателя
+
+# Нагрузочный тест (manage.py loadtest) пишет в базу из настроек — только на отдельной тестовой базе
+LOADTEST_ALLOWED = os.getenv('LOADTEST_ALLOWED', 'False') == 'True'
+
+# Лимиты запросов, расходующих квоту Spotify хоста (jukebox/throttles.py):
+# на сессию и на комнату по классам эндпоинтов, плюс общий бюджет хоста.
+# Счетчики — в кэше: без REDIS_URL у каждого воркера свои, и реальный лимит = ставка x число воркеров
+REST_FRAMEWORK = {
+    'DEFAULT_THROTTLE_RATES': {
+        'search_session': '30/min',
+        'search_room': '120/min',
+        'search_spotify_session': '30/min',  # Отложенная догрузка из Spotify после локальных совпадений
+        'search_spotify_room': '120/min',
+        'queue_session': '10/min',
+        'queue_room': '60/min',
+        'control_session': '20/min',
+        'control_room': '60/min',
+        'spotify_host': '300/min',
+    },
+}
+
+# /metrics/ отдается только с заголовком "Authorization: Bearer <METRICS_TOKEN>"; не задан — 403
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+# Профилировщик медленных запросов (выключен по умолчанию)
+PROFILER_ENABLED = os.getenv('PROFILER_ENABLED', 'False') == 'True'
+PROFILER_SAMPLE_RATE = float(os.getenv('PROFILER_SAMPLE_RATE', 0.01))  # Доля профилируемых запросов
+PROFILER_MIN_MS = float(os.getenv('PROFILER_MIN_MS', 200))  # Сохраняем только запросы медленнее
+PROFILER_KEEP = int(os.getenv('PROFILER_KEEP', 20))  # Сколько самых медленных профилей хранить
+PROFILER_DIR = os.getenv('PROFILER_DIR', str(BASE_DIR / 'profiles'))
+
+# Логи (jukebox/log.py): JSON-строки в stderr через очередь, запрос не ждет вывода.
+# LOG_FORMAT=text — для разработки. Уровни по подсистемам: LOG_LEVELS="spotify=DEBUG,poller=WARNING"
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_LEVELS = dict(item.strip().split('=', 1) for item in os.getenv('LOG_LEVELS', '').split(',') if '=' in item)
+# Повторяющиеся ошибки Spotify: не больше N одинаковых записей в минуту
+LOG_UPSTREAM_BURST = int(os.getenv('LOG_UPSTREAM_BURST', 5))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'context': {'()': 'jukebox.log.ContextFilter'},
+        'upstream_rate_limit': {'()': 'jukebox.log.RateLimitFilter', 'burst': LOG_UPSTREAM_BURST, 'period': 60},
+    },
+    'handlers': {
+        'async': {'()': 'jukebox.log.AsyncHandler', 'fmt': LOG_FORMAT, 'filters': ['context']},
+    },
+    'loggers': {
+        'jukebox': {'handlers': ['async'], 'level': LOG_LEVEL, 'propagate': False},
+        'jukebox.spotify': {'filters': ['upstream_rate_limit']},
+    },
+}
+for _subsystem, _level in LOG_LEVELS.items():
+    LOGGING['loggers'].setdefault(f'jukebox.{_subsystem}', {})['level'] = _level.upper()
+
 INSTALLED_APPS = [
     'django.contrib.admin',
     'django.contrib.auth',
@@ -78,13 +182,17 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'jukebox.middleware.ReplicaRoutingMiddleware',
+    'jukebox.middleware.MetricsMiddleware',
+    'jukebox.middleware.SamplingProfilerMiddleware',
 ]
 
 ROOT_URLCONF = 'config.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Тот же DjangoTemplates, но с учетом времени рендера в Server-Timing
+        'BACKEND': 'jukebox.timing.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -117,6 +225,38 @@ DATABASES = {
     }
 }
 
+# Реплики только для чтения (jukebox/db_router.py): DB_REPLICA_HOSTS=replica1.local,replica2.local
+# Остальные параметры подключения — как у основной БД
+DB_REPLICA_HOSTS = [host for host in os.getenv('DB_REPLICA_HOSTS', '').split(',') if host]
+for _number, _host in enumerate(DB_REPLICA_HOSTS, 1):
+    DATABASES[f'replica{_number}'] = dict(DATABASES['default'], HOST=_host, TEST={'MIRROR': 'default'})
+DATABASE_ROUTERS = ['jukebox.db_router.ReplicaRouter']
+# Сколько секунд после записи клиент читает только основную БД (запас на отставание реплик)
+DB_REPLICA_PIN = int(os.getenv('DB_REPLICA_PIN', 5))
+
+# Cache
+# Если задан REDIS_URL — общий кэш для всех воркеров, иначе локальная память процесса
+
+REDIS_URL = os.getenv('REDIS_URL')
+
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Голоса за пропуск (jukebox/votes.py) считаются в кэше только если он общий для всех воркеров:
+# с кэшем в памяти процесса гость мог бы проголосовать по разу в каждом воркере — тогда голоса сразу в БД
+VOTES_IN_CACHE = bool(REDIS_URL)
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class JukeboxConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'jukebox'
+
+    def ready(self):
+        from . import events  # Подписчики событий комнат
+
+        # Фоновые потоки здесь не запускаются: опросчик — отдельным процессом manage.py poll_rooms,
+        # слушатель событий — при первом опросе в воркере (events.start_listener)
@@ -0,0 +1,46 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+
+# Фоновые задачи внутри процесса (обновление снимков, кэшей и т.п.),
+# чтобы пользовательский запрос не ждал медленный Spotify.
+
+_executor = ThreadPoolExecutor(max_workers=settings.BACKGROUND_WORKERS, thread_name_prefix='jukebox-bg')
+_inflight = set()
+_lock = threading.Lock()
+
+
+def submit_once(key, func, *args, lock_timeout=30):
+    """
+    Запускает func(*args) в фоне, если задача с таким ключом еще не выполняется
+    ни в этом процессе, ни (через блокировку в кэше) в других. Возвращает True, если запустили.
+    """
+    with _lock:
+        if key in _inflight:
+            return False
+        _inflight.add(key)
+
+    cache_key = f"bg-lock:{key}"
+    if not cache.add(cache_key, True, lock_timeout):
+        with _lock:
+            _inflight.discard(key)
+        return False
+
+    def run():
+        try:
+            func(*args)
+        finally:
+            cache.delete(cache_key)
+            with _lock:
+                _inflight.discard(key)
+            if not settings.BACKGROUND_TASKS_EAGER:
+                close_old_connections()
+
+    if settings.BACKGROUND_TASKS_EAGER:
+        # Для тестов: выполняем сразу в текущем потоке
+        run()
+    else:
+        _executor.submit(run)
+    return True
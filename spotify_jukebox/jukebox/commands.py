@@ -0,0 +1,137 @@
+import time
+from django.conf import settings
+from django.core.cache import cache
+from . import devices
+from .playback import apply_optimistic, restore_snapshot, reset_idle, note_command
+from .metrics import cache_hit
+
+# Канал команд плеера комнаты.
+# Все нажатия play/pause/skip/prev проходят здесь: дубли в коротком окне
+# схлопываются, а пачка переключений play/pause сводится к последнему намерению.
+
+ACTIONS = {
+    'play': devices.play,
+    'pause': devices.pause,
+    'skip': devices.skip,
+    'prev': devices.prev,
+}
+TOGGLES = ('play', 'pause')
+
+LOCK_TIMEOUT = 10  # Секунды; на случай, если воркер упал, не отпустив блокировку
+RETRY_AFTER = 1  # Через сколько секунд клиенту повторить команду, отложенную из-за занятого канала
+IDEMPOTENCY_TTL = 60 * 10
+
+
+def _lock_key(room_id):
+    return f"cmd-lock:{room_id}"
+
+
+def _intent_key(room_id):
+    return f"cmd-intent:{room_id}"
+
+
+def _last_key(room_id):
+    return f"cmd-last:{room_id}"
+
+
+def run_command(room, action, idempotency_key=None, by_host=False):
+    """
+    Отправляет команду плеера хоста комнаты.
+
+    Возвращает {'action': ..., 'status': ...}, где status:
+      applied   — команда отправлена в Spotify;
+      coalesced — такая же команда только что была (или уже отправляется), повтор не нужен;
+      pending   — сейчас отправляется другое play/pause, итоговое намерение применит тот запрос;
+                  с 'retry' — отправляется команда другого вида, клиент повторяет через RETRY_AFTER
+                  с тем же ключом;
+      failed    — Spotify вернул ошибку (в 'error' подробности).
+    Повторный запрос с тем же idempotency_key и action возвращает сохраненный результат
+    (кроме pending — его повтор отправляется заново).
+    by_host — команду отдал сам хост (а не гость или голосование).
+    """
+    result_key = f"cmd-result:{room.pk}:{action}:{idempotency_key}" if idempotency_key else None
+    if result_key:
+        stored = cache.get(result_key)
+        if stored is not None:
+            cache_hit('idempotency')
+            return dict(stored, replayed=True)
+
+    result = _dispatch(room, action, by_host)
+
+    if result_key and result['status'] != 'pending':
+        cache.set(result_key, result, IDEMPOTENCY_TTL)
+    return result
+
+
+def _dispatch(room, action, by_host=False):
+    if action in TOGGLES:
+        # Последнее нажатие play/pause — это и есть намерение пользователя
+        cache.set(_intent_key(room.pk), action, LOCK_TIMEOUT)
+
+    last = cache.get(_last_key(room.pk))
+    if last and last['action'] == action and time.time() - last['at'] < settings.PLAYER_COMMAND_WINDOW:
+        return {'action': action, 'status': 'coalesced'}
+
+    # В блокировке — какая команда сейчас отправляется
+    if not cache.add(_lock_key(room.pk), action, LOCK_TIMEOUT):
+        holder = cache.get(_lock_key(room.pk))
+        if action in TOGGLES and holder in TOGGLES:
+            # Отправляющий play/pause после своей команды перечитает намерение
+            return {'action': action, 'status': 'pending'}
+        if holder == action:
+            return {'action': action, 'status': 'coalesced'}
+        # Команда другого вида не поглощается (skip — не пауза): воркер не ждет
+        # освобождения канала, а клиент повторяет запрос с тем же ключом
+        return {'action': action, 'status': 'pending', 'retry': True}
+
+    try:
+        if action in TOGGLES:
+            result = _apply_final_intent(room, action, by_host)
+        else:
+            result = _apply(room, action, by_host)
+    finally:
+        cache.delete(_lock_key(room.pk))
+
+    if action in TOGGLES:
+        # Намерение, записанное после последней проверки, но до снятия блокировки,
+        # получило 'pending' — применить его больше некому
+        intent = cache.get(_intent_key(room.pk))
+        if intent and intent != result['action']:
+            return _dispatch(room, intent, by_host)
+    return result
+
+
+def _apply_final_intent(room, action, by_host=False):
+    """Пока команда шла в Spotify, могли нажать еще раз — догоняем итоговое намерение."""
+    applied = None
+    result = None
+    for _ in range(3):
+        intent = cache.get(_intent_key(room.pk)) or action
+        if intent == applied:
+            break
+        result = _apply(room, intent, by_host)
+        applied = intent
+    return result
+
+
+def _apply(room, action, by_host=False):
+    # Гости видят результат команды сразу, не дожидаясь ответа Spotify
+    previous = apply_optimistic(room, action)
+
+    response = ACTIONS[action](room.host, by_host=by_host) or {}
+    error = response.get('error') or response.get('Error')
+
+    if error:
+        if previous:
+            restore_snapshot(room, previous)
+        return {'action': action, 'status': 'failed', 'error': error}
+
+    if by_host:
+        # Хост управляет плеером, и Spotify команду принял — устройство есть, опрашиваем сразу.
+        # Сбрасываем после команды: по паузе опроса devices понимает, что переносить воспроизведение надо сразу.
+        # Нажатия гостей и голосования паузу не сбрасывают: иначе они будили бы опрос хоста без устройства
+        reset_idle(room.host)
+
+    cache.set(_last_key(room.pk), {'action': action, 'at': time.time()}, LOCK_TIMEOUT)
+    note_command(room)
+    return {'action': action, 'status': 'applied'}
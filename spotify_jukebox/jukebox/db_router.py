@@ -0,0 +1,57 @@
+import random
+from contextvars import ContextVar
+from django.conf import settings
+
+# Чтение с реплик Postgres для горячих read-only эндпоинтов.
+# Вью с атрибутом replica_reads = True читают модели jukebox с случайной реплики
+# (DB_REPLICA_HOSTS), все записи идут в основную БД. Read-your-writes:
+# как только в запросе была запись, дальнейшие чтения идут в основную БД, а клиент
+# на DB_REPLICA_PIN секунд закрепляется за ней (ReplicaRoutingMiddleware).
+# Сессии, пользователи и фоновые задачи (вне запроса) всегда читают основную БД.
+# Вью, которые пишут на основе прочитанного (плеер: heartbeat, смена трека, закрытие
+# комнаты), replica_reads не ставят — решение о записи по отставшей реплике было бы неверным.
+
+_state = ContextVar('db_routing', default=None)
+
+
+def replicas():
+    return [alias for alias in settings.DATABASES if alias.startswith('replica')]
+
+
+def start():
+    return _state.set({'replica': False, 'wrote': False})
+
+
+def use_replica():
+    state = _state.get()
+    if state is not None:
+        state['replica'] = True
+
+
+def finish(token):
+    """Завершает запрос. True — в нем была запись."""
+    state = _state.get()
+    _state.reset(token)
+    return bool(state and state['wrote'])
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if not state or not state['replica'] or state['wrote'] or model._meta.app_label != 'jukebox':
+            return None
+        aliases = replicas()
+        return random.choice(aliases) if aliases else None
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None and model._meta.app_label == 'jukebox':
+            state['wrote'] = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплики — копии основной БД
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
@@ -0,0 +1,130 @@
+from django.core.cache import cache
+from .metrics import cache_hit, cache_miss
+from .playback import get_idle_backoff
+from .spotify_util import NO_DEVICE_ERROR, get_devices, transfer_playback
+from .spotify_util import play_song, pause_song, skip_song, prev_song, add_to_queue
+
+# Устройство, на которое уходят команды плеера хоста.
+# Пока у хоста есть активное устройство, команды идут как раньше, без device_id.
+# Если активного нет, Spotify отвечает 404 NO_ACTIVE_DEVICE на каждое нажатие гостя — тогда берем
+# лучшее устройство из списка (кэшируется на хоста и обновляется редко),
+# переносим на него воспроизведение и повторяем команду. Когда опрос уже знает,
+# что устройства нет (пауза опроса 'No Active Device'), переносим сразу, без заведомо
+# неудачного запроса, а пока действует запомненный пустой список — нажатия гостей не ходят
+# в Spotify вовсе. Нажатие хоста список перечитывает: он мог только что открыть Spotify.
+
+DEVICE_TTL = 60 * 10
+NO_DEVICE_TTL = 30  # Пустой список перепроверяем чаще: хост мог открыть Spotify
+# Чем меньше, тем лучше для переноса воспроизведения, если активного устройства нет
+DEVICE_TYPES = {'Computer': 0, 'Smartphone': 1, 'Speaker': 2, 'TV': 3, 'CastAudio': 4}
+
+
+def _device_key(host_id):
+    return f"device:{host_id}"
+
+
+def pick_device(devices):
+    """Активное устройство, иначе лучшее по типу; устройства с ограничениями не берем."""
+    usable = [device for device in devices if device.get('id') and not device.get('is_restricted')]
+    if not usable:
+        return None
+    best = min(usable, key=lambda device: (not device.get('is_active'),
+                                           DEVICE_TYPES.get(device.get('type'), len(DEVICE_TYPES))))
+    return {'id': best['id'], 'name': best.get('name'), 'is_active': bool(best.get('is_active'))}
+
+
+def resolve(host, refresh=False):
+    """Устройство для команд хоста ({'id', 'name', 'is_active'}) или None."""
+    if not refresh:
+        device = cache.get(_device_key(host.pk))
+        if device is not None:
+            cache_hit('device')
+            return device or None
+    cache_miss('device')
+
+    devices = get_devices(host)
+    if devices is None:
+        # Spotify не ответил — ничего не запоминаем
+        return None
+    device = pick_device(devices)
+    cache.set(_device_key(host.pk), device or {}, DEVICE_TTL if device else NO_DEVICE_TTL)
+    return device
+
+
+def invalidate(host):
+    cache.delete(_device_key(host.pk))
+
+
+def is_no_device(response):
+    """Spotify не нашел активного устройства (а не, например, 404 на неверный uri)."""
+    return response.get('status_code') in (403, 404) and 'NO_ACTIVE_DEVICE' in str(response.get('error'))
+
+
+def _known_idle(host):
+    """Последний опрос плеера хоста видел 'нет устройства'."""
+    idle = get_idle_backoff(host)
+    return bool(idle) and idle['reason'] == NO_DEVICE_ERROR
+
+
+def send(host, command, transfer=None, by_host=False):
+    """
+    Выполняет command(host, device_id=None) на устройстве хоста.
+
+    transfer — для play/pause: перенос воспроизведения с play=transfer уже и есть
+    эта команда, повторять ее не нужно.
+    by_host — нажал сам хост: запомненный пустой список устройств его не останавливает.
+    """
+    if cache.get(_device_key(host.pk)) == {}:
+        if by_host:
+            invalidate(host)
+        else:
+            # Недавно проверяли (NO_DEVICE_TTL): устройств нет — ни команды, ни списка устройств
+            cache_hit('device')
+            return {'error': NO_DEVICE_ERROR, 'status_code': 404}
+    if _known_idle(host):
+        device = resolve(host)
+        if device is None:
+            return {'error': NO_DEVICE_ERROR, 'status_code': 404}
+    else:
+        response = command(host) or {}
+        if not is_no_device(response):
+            return response
+        # Запомненное устройство пропало (или список еще не читали) — перечитываем
+        device = resolve(host, refresh=True)
+        if device is None:
+            return response
+
+    if device['is_active']:
+        # Устройство активно, но Spotify его не нашел (только что проснулось) — адресуем явно
+        response = command(host, device_id=device['id']) or {}
+    else:
+        response = transfer_playback(host, device['id'], play=bool(transfer))
+        if not response.get('error'):
+            cache.set(_device_key(host.pk), dict(device, is_active=True), DEVICE_TTL)
+            if transfer is None:
+                response = command(host, device_id=device['id']) or {}
+
+    if is_no_device(response):
+        # Устройство пропало — в следующий раз перечитаем список
+        invalidate(host)
+    return response
+
+
+def play(host, by_host=False):
+    return send(host, play_song, transfer=True, by_host=by_host)
+
+
+def pause(host, by_host=False):
+    return send(host, pause_song, transfer=False, by_host=by_host)
+
+
+def skip(host, by_host=False):
+    return send(host, skip_song, by_host=by_host)
+
+
+def prev(host, by_host=False):
+    return send(host, prev_song, by_host=by_host)
+
+
+def queue(host, uri):
+    return send(host, lambda host, device_id=None: add_to_queue(host, uri, device_id))
@@ -0,0 +1,135 @@
+import json
+import select
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from .log import get_logger
+
+# Лента изменений комнат между процессами без отдельного брокера.
+# Логическое изменение комнаты (трек добавлен или заиграл, настройки, голоса, удаление)
+# публикуется одним компактным событием {"r": room_id, "k": вид, "o": save|delete}:
+# код, который меняет данные, вызывает publish сам — не сигнал на каждую строку.
+# Версия данных комнаты — время последнего события; ее записывает в кэш каждый,
+# кто событие получил. С ROOM_EVENTS_ENABLED (только Postgres) события рассылаются
+# через NOTIFY: поток-слушатель (LISTEN) каждого воркера записывает версию из уведомления
+# и вызывает подписчиков этого процесса, так что версии совпадают и при кэше в памяти процесса.
+# Без слушателя событие получает только процесс, где произошло изменение, — тогда
+# одинаковые версии у всех воркеров дает лишь общий кэш (REDIS_URL).
+
+CHANNEL = 'jukebox_events'
+VERSION_TTL = 60 * 60 * 24
+
+_handlers = []
+_listening = threading.Event()
+
+logger = get_logger('events')
+
+
+def subscribe(handler):
+    """handler(event) вызывается на каждое событие в этом процессе."""
+    _handlers.append(handler)
+    return handler
+
+
+def _version_key(room_id, kind):
+    return f"room-version:{room_id}:{kind}"
+
+
+def version(room_id, kind):
+    """Версия данных комнаты (время последнего события); 0, если неизвестна."""
+    start_listener()
+    return cache.get(_version_key(room_id, kind), 0)
+
+
+# --- ПУБЛИКАЦИЯ ---
+
+# Время события берем из now() транзакции: оно одинаково для всех ее событий,
+# поэтому Postgres схлопывает одинаковые уведомления одной транзакции
+NOTIFY_SQL = "SELECT pg_notify(%s, %s || ',\"t\":' || round(extract(epoch from now())::numeric, 3) || '}')"
+
+
+def publish(room_id, kind, op='save'):
+    """
+    Публикует событие комнаты после коммита транзакции: откаченные изменения
+    никого не разбудят (NOTIFY в Postgres тоже транзакционный).
+    """
+    if settings.ROOM_EVENTS_ENABLED and connection.vendor == 'postgresql':
+        body = json.dumps({'r': room_id, 'k': kind, 'o': op}, separators=(',', ':'))[:-1]
+        with connection.cursor() as cursor:
+            cursor.execute(NOTIFY_SQL, [CHANNEL, body])
+    event = {'r': room_id, 'k': kind, 'o': op}
+    transaction.on_commit(lambda: _committed(event))
+
+
+def _committed(event):
+    # Со слушателем событие (и версию с временем из базы) процесс получит, как и все, через NOTIFY;
+    # без него узнает о своем событии напрямую
+    if not _listening.is_set():
+        dispatch(json.dumps(dict(event, t=round(time.time(), 3))))
+
+
+# --- ПРИЕМ ---
+
+def dispatch(payload):
+    event = json.loads(payload)
+    cache.set(_version_key(event['r'], event['k']), event['t'], VERSION_TTL)
+    for handler in _handlers:
+        handler(event)
+
+
+@subscribe
+def _invalidate(event):
+    """Комната удалена — ее производные данные в кэше больше не нужны."""
+    if event['k'] == 'room' and event['o'] == 'delete':
+        room_id = event['r']
+        cache.delete_many([f"playback:{room_id}", f"presence:{room_id}", f"recent-cmd:{room_id}"]
+                          + [_version_key(room_id, kind) for kind in ('room', 'queue', 'vote')])
+
+
+def listen_forever(stop_event=None):
+    """Поток-слушатель LISTEN (только Postgres). Переподключается при обрыве."""
+    import psycopg2
+
+    stop_event = stop_event or threading.Event()
+    while not stop_event.is_set():
+        conn = None
+        try:
+            conn = psycopg2.connect(**connection.get_connection_params())
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            conn.cursor().execute(f"LISTEN {CHANNEL}")
+            _listening.set()
+            while not stop_event.is_set():
+                if select.select([conn], [], [], 5) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    dispatch(conn.notifies.pop(0).payload)
+        except Exception as exc:
+            logger.warning("Room events listener disconnected: %s", exc)
+            stop_event.wait(settings.ROOM_EVENTS_RETRY)
+        finally:
+            _listening.clear()
+            if conn is not None:
+                conn.close()
+
+
+_started = False
+_start_lock = threading.Lock()
+
+
+def start_listener():
+    """
+    Запускает слушателя в потоке текущего процесса (один раз на процесс, только Postgres
+    и ROOM_EVENTS_ENABLED). Вызывается при первом опросе, то есть уже в воркере после fork.
+    """
+    global _started
+    if _started or not settings.ROOM_EVENTS_ENABLED or connection.vendor != 'postgresql':
+        return False
+    with _start_lock:
+        if _started:
+            return False
+        _started = True
+    threading.Thread(target=listen_forever, name='jukebox-events', daemon=True).start()
+    return True
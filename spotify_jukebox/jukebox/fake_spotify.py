@@ -0,0 +1,222 @@
+import json
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Локальная заглушка Spotify Web API для нагрузочного теста (manage.py loadtest).
+# Моделирует плеер каждого хоста (по access token), задержку ответа
+# и лимит запросов с ответом 429 + Retry-After.
+
+
+class FakePlayer:
+    def __init__(self, catalog, rng):
+        self.rng = rng
+        self.catalog = catalog
+        self.queue = deque()
+        self.track = rng.choice(catalog)
+        self.started_at = time.time()  # Момент, соответствующий progress = 0
+        self.paused_progress = None  # Позиция, если на паузе
+
+    def progress_ms(self):
+        if self.paused_progress is not None:
+            return self.paused_progress
+        progress = int((time.time() - self.started_at) * 1000)
+        if progress >= self.track['duration_ms']:
+            self.next()
+            return 0
+        return progress
+
+    def next(self):
+        self.track = self.queue.popleft() if self.queue else self.rng.choice(self.catalog)
+        self.started_at = time.time()
+        if self.paused_progress is not None:
+            self.paused_progress = 0
+
+    def play(self):
+        if self.paused_progress is not None:
+            self.started_at = time.time() - self.paused_progress / 1000
+            self.paused_progress = None
+
+    def pause(self):
+        if self.paused_progress is None:
+            self.paused_progress = self.progress_ms()
+
+
+class FakeSpotify:
+    """
+    Состояние заглушки: каталог, плееры, счетчики запросов.
+
+    latency_ms / jitter_ms — задержка каждого ответа;
+    rate_limit — сколько запросов один токен может сделать за rate_window секунд.
+    """
+
+    def __init__(self, catalog_size=500, latency_ms=80, jitter_ms=30, rate_limit=180, rate_window=30, seed=0):
+        self.rng = random.Random(seed)
+        self.catalog = [self._make_track(i) for i in range(catalog_size)]
+        self.tracks_by_id = {track['id']: track for track in self.catalog}
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+
+        self.lock = threading.Lock()
+        self.players = {}
+        self.recent = defaultdict(deque)  # token -> времена запросов в окне лимита
+        self.calls = defaultdict(int)  # token -> всего запросов
+        self.rate_limited = defaultdict(int)  # token -> ответов 429
+        self.server = None
+
+    def _make_track(self, index):
+        words = ['love', 'night', 'summer', 'dance', 'fire', 'rain', 'heart', 'road', 'star', 'blue']
+        track_id = f"fake{index:06d}"
+        return {
+            'id': track_id,
+            'uri': f"spotify:track:{track_id}",
+            'name': f"{self.rng.choice(words).title()} {self.rng.choice(words)} {index}",
+            'artists': [{'name': f"Artist {index % 50}"}],
+            'album': {
+                'name': f"Album {index % 80}",
+                'images': [{'url': f"https://img.invalid/{track_id}/640"},
+                           {'url': f"https://img.invalid/{track_id}/64"}],
+            },
+            'duration_ms': self.rng.randint(120, 300) * 1000,
+            'explicit': False,
+        }
+
+    # --- ЗАПУСК ---
+
+    def start(self, host='127.0.0.1', port=0):
+        fake = self
+
+        class Handler(FakeSpotifyHandler):
+            spotify = fake
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://{host}:{self.server.server_port}"
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    # --- ЛОГИКА ---
+
+    def player(self, token):
+        with self.lock:
+            if token not in self.players:
+                self.players[token] = FakePlayer(self.catalog, self.rng)
+            return self.players[token]
+
+    def check_rate_limit(self, token):
+        """Возвращает Retry-After (сек), если лимит исчерпан, иначе None."""
+        now = time.time()
+        with self.lock:
+            self.calls[token] += 1
+            recent = self.recent[token]
+            while recent and now - recent[0] > self.rate_window:
+                recent.popleft()
+            if len(recent) >= self.rate_limit:
+                self.rate_limited[token] += 1
+                return max(1, int(self.rate_window - (now - recent[0])) + 1)
+            recent.append(now)
+            return None
+
+    def delay(self):
+        latency = max(0, self.rng.gauss(self.latency_ms, self.jitter_ms))
+        time.sleep(latency / 1000)
+
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+    spotify = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass  # Не засоряем вывод нагрузочного теста
+
+    def _send_json(self, status, body=None, headers=None):
+        payload = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        if payload:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _handle(self, method):
+        spotify = self.spotify
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+
+        spotify.delay()
+
+        if url.path == '/api/token':
+            return self._send_json(200, {'access_token': 'refreshed', 'token_type': 'Bearer', 'expires_in': 3600})
+
+        token = (self.headers.get('Authorization') or '').replace('Bearer ', '')
+        retry_after = spotify.check_rate_limit(token)
+        if retry_after:
+            return self._send_json(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}},
+                                   {'Retry-After': retry_after})
+
+        player = spotify.player(token)
+        path = url.path.replace('/v1/', '', 1).strip('/')
+
+        if method == 'GET' and path == 'me/player/currently-playing':
+            progress = player.progress_ms()  # Может переключить трек, если текущий закончился
+            return self._send_json(200, {
+                'item': player.track,
+                'progress_ms': progress,
+                'is_playing': player.paused_progress is None,
+            })
+        if method == 'GET' and path == 'search':
+            needle = (query.get('q') or [''])[0].lower()
+            limit = int((query.get('limit') or ['5'])[0])
+            items = [track for track in spotify.catalog if needle in track['name'].lower()][:limit]
+            return self._send_json(200, {'tracks': {'items': items}})
+        if method == 'GET' and path == 'tracks':
+            ids = (query.get('ids') or [''])[0].split(',')
+            return self._send_json(200, {'tracks': [spotify.tracks_by_id.get(track_id) for track_id in ids]})
+        if method == 'GET' and path == 'me/player/devices':
+            return self._send_json(200, {'devices': [
+                {'id': 'fake-device', 'is_active': True, 'is_restricted': False, 'name': 'Fake', 'type': 'Computer'}
+            ]})
+        if method == 'PUT' and path == 'me/player/play':
+            player.play()
+            return self._send_json(204)
+        if method == 'PUT' and path == 'me/player/pause':
+            player.pause()
+            return self._send_json(204)
+        if method == 'PUT' and path == 'me/player':
+            return self._send_json(204)
+        if method == 'POST' and path == 'me/player/next':
+            player.next()
+            return self._send_json(204)
+        if method == 'POST' and path == 'me/player/previous':
+            player.started_at = time.time()
+            return self._send_json(204)
+        if method == 'POST' and path == 'me/player/queue':
+            track_id = (query.get('uri') or [''])[0].split(':')[-1]
+            if track_id in spotify.tracks_by_id:
+                player.queue.append(spotify.tracks_by_id[track_id])
+            return self._send_json(204)
+
+        return self._send_json(404, {'error': {'status': 404, 'message': 'Not found'}})
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
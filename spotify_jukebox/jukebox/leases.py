@@ -0,0 +1,70 @@
+import os
+import socket
+import uuid
+from datetime import timedelta
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import WorkerLease
+
+# Аренды фоновой работы между процессами и узлами (таблица WorkerLease).
+# Захват — одним UPDATE "если свободно или просрочено" либо INSERT, поэтому
+# работает на любой БД без advisory locks. Кто перестал продлевать — теряет аренду.
+
+# Уникален для процесса: узел + pid + случайный суффикс (pid переиспользуются)
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+def acquire(key, ttl, owner=WORKER_ID):
+    """Берет или продлевает аренду на ttl секунд. True — аренда наша."""
+    now = timezone.now()
+    expires_at = now + timedelta(seconds=ttl)
+
+    # Своя или просроченная аренда — забираем/продлеваем атомарно
+    taken = WorkerLease.objects.filter(Q(owner=owner) | Q(expires_at__lt=now), key=key) \
+        .update(owner=owner, expires_at=expires_at)
+    if taken:
+        return True
+
+    try:
+        with transaction.atomic():
+            WorkerLease.objects.create(key=key, owner=owner, expires_at=expires_at)
+        return True
+    except IntegrityError:
+        # Аренда есть и она действующая чужая
+        return False
+
+
+def renew(keys, ttl, owner=WORKER_ID):
+    """Продлевает сразу несколько своих аренд. Возвращает, сколько продлено."""
+    if not keys:
+        return 0
+    return WorkerLease.objects.filter(key__in=keys, owner=owner).update(
+        expires_at=timezone.now() + timedelta(seconds=ttl)
+    )
+
+
+def release(keys, owner=WORKER_ID):
+    WorkerLease.objects.filter(key__in=list(keys), owner=owner).delete()
+
+
+def release_all(owner=WORKER_ID):
+    WorkerLease.objects.filter(owner=owner).delete()
+
+
+def holders(keys):
+    """{key: owner} для действующих аренд из списка."""
+    return dict(
+        WorkerLease.objects.filter(key__in=list(keys), expires_at__gte=timezone.now())
+        .values_list('key', 'owner')
+    )
+
+
+def live_owners(prefix):
+    """Сколько действующих аренд с ключом на prefix (например, живых воркеров)."""
+    return WorkerLease.objects.filter(key__startswith=prefix, expires_at__gte=timezone.now()).count()
+
+
+def purge_expired(older_than=60 * 60):
+    """Удаляет давно просроченные аренды (комнаты закрыты, воркеры ушли)."""
+    WorkerLease.objects.filter(expires_at__lt=timezone.now() - timedelta(seconds=older_than)).delete()
@@ -0,0 +1,156 @@
+import atexit
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+
+# Логирование приложения: записи с контекстом (комната, хост, пользователь),
+# вывод в отдельном потоке через очередь — поток запроса никогда не ждет stdout/файл.
+# Подсистемы — логгеры jukebox.<имя> (spotify, auth, rooms, queue, poller, events),
+# уровни задаются в settings.LOGGING (переменная окружения LOG_LEVELS).
+
+_context = ContextVar('log_context', default=None)
+
+
+def get_logger(subsystem):
+    return logging.getLogger(f"jukebox.{subsystem}")
+
+
+# --- КОНТЕКСТ ЗАПРОСА ---
+
+def start(request):
+    return _context.set({'request': request})
+
+
+def finish(token):
+    _context.reset(token)
+
+
+def bind(**fields):
+    """Добавляет поля (room=..., host=...) ко всем записям до конца текущего запроса."""
+    context = _context.get()
+    if context is not None:
+        context.update(fields)
+
+
+class ContextFilter(logging.Filter):
+    """
+    Проставляет записи room / host / user из контекста запроса.
+    Считается только когда запись реально пишется, и не делает запросов к БД.
+    """
+
+    def filter(self, record):
+        context = _context.get() or {}
+        request = context.get('request')
+        if request is not None:
+            session = getattr(request, 'session', None)
+            if 'room' not in context and session is not None and getattr(session, '_session_cache', None) is not None:
+                record.room = session.get('room_code')
+            user = getattr(request, '_cached_user', None)
+            if user is not None and user.is_authenticated:
+                record.user = user.username
+            record.path = request.path
+        for name, value in context.items():
+            if name != 'request':
+                setattr(record, name, value)
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Не больше burst одинаковых записей (логгер + шаблон сообщения) за period секунд.
+    Первая запись после паузы сообщает, сколько было пропущено (поле suppressed).
+    """
+
+    def __init__(self, burst=5, period=60):
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self.lock = threading.Lock()
+        self.windows = {}  # ключ -> [начало окна, записано, пропущено]
+
+    def filter(self, record):
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.period:
+                suppressed = window[2] if window else 0
+                self.windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+# --- ВЫВОД ---
+
+STANDARD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON: время, уровень, логгер, сообщение и все доп. поля."""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in STANDARD_ATTRS and not name.startswith('_'):
+                entry[name] = value if isinstance(value, (str, int, float, bool, type(None))) else str(value)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """Для разработки: обычная строка, доп. поля в конце как key=value."""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        extra = [f"{name}={value}" for name, value in vars(record).items()
+                 if name not in STANDARD_ATTRS and not name.startswith('_')]
+        return f"{line} [{' '.join(extra)}]" if extra else line
+
+
+class AsyncHandler(QueueHandler):
+    """
+    Кладет записи в ограниченную очередь; в поток вывода их пишет QueueListener.
+    Если вывод не успевает и очередь полна, запись отбрасывается, а не блокирует запрос.
+    """
+
+    def __init__(self, fmt='json', stream=None, maxsize=10000):
+        super().__init__(queue.Queue(maxsize=maxsize))
+        target = logging.StreamHandler(stream or sys.stderr)
+        target.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+        self.dropped = 0
+        self.listener = QueueListener(self.queue, target)
+        self.listener.start()
+        self.stopped = False
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Дописывает очередь и останавливает поток вывода (повторный вызов ничего не делает)."""
+        if not self.stopped:
+            self.stopped = True
+            self.listener.stop()
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
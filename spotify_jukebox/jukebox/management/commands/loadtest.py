@@ -0,0 +1,242 @@
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.utils import timezone
+from jukebox.fake_spotify import FakeSpotify
+from jukebox.models import Room, SpotifyToken
+
+USER_PREFIX = 'loadtest_'
+# Свой кэш на время прогона: общий (Redis) не трогаем и не чистим
+LOADTEST_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'loadtest'}}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class Stats:
+    """Собирает (эндпоинт, задержка, число SQL-запросов) из всех потоков."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = []
+
+    def add(self, endpoint, seconds, queries, status):
+        with self.lock:
+            self.samples.append((endpoint, seconds, queries, status))
+
+
+class Command(BaseCommand):
+    help = (
+        "Нагрузочный тест: N комнат по M гостей опрашивают плеер, ищут, добавляют треки "
+        "и голосуют против локальной заглушки Spotify. Отчет: RPS, p50/p95/p99, "
+        "SQL-запросов на запрос, запросов к Spotify на комнату в минуту."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=5)
+        parser.add_argument('--guests', type=int, default=10, help='Гостей в каждой комнате')
+        parser.add_argument('--duration', type=float, default=60, help='Длительность в секундах')
+        parser.add_argument('--poll-interval', type=float, default=2.0,
+                            help='Если сервер не прислал X-Poll-After (как в room.html)')
+        parser.add_argument('--search-rate', type=float, default=0.05, help='Вероятность поиска на тик')
+        parser.add_argument('--add-rate', type=float, default=0.5, help='Вероятность добавить трек после поиска')
+        parser.add_argument('--vote-burst-rate', type=float, default=0.02,
+                            help='Вероятность "волны" голосов в комнате на тик')
+        parser.add_argument('--latency-ms', type=float, default=80, help='Задержка заглушки Spotify')
+        parser.add_argument('--rate-limit', type=int, default=180, help='Запросов на токен за 30 секунд до 429')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--yes', action='store_true',
+                            help='Подтверждение: база из настроек — тестовая, в нее можно писать')
+
+    def handle(self, *args, **options):
+        # Тест создает пользователей, комнаты, треки и метаданные в базе из настроек
+        database = settings.DATABASES['default']['NAME']
+        if not settings.LOADTEST_ALLOWED:
+            raise CommandError(
+                "Нагрузочный тест пишет в базу из настроек. Запускайте его на отдельной базе "
+                "с LOADTEST_ALLOWED=True (и отдельными --settings / DB_NAME)."
+            )
+        if not options['yes']:
+            raise CommandError(f"База {database} будет заполнена тестовыми данными — подтвердите флагом --yes")
+
+        # Имена пользователей этого прогона: удаляем только их
+        self.prefix = f"{USER_PREFIX}{uuid.uuid4().hex[:8]}_"
+        self.user_ids = []
+        self.session_keys = []
+
+        fake = FakeSpotify(latency_ms=options['latency_ms'], rate_limit=options['rate_limit'], seed=options['seed'])
+        base_url = fake.start()
+        self.stdout.write(f"Fake Spotify: {base_url}, база: {database}")
+
+        try:
+            with override_settings(
+                SPOTIFY_API_URL=f"{base_url}/v1/",
+                SPOTIFY_TOKEN_URL=f"{base_url}/api/token",
+                CACHES=LOADTEST_CACHES,
+            ):
+                rooms = self._create_rooms(options['rooms'])
+                stats, elapsed = self._run(rooms, fake, options)
+        finally:
+            fake.stop()
+            self._cleanup()
+
+        self._report(stats, elapsed, rooms, fake)
+
+    # --- ПОДГОТОВКА ---
+
+    def _cleanup(self):
+        # Комнаты, треки и токены удаляются каскадом вместе с пользователями
+        User.objects.filter(pk__in=self.user_ids).delete()
+        Session.objects.filter(session_key__in=self.session_keys).delete()
+
+    def _create_rooms(self, count):
+        rooms = []
+        for i in range(count):
+            host = User.objects.create_user(username=f"{self.prefix}host{i}")
+            self.user_ids.append(host.pk)
+            SpotifyToken.objects.create(
+                user=host, access_token=f"{self.prefix}token{i}", refresh_token='refresh',
+                token_type='Bearer', expires_in=timezone.now() + timedelta(days=1)
+            )
+            rooms.append(Room.objects.create(host=host, guest_can_pause=True, votes_to_skip=3))
+        return rooms
+
+    def _client(self, room, user=None):
+        client = Client(HTTP_HOST='localhost')
+        if user:
+            client.force_login(user)
+        # Сессия гостя с кодом комнаты — как после join_room
+        session = SessionStore(session_key=client.cookies[settings.SESSION_COOKIE_NAME].value) \
+            if user else SessionStore()
+        session['room_code'] = room.code
+        session.save()
+        self.session_keys.append(session.session_key)
+        client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+        return client
+
+    # --- НАГРУЗКА ---
+
+    def _run(self, rooms, fake, options):
+        stats = Stats()
+        stop_at = time.time() + options['duration']
+        bursts = defaultdict(int)  # room.pk -> номер последней "волны" голосов
+        threads = []
+
+        for index, room in enumerate(rooms):
+            clients = [(self._client(room, room.host), True)]
+            clients += [(self._client(room), False) for _ in range(options['guests'])]
+            for number, (client, is_host) in enumerate(clients):
+                rng = random.Random(options['seed'] * 100003 + index * 1009 + number)
+                thread = threading.Thread(
+                    target=self._session_loop,
+                    args=(client, is_host, room, rng, fake, stats, bursts, stop_at, options),
+                    daemon=True,
+                )
+                threads.append(thread)
+
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return stats, time.time() - started
+
+    def _session_loop(self, client, is_host, room, rng, fake, stats, bursts, stop_at, options):
+        queries = [0]
+
+        def count_query(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        def call(method, endpoint, path, **kwargs):
+            queries[0] = 0
+            started = time.perf_counter()
+            response = getattr(client, method)(path, secure=True, **kwargs)
+            stats.add(endpoint, time.perf_counter() - started, queries[0], response.status_code)
+            return response
+
+        seen_burst = 0
+        # Разносим старт, чтобы гости не опрашивали синхронно
+        time.sleep(rng.random() * options['poll_interval'])
+
+        try:
+            with connection.execute_wrapper(count_query):
+                while time.time() < stop_at:
+                    tick = time.time()
+                    player = call('get', 'current-song', '/api/current-song/')
+                    # Как браузер: следующий опрос — когда скажет сервер
+                    interval = float(player.get('X-Poll-After') or options['poll_interval'])
+
+                    if is_host and rng.random() < options['vote_burst_rate']:
+                        bursts[room.pk] += 1
+
+                    if not is_host:
+                        if rng.random() < options['search_rate']:
+                            track = rng.choice(fake.catalog)
+                            query = track['name'].split()[0]
+                            call('get', 'search', '/api/spotify/search/', data={'query': query})
+                            if rng.random() < options['add_rate']:
+                                call('post', 'add-to-queue', '/api/add-to-queue/', data={'uri': track['uri']})
+
+                        if bursts[room.pk] != seen_burst:
+                            seen_burst = bursts[room.pk]
+                            # Все гости жмут "Vote to Skip" в течение секунды
+                            time.sleep(rng.random())
+                            call('post', 'vote-to-skip', '/api/vote-to-skip/')
+
+                    time.sleep(max(0, interval - (time.time() - tick)))
+        finally:
+            connection.close()
+
+    # --- ОТЧЕТ ---
+
+    def _report(self, stats, elapsed, rooms, fake):
+        samples = stats.samples
+        if not samples:
+            self.stdout.write("Нет запросов")
+            return
+
+        self.stdout.write("")
+        self.stdout.write(f"Запросов: {len(samples)} за {elapsed:.1f} с, RPS: {len(samples) / elapsed:.1f}")
+
+        header = f"{'endpoint':<16}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>10}{'errors':>8}"
+        self.stdout.write(header)
+
+        by_endpoint = defaultdict(list)
+        for sample in samples:
+            by_endpoint[sample[0]].append(sample)
+        by_endpoint['ALL'] = samples
+
+        for endpoint, rows in by_endpoint.items():
+            latencies = [row[1] * 1000 for row in rows]
+            queries = sum(row[2] for row in rows) / len(rows)
+            errors = sum(1 for row in rows if row[3] >= 500)
+            self.stdout.write(
+                f"{endpoint:<16}{len(rows):>8}{percentile(latencies, 50):>10.1f}"
+                f"{percentile(latencies, 95):>10.1f}{percentile(latencies, 99):>10.1f}"
+                f"{queries:>10.1f}{errors:>8}"
+            )
+
+        minutes = elapsed / 60
+        per_room = [fake.calls.get(f"{self.prefix}token{i}", 0) / minutes for i in range(len(rooms))]
+        limited = sum(fake.rate_limited.values())
+        self.stdout.write("")
+        self.stdout.write(
+            f"Запросов к Spotify на комнату в минуту: среднее {sum(per_room) / len(per_room):.1f}, "
+            f"максимум {max(per_room):.1f}; ответов 429: {limited}"
+        )
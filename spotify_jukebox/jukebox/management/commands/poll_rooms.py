@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from jukebox import leases
+from jukebox.poller import run_forever
+
+
+class Command(BaseCommand):
+    help = (
+        "Опрашивает плееры активных комнат. Можно запускать на нескольких узлах: "
+        "комнаты делятся между процессами через аренды WorkerLease."
+    )
+
+    def handle(self, *args, **options):
+        # Снимки плеера опросчик кладет в кэш: без общего кэша веб-воркеры их не увидят,
+        # а Spotify будут спрашивать и опросчик, и каждый воркер
+        if not settings.REDIS_URL:
+            raise CommandError("Room poller needs a shared cache: set REDIS_URL")
+        self.stdout.write(f"Room poller {leases.WORKER_ID} started")
+        try:
+            run_forever()
+        except KeyboardInterrupt:
+            pass
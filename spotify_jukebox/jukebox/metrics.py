@@ -0,0 +1,106 @@
+import os
+from datetime import timedelta
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils import timezone
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest, multiprocess
+)
+from prometheus_client.core import GaugeMetricFamily
+from .models import Room
+from . import presence
+
+# Метрики в формате Prometheus. Отдаются на /metrics/, внешний сервис не нужен.
+# При нескольких воркерах gunicorn задайте PROMETHEUS_MULTIPROC_DIR — тогда
+# счетчики всех процессов суммируются.
+
+SPOTIFY_LATENCY = Histogram(
+    'jukebox_spotify_request_seconds', 'Время ответа Spotify по эндпоинтам', ['endpoint']
+)
+# По id хоста, не по имени: имена пользователей не должны попадать в метрики.
+# Запросы без хоста (обновление токена) идут с host_id="none"
+SPOTIFY_RESPONSES = Counter(
+    'jukebox_spotify_responses_total', 'Ответы Spotify по хосту комнаты и коду статуса', ['host_id', 'status']
+)
+SPOTIFY_RATE_LIMITED = Counter(
+    'jukebox_spotify_rate_limited_total', 'Ответы 429 от Spotify по хосту комнаты', ['host_id']
+)
+SPOTIFY_CALLS_BY_HOST = Counter(
+    'jukebox_spotify_calls_by_host_total', 'Запросы к Spotify от имени хоста комнаты', ['host_id']
+)
+VIEW_LATENCY = Histogram(
+    'jukebox_view_seconds', 'Время обработки запроса по маршрутам', ['view', 'method']
+)
+DB_QUERIES = Histogram(
+    'jukebox_db_queries_per_request', 'Число SQL-запросов на один HTTP-запрос', ['view'],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+)
+CACHE_REQUESTS = Counter(
+    'jukebox_cache_requests_total', 'Обращения к кэшам: hit / miss', ['cache', 'result']
+)
+TOKEN_REFRESHES = Counter(
+    'jukebox_token_refreshes_total', 'Фоновые обновления токенов хостов: ok / failed', ['result']
+)
+
+def cache_hit(name, count=1):
+    CACHE_REQUESTS.labels(name, 'hit').inc(count)
+
+
+def cache_miss(name, count=1):
+    CACHE_REQUESTS.labels(name, 'miss').inc(count)
+
+
+def observe_token_refresh(ok, failed):
+    TOKEN_REFRESHES.labels('ok').inc(ok)
+    TOKEN_REFRESHES.labels('failed').inc(failed)
+
+
+def observe_spotify(endpoint, status_code, seconds, user=None):
+    host_id = str(user.pk) if user is not None else 'none'
+    SPOTIFY_LATENCY.labels(endpoint).observe(seconds)
+    SPOTIFY_RESPONSES.labels(host_id, str(status_code)).inc()
+    if status_code == 429:
+        SPOTIFY_RATE_LIMITED.labels(host_id).inc()
+    if user is not None:
+        SPOTIFY_CALLS_BY_HOST.labels(host_id).inc()
+
+
+class RoomsCollector:
+    """Gauge-метрики, которые считаются в момент запроса /metrics/."""
+
+    def collect(self):
+        since = timezone.now() - timedelta(seconds=180)
+        room_ids = list(Room.objects.filter(last_active__gte=since).values_list('pk', flat=True))
+
+        guests = sum(presence.counts(room_ids).values())
+        # Растет и не падает — фоновое обновление токенов не справляется, скоро хосты "отвалятся"
+        from .tokens import due
+        expiring = due().count()
+
+        yield GaugeMetricFamily('jukebox_active_rooms', 'Комнаты с активным хостом', value=len(room_ids))
+        yield GaugeMetricFamily('jukebox_connected_guests', 'Сессии, опрашивающие плеер', value=guests)
+        yield GaugeMetricFamily('jukebox_expiring_host_tokens', 'Токены хостов активных комнат, которые скоро истекут',
+                                value=expiring)
+
+
+def metrics_view(request):
+    # Без настроенного токена метрики не отдаются никому
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if not token or request.headers.get('Authorization') != f"Bearer {token}":
+        return HttpResponse(status=403)
+
+    registry = CollectorRegistry()
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry.register(_ProcessRegistry())
+    registry.register(RoomsCollector())
+
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+class _ProcessRegistry:
+    """Метрики текущего процесса (глобальный REGISTRY) внутри временного реестра."""
+
+    def collect(self):
+        return REGISTRY.collect()
@@ -0,0 +1,130 @@
+import cProfile
+import random
+import time
+from contextlib import ExitStack
+from pathlib import Path
+from django.conf import settings
+from django.db import connections
+from . import db_router
+from . import log
+from . import timing
+from .metrics import VIEW_LATENCY, DB_QUERIES
+
+
+class MetricsMiddleware:
+    """
+    Для каждого HTTP-запроса: время обработки и число SQL-запросов в метрики,
+    разбивка времени (db / spotify / tpl) в заголовок Server-Timing.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = [0]
+
+        def count_query(execute, sql, params, many, context):
+            queries[0] += 1
+            with timing.measure('db'):
+                return execute(sql, params, many, context)
+
+        token = timing.start()
+        log_token = log.start(request)
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(count_query))
+                response = self.get_response(request)
+        finally:
+            timings = timing.finish(token)
+            log.finish(log_token)
+        total = time.perf_counter() - started
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.route if match else 'unmatched'
+        VIEW_LATENCY.labels(view, request.method).observe(total)
+        DB_QUERIES.labels(view).observe(queries[0])
+
+        entries = [f'db;dur={timings.get("db", 0) * 1000:.1f};desc="{queries[0]} queries"']
+        for name in ('spotify', 'tpl'):
+            entries.append(f'{name};dur={timings.get(name, 0) * 1000:.1f}')
+        entries.append(f'total;dur={total * 1000:.1f}')
+        response['Server-Timing'] = ', '.join(entries)
+        return response
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Включает чтение с реплик для вью с replica_reads = True (jukebox/db_router.py).
+    Клиент, который недавно писал, читает с основной БД, пока реплики не догонят:
+    отметка — в короткоживущей cookie, поэтому действует в любом воркере.
+    Без настроенных реплик ничего не делает.
+    """
+    PIN_COOKIE = 'db_pin'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not db_router.replicas():
+            return self.get_response(request)
+
+        token = db_router.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            wrote = db_router.finish(token)
+        if wrote:
+            # Подделанная cookie лишь отправит чтения в основную БД
+            response.set_cookie(self.PIN_COOKIE, '1', max_age=settings.DB_REPLICA_PIN,
+                                httponly=True, samesite='Lax')
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not getattr(getattr(view_func, 'view_class', None), 'replica_reads', False):
+            return None
+        if self.PIN_COOKIE not in request.COOKIES:
+            db_router.use_replica()
+        return None
+
+
+class SamplingProfilerMiddleware:
+    """
+    Профилирует случайную долю запросов (PROFILER_SAMPLE_RATE) и сохраняет
+    .prof-файлы самых медленных из них в PROFILER_DIR (оставляя PROFILER_KEEP штук).
+    Выключен по умолчанию; в выключенном состоянии — одна проверка флага на запрос.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = settings.PROFILER_ENABLED
+        self.sample_rate = settings.PROFILER_SAMPLE_RATE
+        self.min_ms = settings.PROFILER_MIN_MS
+        self.directory = Path(settings.PROFILER_DIR)
+
+    def __call__(self, request):
+        if not self.enabled or random.random() >= self.sample_rate:
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            return self.get_response(request)
+        finally:
+            profiler.disable()
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            if elapsed_ms >= self.min_ms:
+                self._save(profiler, request, elapsed_ms)
+
+    def _save(self, profiler, request, elapsed_ms):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        route = request.path.strip('/').replace('/', '_') or 'root'
+        # Длительность в начале имени: сортировка по имени = сортировка по времени
+        name = f"{int(elapsed_ms):07d}ms_{route}_{int(time.time() * 1000)}.prof"
+        profiler.dump_stats(self.directory / name)
+
+        profiles = sorted(self.directory.glob('*.prof'), reverse=True)
+        for old in profiles[settings.PROFILER_KEEP:]:
+            old.unlink(missing_ok=True)
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.9 on 2026-10-19 11:43
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jukebox', '0003_room_last_active'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrackMetadata',
+            fields=[
+                ('spotify_id', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('uri', models.CharField(max_length=100)),
+                ('title', models.CharField(max_length=200)),
+                ('artist', models.CharField(max_length=200)),
+                ('album', models.CharField(blank=True, max_length=200)),
+                ('image_url', models.URLField(blank=True, null=True)),
+                ('image_url_small', models.URLField(blank=True, null=True)),
+                ('duration_ms', models.PositiveIntegerField(default=0)),
+                ('explicit', models.BooleanField(default=False)),
+                ('fetched_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='track',
+            name='metadata',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='jukebox.trackmetadata'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.9 on 2026-10-19 11:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jukebox', '0004_track_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='track',
+            name='duration_ms',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='track',
+            name='queue_offset_ms',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -1,5 +1,7 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.conf import settings
+from datetime import timedelta
 import string
 import random
 from django.utils import timezone
@@ -9,7 +11,7 @@ def generate_unique_code():
     length = 4
     while True:
         code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
-        if not Room.objects.filter(code=code).exists():
+        if not Room.all_objects.filter(code=code).exists():
             return code
 
 
@@ -26,6 +28,13 @@ class SpotifyToken(models.Model):
         return f"Token for {self.user.username}"
 
 
+class OpenRoomManager(models.Manager):
+    """Только открытые комнаты: закрытые (is_active=False) ждут фонового удаления (jukebox/teardown.py)."""
+
+    def get_queryset(self):
+        return super().get_queryset().filter(is_active=True)
+
+
 class Room(models.Model):
     code = models.CharField(
         max_length=8,
@@ -44,6 +53,9 @@ class Room(models.Model):
 
     last_active = models.DateTimeField(auto_now=True)  # Обновляется при каждом save()
 
+    objects = OpenRoomManager()
+    all_objects = models.Manager()
+
     def is_host_online(self):
             # Даем хосту 15 секунд запаса (на случай лагов интернета)
         return (timezone.now() - self.last_active).total_seconds() < 180
@@ -52,6 +64,27 @@ class Room(models.Model):
         return f"Room {self.code} ({self.host.username})"
 
 
+class TrackMetadata(models.Model):
+    """Общий (для всех комнат) кэш метаданных трека Spotify."""
+    spotify_id = models.CharField(max_length=50, primary_key=True)
+    uri = models.CharField(max_length=100)
+    title = models.CharField(max_length=200)
+    artist = models.CharField(max_length=200)
+    album = models.CharField(max_length=200, blank=True)
+    image_url = models.URLField(null=True, blank=True)  # Большая обложка (плеер)
+    image_url_small = models.URLField(null=True, blank=True)  # Маленькая обложка (списки)
+    duration_ms = models.PositiveIntegerField(default=0)
+    explicit = models.BooleanField(default=False)
+    fetched_at = models.DateTimeField(default=timezone.now)
+
+    def is_fresh(self):
+        ttl = timedelta(seconds=settings.TRACK_METADATA_TTL)
+        return timezone.now() - self.fetched_at < ttl
+
+    def __str__(self):
+        return f"{self.artist} — {self.title}"
+
+
 class Track(models.Model):
     room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='tracks')
     added_by = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -61,6 +94,11 @@ class Track(models.Model):
     artist = models.CharField(max_length=150)
     spotify_uri = models.CharField(max_length=100)  # ID трека: spotify:track:xxxx
     album_cover_url = models.URLField(null=True, blank=True)  # <-- ВАЖНО: Картинка альбома!
+    metadata = models.ForeignKey(TrackMetadata, null=True, blank=True, on_delete=models.SET_NULL)
+    duration_ms = models.PositiveIntegerField(default=0)
+    # Префиксная сумма: суммарная длительность всех треков, добавленных в комнату раньше.
+    # Не меняется после вставки, поэтому ETA = остаток текущего трека + (offset - offset головы очереди)
+    queue_offset_ms = models.BigIntegerField(default=0)
 
     added_at = models.DateTimeField(auto_now_add=True)
 
@@ -75,4 +113,17 @@ class Vote(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
-        return f"{self.user} voted to skip {self.song_id}"
\ No newline at end of file
+        return f"{self.user} voted to skip {self.song_id}"
+
+class WorkerLease(models.Model):
+    """
+    Аренда фоновой работы воркером (jukebox/leases.py): комната для опроса,
+    периодическая задача и т.п. Пока expires_at не прошел, работу делает только owner;
+    упавший воркер перестает продлевать аренду, и ее забирает другой.
+    """
+    key = models.CharField(max_length=100, primary_key=True)
+    owner = models.CharField(max_length=100)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.key} -> {self.owner}"
@@ -0,0 +1,319 @@
+import time
+from django.conf import settings
+from django.core.cache import cache
+from .models import Room, Track
+from .spotify_util import track_id_from_uri, get_current_song, save_tracks_metadata, metadata_from_song
+from .spotify_util import NO_DEVICE_ERROR, NOT_AUTHENTICATED_ERROR, UPSTREAM_ERROR
+from .metrics import cache_hit, cache_miss
+from .background import submit_once
+from . import events, presence
+
+# Снимок состояния плеера комнаты (результат get_current_song + время получения).
+# Хранится в общем кэше, чтобы очередь и другие страницы не ходили в Spotify.
+SNAPSHOT_TTL = 60 * 60
+# Сколько секунд после команды показываем предсказанное состояние,
+# пока Spotify не успел отразить изменение у себя
+OPTIMISTIC_HOLD = 1.5
+
+# Хост без активного устройства / с отозванным токеном: повторяем запрос
+# не каждые 2 секунды, а с экспоненциальной паузой 5, 10, 20 ... 120 секунд
+IDLE_BACKOFF_BASE = 5
+IDLE_BACKOFF_MAX = 120
+
+# Расписание опроса Spotify (секунды). Следующий запрос к Spotify делается не
+# по таймеру, а когда состояние может измениться: к концу трека, вскоре после
+# команды; на паузе и в пустой комнате — реже.
+POLL_DEFAULT = 2
+POLL_MIN = 1
+POLL_AFTER_COMMAND = 2
+POLL_PAUSED = 10
+POLL_MAX_PLAYING = 15
+POLL_MAX_BUSY = 8  # Много гостей — внешние изменения (хост переключил с телефона) замечаем быстрее
+POLL_MAX_ALONE = 30  # Никто, кроме хоста, не слушает
+BUSY_LISTENERS = 5
+TRACK_END_LAG = 0.5  # Spotify переключает трек чуть позже расчетного конца
+RECENT_COMMAND_WINDOW = 10
+# Клиенту не даем пропасть дольше этого: голоса и очередь меняются и без Spotify
+CLIENT_POLL_MAX = 10
+
+
+def _snapshot_key(room_id):
+    return f"playback:{room_id}"
+
+
+def save_snapshot(room, song):
+    now = time.time()
+    snapshot = dict(song, fetched_at=now)
+    snapshot['next_fetch_at'] = now + fetch_delay(snapshot, presence.count(room.pk), recently_commanded(room), now)
+    cache.set(_snapshot_key(room.pk), snapshot, SNAPSHOT_TTL)
+    return snapshot
+
+
+def get_snapshot(room):
+    return cache.get(_snapshot_key(room.pk))
+
+
+def apply_optimistic(room, action):
+    """
+    Сразу после принятия команды обновляет снимок так, как он будет выглядеть
+    после нее. Все гости увидят это на ближайшем опросе, а настоящее состояние
+    подтянется из Spotify, когда истечет OPTIMISTIC_HOLD.
+
+    Возвращает прежний снимок (для отката при ошибке) или None, если менять нечего.
+    """
+    snapshot = get_snapshot(room)
+    if not snapshot or 'id' not in snapshot:
+        return None
+
+    now = time.time()
+    progress = progress_ms(snapshot, now)
+
+    if action in ('play', 'pause'):
+        predicted = dict(snapshot, time=progress, is_playing=(action == 'play'))
+    elif action == 'prev' and progress > 3000:
+        # Spotify по "previous" сначала перематывает текущий трек в начало
+        predicted = dict(snapshot, time=0)
+    elif action == 'skip':
+        # Следующим заиграет голова нашей очереди (если она есть)
+        head = Track.objects.filter(room=room).select_related('metadata').order_by('added_at').first()
+        if not head:
+            return None
+        predicted = {
+            'id': track_id_from_uri(head.spotify_uri),
+            'uri': head.spotify_uri,
+            'title': head.title,
+            'artist': head.artist,
+            'image_url': head.metadata.image_url if head.metadata else head.album_cover_url,
+            'duration': head.duration_ms,
+            'time': 0,
+            'is_playing': True,
+        }
+    else:
+        return None
+
+    predicted.update(fetched_at=now, optimistic=True, hold_until=now + OPTIMISTIC_HOLD)
+    cache.set(_snapshot_key(room.pk), predicted, SNAPSHOT_TTL)
+    return snapshot
+
+
+def restore_snapshot(room, snapshot):
+    """Откат предсказанного состояния, если Spotify команду не принял."""
+    cache.set(_snapshot_key(room.pk), snapshot, SNAPSHOT_TTL)
+
+
+def get_held_snapshot(room):
+    """Предсказанный после команды снимок, если он еще действует — иначе None."""
+    snapshot = get_snapshot(room)
+    if snapshot and snapshot.get('optimistic') and time.time() < snapshot['hold_until']:
+        return dict(snapshot, time=progress_ms(snapshot))
+    return None
+
+
+def get_scheduled_snapshot(room, grace=0):
+    """
+    Настоящий снимок Spotify, если по расписанию его еще рано обновлять — иначе None.
+    grace — сколько еще ждать обновления от фонового опросчика, прежде чем идти в Spotify самим.
+    """
+    snapshot = get_snapshot(room)
+    if snapshot and 'id' in snapshot and not snapshot.get('optimistic') \
+            and time.time() < snapshot.get('next_fetch_at', 0) + grace:
+        return dict(snapshot, time=progress_ms(snapshot), scheduled=True)
+    return None
+
+
+def is_due(snapshot, now=None):
+    """Пора ли снова спросить Spotify (нет снимка, истекло расписание или удержание после команды)."""
+    if not snapshot:
+        return True
+    now = time.time() if now is None else now
+    if snapshot.get('optimistic'):
+        return now >= snapshot['hold_until']
+    return now >= snapshot.get('next_fetch_at', 0)
+
+
+def get_stale_snapshot(room):
+    """Последний известный снимок (Spotify сейчас не отвечает) с пометкой stale."""
+    snapshot = get_snapshot(room)
+    if snapshot and 'id' in snapshot:
+        return dict(snapshot, time=progress_ms(snapshot), stale=True)
+    return None
+
+
+def refresh_snapshot(room_id):
+    """Фоновое обновление снимка с обычным (не горячим) таймаутом."""
+    room = Room.objects.select_related('host').filter(pk=room_id).first()
+    if not room:
+        return
+    song = get_current_song(room.host, timeout=settings.SPOTIFY_TIMEOUT)
+    if 'id' in song:
+        save_snapshot(room, song)
+        sync_live_song(room, song)
+        reset_idle(room.host)
+    elif song.get('error') in (NO_DEVICE_ERROR, NOT_AUTHENTICATED_ERROR):
+        note_idle(room.host, song['error'], get_idle_backoff(room.host))
+
+
+def read_playback(room, grace=0):
+    """
+    Состояние плеера комнаты для запроса пользователя.
+
+    Сразу после команды — предсказанное состояние, затем снимок, пока по расписанию
+    его рано обновлять. Хост без устройства / без авторизации не дергает Spotify до
+    конца паузы; если Spotify тормозит — последний известный снимок, обновление в фоне.
+    """
+    song_info = get_held_snapshot(room) or get_scheduled_snapshot(room, grace)
+    if song_info is not None:
+        cache_hit('playback')
+        return song_info
+
+    host = room.host
+    idle = get_idle_backoff(host)
+    if in_idle_backoff(idle):
+        cache_hit('idle-backoff')
+        return {'error': idle['reason'], 'next_fetch_at': idle['until']}
+
+    cache_miss('playback')
+    song_info = get_current_song(host)
+    if song_info and 'id' in song_info:
+        song_info = save_snapshot(room, song_info)
+        if idle:
+            reset_idle(host)
+    elif song_info.get('error') in (NO_DEVICE_ERROR, NOT_AUTHENTICATED_ERROR):
+        idle = note_idle(host, song_info['error'], idle)
+        song_info = dict(song_info, next_fetch_at=idle['until'])
+    elif song_info.get('error') == UPSTREAM_ERROR:
+        song_info = get_stale_snapshot(room) or song_info
+        submit_once(f"playback:{room.pk}", refresh_snapshot, room.pk)
+    return song_info
+
+
+def sync_live_song(room, song):
+    """
+    По свежим данным Spotify: запоминает смену трека (одна запись на смену)
+    и убирает из очереди трек, который уже заиграл.
+    """
+    if room.current_song != song['id']:
+        room.current_song = song['id']
+        room.save(update_fields=['current_song'])
+        save_tracks_metadata([metadata_from_song(song)])
+        events.publish(room.pk, 'room')
+
+    first_track = Track.objects.filter(room=room).order_by('added_at').first()
+    if first_track and track_id_from_uri(first_track.spotify_uri) == song['id']:
+        first_track.delete()
+        events.publish(room.pk, 'queue', 'delete')
+
+
+def _idle_key(host_id):
+    return f"idle:{host_id}"
+
+
+def get_idle_backoff(host):
+    """Состояние паузы хоста {'reason', 'level', 'until'} или None."""
+    return cache.get(_idle_key(host.pk))
+
+
+def in_idle_backoff(state):
+    return bool(state) and time.time() < state['until']
+
+
+def note_idle(host, reason, state=None):
+    """Spotify снова ответил 'нет устройства' / 'нет авторизации' — увеличиваем паузу."""
+    level = state['level'] + 1 if state and state['reason'] == reason else 1
+    delay = min(IDLE_BACKOFF_BASE * 2 ** (level - 1), IDLE_BACKOFF_MAX)
+    state = {'reason': reason, 'level': level, 'until': time.time() + delay}
+    # Храним дольше самой паузы, чтобы следующая неудача продолжила рост
+    cache.set(_idle_key(host.pk), state, IDLE_BACKOFF_MAX * 4)
+    return state
+
+
+def reset_idle(host):
+    """Хост что-то сделал (play, переподключил Spotify) — снова опрашиваем сразу."""
+    cache.delete(_idle_key(host.pk))
+
+
+def _command_key(room_id):
+    return f"recent-cmd:{room_id}"
+
+
+def note_command(room):
+    """Команда применена — ближайшие секунды сверяемся со Spotify чаще."""
+    cache.set(_command_key(room.pk), time.time(), RECENT_COMMAND_WINDOW)
+
+
+def recently_commanded(room):
+    return cache.get(_command_key(room.pk)) is not None
+
+
+def fetch_delay(snapshot, listeners=0, recent_command=False, now=None):
+    """Через сколько секунд снова спросить Spotify о плеере комнаты."""
+    if recent_command:
+        return POLL_AFTER_COMMAND
+    if listeners >= BUSY_LISTENERS:
+        cap = POLL_MAX_BUSY
+    elif listeners:
+        cap = POLL_MAX_PLAYING
+    else:
+        cap = POLL_MAX_ALONE
+
+    if not snapshot.get('is_playing'):
+        return min(POLL_PAUSED, cap)
+
+    # Трек вот-вот закончится — приходим сразу после конца, чтобы заметить смену
+    until_end = remaining_ms(snapshot, now) / 1000 + TRACK_END_LAG
+    return max(POLL_MIN, min(until_end, cap))
+
+
+def poll_after(deadline, recent_command=False, now=None):
+    """
+    Сколько секунд клиенту ждать до следующего опроса (заголовок X-Poll-After).
+
+    Пока в комнате идут команды, клиенты приходят не реже OPTIMISTIC_HOLD:
+    предсказанное состояние, записанное нажавшим, видят и остальные гости.
+    """
+    cap = OPTIMISTIC_HOLD if recent_command else CLIENT_POLL_MAX
+    if not deadline:
+        return min(POLL_DEFAULT, cap)
+    now = time.time() if now is None else now
+    return round(max(POLL_MIN, min(deadline - now, cap)), 1)
+
+
+def progress_ms(snapshot, now=None):
+    """Текущая позиция трека с поправкой на время, прошедшее с момента снимка."""
+    progress = snapshot.get('time') or 0
+    if snapshot.get('is_playing'):
+        now = time.time() if now is None else now
+        progress += int((now - snapshot['fetched_at']) * 1000)
+    return min(progress, snapshot.get('duration') or 0)
+
+
+def remaining_ms(snapshot, now=None):
+    return max((snapshot.get('duration') or 0) - progress_ms(snapshot, now), 0)
+
+
+def format_ms(ms):
+    seconds = int(ms // 1000)
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+
+def annotate_queue_etas(tracks, snapshot, now=None, head_offset=None):
+    """
+    Проставляет каждому треку очереди eta_ms / eta_display.
+
+    Треки должны идти в порядке очереди. Благодаря queue_offset_ms
+    расчет O(1) на строку и без запросов к Spotify.
+    Без снимка плеера (ничего не играет) ETA неизвестно.
+    head_offset — offset головы очереди, если tracks начинаются не с нее (дельта очереди).
+    """
+    tracks = list(tracks)
+    if not tracks or not snapshot or 'id' not in snapshot:
+        return tracks
+
+    remaining = remaining_ms(snapshot, now)
+    if head_offset is None:
+        head_offset = tracks[0].queue_offset_ms
+
+    for track in tracks:
+        track.eta_ms = remaining + (track.queue_offset_ms - head_offset)
+        track.eta_display = format_ms(track.eta_ms)
+    return tracks
@@ -0,0 +1,87 @@
+import math
+import threading
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from . import leases, tokens
+from .log import get_logger
+from .background import submit_once
+from .models import Room
+from .playback import get_snapshot, is_due, refresh_snapshot, get_idle_backoff, in_idle_backoff
+
+# Фоновый опрос плееров комнат, поделенный между воркерами кластера.
+# Каждая активная комната арендуется (WorkerLease "room:<id>") ровно одним воркером,
+# и только он ходит за ее состоянием в Spotify. Воркеры берут не больше
+# справедливой доли комнат (активных комнат / живых воркеров), поэтому новый узел
+# забирает часть работы, а комнаты упавшего воркера разбирают остальные,
+# когда истечет его аренда.
+# Здесь же, раз в TOKEN_REFRESH_INTERVAL, заранее обновляются токены хостов (tokens.py).
+
+WORKER_PREFIX = 'worker:'
+ROOM_PREFIX = 'room:'
+ACTIVE_WINDOW = 180  # Как Room.is_host_online
+
+logger = get_logger('poller')
+
+
+def _room_key(room_id):
+    return f"{ROOM_PREFIX}{room_id}"
+
+
+def tick(worker_id=leases.WORKER_ID):
+    """
+    Один проход опросчика: отметиться живым, пересчитать свои комнаты,
+    запустить обновление тех, которым пора. Возвращает id своих комнат.
+    """
+    ttl = settings.ROOM_LEASE_TTL
+    leases.acquire(f"{WORKER_PREFIX}{worker_id}", ttl, owner=worker_id)
+
+    since = timezone.now() - timedelta(seconds=ACTIVE_WINDOW)
+    rooms = {room.pk: room for room in Room.objects.filter(last_active__gte=since).select_related('host')}
+    if not rooms:
+        return []
+
+    holders = leases.holders(_room_key(room_id) for room_id in rooms)
+    workers = max(leases.live_owners(WORKER_PREFIX), 1)
+    share = math.ceil(len(rooms) / workers)
+
+    mine = [room_id for room_id in rooms if holders.get(_room_key(room_id)) == worker_id]
+    # Узлов стало больше — отдаем лишнее, его подберут новые воркеры
+    if len(mine) > share:
+        leases.release([_room_key(room_id) for room_id in mine[share:]], owner=worker_id)
+        mine = mine[:share]
+    leases.renew([_room_key(room_id) for room_id in mine], ttl, owner=worker_id)
+
+    for room_id in rooms:
+        if len(mine) >= share:
+            break
+        if _room_key(room_id) not in holders and leases.acquire(_room_key(room_id), ttl, owner=worker_id):
+            mine.append(room_id)
+
+    now = time.time()
+    for room_id in mine:
+        room = rooms[room_id]
+        if is_due(get_snapshot(room), now) and not in_idle_backoff(get_idle_backoff(room.host)):
+            submit_once(f"playback:{room_id}", refresh_snapshot, room_id)
+    return mine
+
+
+def run_forever(stop_event=None):
+    stop_event = stop_event or threading.Event()
+    try:
+        while not stop_event.is_set():
+            try:
+                tick()
+                tokens.tick()
+            except Exception:
+                # Опросчик не должен умирать из-за одной ошибки БД/кэша
+                logger.exception("Room poller tick failed", extra={'worker': leases.WORKER_ID})
+            finally:
+                close_old_connections()
+            stop_event.wait(settings.ROOM_POLLER_TICK)
+    finally:
+        # Штатная остановка: комнаты сразу достаются другим, не дожидаясь истечения аренды
+        leases.release_all()
+
@@ -0,0 +1,86 @@
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+
+# Кто сейчас в комнате: сессии, которые недавно опрашивали плеер.
+# Реестр живет в общем кэше (Redis/LocMem), без записей в БД: на комнату —
+# словарь {session_key: время последнего опроса}, записи старше PRESENCE_TTL не считаются.
+#
+# Чтобы опрос раз в пару секунд не превращался в запись в кэш, каждая сессия
+# переписывает свою отметку не чаще раза в PRESENCE_REFRESH секунд (счетчик на процесс).
+# Одновременные записи двух сессий могут затереть друг друга — это лечится
+# следующим обновлением, которое наступает раньше, чем истекает TTL.
+
+PRESENCE_TTL = 30
+PRESENCE_REFRESH = 10
+
+_lock = threading.Lock()
+_written = {}  # (room_id, session_key) -> когда этот процесс последний раз писал отметку
+
+
+def _key(room_id):
+    return f"presence:{room_id}"
+
+
+def _alive(members, now):
+    return {session: seen for session, seen in members.items() if now - seen < PRESENCE_TTL}
+
+
+def touch(room_id, session_key):
+    """Отмечает, что сессия в комнате. Возвращает True, если отметка реально записана."""
+    if not session_key:
+        return False
+    now = time.time()
+    with _lock:
+        if now - _written.get((room_id, session_key), 0) < PRESENCE_REFRESH:
+            return False
+        _written[(room_id, session_key)] = now
+        if len(_written) > 10000:
+            # Не даем словарю расти бесконечно: забываем все, кто давно не писал
+            for item, written in list(_written.items()):
+                if now - written >= PRESENCE_TTL:
+                    del _written[item]
+
+    members = _alive(cache.get(_key(room_id)) or {}, now)
+    members[session_key] = now
+    cache.set(_key(room_id), members, PRESENCE_TTL)
+    return True
+
+
+def leave(room_id, session_key):
+    """Сессия ушла из комнаты (вышла, перешла в другую)."""
+    with _lock:
+        _written.pop((room_id, session_key), None)
+    members = cache.get(_key(room_id)) or {}
+    if members.pop(session_key, None) is not None:
+        cache.set(_key(room_id), members, PRESENCE_TTL)
+
+
+def members(room_id):
+    return set(_alive(cache.get(_key(room_id)) or {}, time.time()))
+
+
+def count(room_id):
+    """Число активных сессий в комнате."""
+    return len(members(room_id))
+
+
+def counts(room_ids):
+    """{room_id: число активных сессий} одним запросом к кэшу."""
+    now = time.time()
+    found = cache.get_many([_key(room_id) for room_id in room_ids])
+    return {room_id: len(_alive(found.get(_key(room_id)) or {}, now)) for room_id in room_ids}
+
+
+def is_present(room_id, session_key):
+    return session_key in members(room_id)
+
+
+def is_full(room_id, session_key=None):
+    """Лимит ROOM_MAX_LISTENERS исчерпан (уже вошедшие сессии не выгоняем)."""
+    limit = getattr(settings, 'ROOM_MAX_LISTENERS', None)
+    if not limit:
+        return False
+    present = members(room_id)
+    return session_key not in present and len(present) >= limit
@@ -2,70 +2,115 @@ import requests
 from django.utils import timezone
 from datetime import timedelta
 from django.conf import settings
-from .models import SpotifyToken
+from django.core.cache import cache
+from django.contrib.auth.models import User
+from .models import SpotifyToken, TrackMetadata
+from .metrics import observe_spotify, cache_hit, cache_miss
+from . import timing
+from .log import get_logger
+from .background import submit_once
+import hashlib
 import json
+import re
+import time
 import base64  # <--- Добавил этот импорт, он нужен для обновления токена
 
-# Базовые URL Spotify
-BASE_URL = "https://api.spotify.com/v1/"
-TOKEN_URL = "https://accounts.spotify.com/api/token"
+# Максимум id за один запрос GET /tracks?ids=
+TRACKS_BATCH_SIZE = 50
+# В очередь добавляются только треки
+TRACK_URI_RE = re.compile(r'^spotify:track:[0-9A-Za-z]+$')
+
+logger = get_logger('spotify')
+
+# Spotify не ответил вовремя / ответил 429 или 5xx — можно показать последний известный результат
+UPSTREAM_ERROR = 'Upstream unavailable'
+# Хост не слушает музыку (Spotify закрыт) или его токен отозван —
+# такие ответы не изменятся от повторного запроса через 2 секунды
+NO_DEVICE_ERROR = 'No Active Device'
+NOT_AUTHENTICATED_ERROR = 'User not authenticated'
+
+
+def _send(method, url, endpoint, user=None, **kwargs):
+    """HTTP-запрос к Spotify с записью метрик (время, код ответа, 429)."""
+    started = time.perf_counter()
+    status_code = 'error'
+    try:
+        response = requests.request(method, url, **kwargs)
+        status_code = response.status_code
+        return response
+    finally:
+        elapsed = time.perf_counter() - started
+        timing.add('spotify', elapsed)
+        observe_spotify(endpoint, status_code, elapsed, user)
+
+
+def _endpoint_label(endpoint):
+    """me/player/currently-playing?x=1 -> currently-playing (метка для метрик)."""
+    return endpoint.split('?')[0].rstrip('/').split('/')[-1]
 
 
 def get_user_tokens(host_user):
-    """Вспомогательная функция для получения токена по пользователю."""
-    user_tokens = SpotifyToken.objects.filter(user=host_user)
-    if user_tokens.exists():
-        return user_tokens[0]
-    return None
+    """Вспомогательная функция для получения токена по пользователю (один запрос к БД)."""
+    return SpotifyToken.objects.filter(user=host_user).first()
+
+
+def request_token_refresh(refresh_token, timeout=None):
+    """
+    Обмен refresh_token на новый access token (только сеть, без БД).
+    Возвращает ответ Spotify или None при сетевой ошибке.
+    """
+    auth_string = f"{settings.SPOTIPY_CLIENT_ID}:{settings.SPOTIPY_CLIENT_SECRET}"
+    auth_base64 = base64.b64encode(auth_string.encode('utf-8')).decode('utf-8')
+
+    headers = {
+        'Content-Type': 'application/x-www-form-urlencoded',
+        'Authorization': 'Basic ' + auth_base64
+    }
+    data = {
+        'grant_type': 'refresh_token',
+        'refresh_token': refresh_token
+    }
+
+    try:
+        # URL читаем при каждом вызове: нагрузочный тест подменяет его через override_settings
+        return _send('POST', settings.SPOTIFY_TOKEN_URL, 'token-refresh', data=data, headers=headers,
+                     timeout=timeout or settings.SPOTIFY_TIMEOUT).json()
+    except (requests.RequestException, ValueError):
+        return None
+
+
+def apply_token_refresh(user_tokens, response):
+    """Переносит ответ Spotify в объект токена (без сохранения). True — токен обновлен."""
+    access_token = (response or {}).get('access_token')
+    if not access_token:
+        return False
+    user_tokens.access_token = access_token
+    # Пересчитываем абсолютное время истечения
+    user_tokens.expires_in = timezone.now() + timedelta(seconds=response.get('expires_in', 3600))
+    # Spotify иногда выдает и новый refresh_token — старый тогда перестает работать
+    user_tokens.refresh_token = response.get('refresh_token') or user_tokens.refresh_token
+    user_tokens.token_type = response.get('token_type') or user_tokens.token_type
+    return True
 
 
 def refresh_spotify_token(user_tokens):
     """
-    Проверяет срок действия токена и обновляет его, если он истек.
-    ИСПРАВЛЕНО: Теперь использует правильную авторизацию через заголовки.
+    Обновляет токен, если он истек. Обычно до этого не доходит: токены хостов
+    активных комнат заранее обновляет фоновый tokens.refresh_due. Здесь же запрос
+    пользователя ждет Spotify, поэтому таймаут — как у горячего пути.
     """
-    # Проверяем, истек ли токен (или истекает вот-вот)
-    if user_tokens.expires_in <= timezone.now():
-
-        # 1. Подготовка Basic Auth (Client ID и Secret)
-        auth_string = f"{settings.SPOTIPY_CLIENT_ID}:{settings.SPOTIPY_CLIENT_SECRET}"
-        auth_base64 = base64.b64encode(auth_string.encode('utf-8')).decode('utf-8')
-
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded',
-            'Authorization': 'Basic ' + auth_base64
-        }
-
-        # 2. Тело запроса
-        data = {
-            'grant_type': 'refresh_token',
-            'refresh_token': user_tokens.refresh_token
-        }
-
-        try:
-            response = requests.post(TOKEN_URL, data=data, headers=headers).json()
-        except:
-            return  # Если ошибка сети, выходим
-
-        # Получаем новые данные
-        access_token = response.get('access_token')
-        expires_in = response.get('expires_in')  # Обычно 3600 секунд
-        token_type = response.get('token_type')
-
-        # Обновляем запись в БД
-        if access_token:
-            user_tokens.access_token = access_token
-            # Пересчитываем абсолютное время истечения
-            user_tokens.expires_in = timezone.now() + timedelta(seconds=expires_in)
-            if token_type:
-                user_tokens.token_type = token_type
-            user_tokens.save(update_fields=['access_token', 'expires_in', 'token_type'])
-
-
-def execute_spotify_api_request(host_user, endpoint, post_=False, put_=False, data=None):
+    if user_tokens.expires_in > timezone.now():
+        return
+
+    response = request_token_refresh(user_tokens.refresh_token, timeout=settings.SPOTIFY_HOT_TIMEOUT)
+    if apply_token_refresh(user_tokens, response):
+        user_tokens.save(update_fields=['access_token', 'refresh_token', 'expires_in', 'token_type'])
+
+
+def execute_spotify_api_request(host_user, endpoint, post_=False, put_=False, data=None, timeout=None):
     tokens = get_user_tokens(host_user)
     if not tokens:
-        return {'error': 'User not authenticated'}
+        return {'error': NOT_AUTHENTICATED_ERROR}
 
     refresh_spotify_token(tokens)
 
@@ -75,34 +120,56 @@ def execute_spotify_api_request(host_user, endpoint, post_=False, put_=False, da
     }
 
     # ИСПРАВЛЕНО: Добавлен слэш между базовым URL и эндпоинтом
-    url = f"https://api.spotify.com/v1/{endpoint}"
+    url = f"{settings.SPOTIFY_API_URL}{endpoint}"
+
+    method = 'POST' if post_ else 'PUT' if put_ else 'GET'
 
     try:
-        if post_:
-            response = requests.post(url, headers=headers, json=data)
-        elif put_:
-            response = requests.put(url, headers=headers, json=data)
-        else:
-            response = requests.get(url, headers=headers)
+        response = _send(method, url, _endpoint_label(endpoint), host_user,
+                         headers=headers, json=data if method != 'GET' else None,
+                         timeout=timeout or settings.SPOTIFY_TIMEOUT)
 
         if response.status_code == 204:
             return {'no_content': True}
 
         # Если Spotify вернул ошибку (например 403 или 404)
         if not response.ok:
-            return {'error': response.text}
+            # Тело ответа целиком не пишем: короткого сообщения достаточно, а повторы режет RateLimitFilter
+            logger.warning("Spotify %s returned %s: %s", _endpoint_label(endpoint), response.status_code,
+                           response.text[:200], extra={'host': host_user.username})
+            return {
+                'error': response.text,
+                'status_code': response.status_code,
+                # 429 и 5xx — временные проблемы Spotify, а не "ничего не играет"
+                'upstream_failed': response.status_code == 429 or response.status_code >= 500,
+            }
 
         return response.json()
+    except requests.RequestException as e:
+        # Таймаут или сетевая ошибка
+        logger.warning("Spotify %s failed: %s", _endpoint_label(endpoint), type(e).__name__,
+                       extra={'host': host_user.username})
+        return {'error': str(e), 'upstream_failed': True}
     except Exception as e:
         return {'error': str(e)}
 
-def get_current_song(user):
+def get_current_song(user, timeout=None):
+    """
+    Текущий трек хоста. По умолчанию со строгим таймаутом горячего пути:
+    если Spotify не успел ответить, возвращается {'error': UPSTREAM_ERROR}.
+    """
     endpoint = "me/player/currently-playing"  # ИСПРАВЛЕНО: me/player/...
-    response = execute_spotify_api_request(user, endpoint)
+    response = execute_spotify_api_request(user, endpoint, timeout=timeout or settings.SPOTIFY_HOT_TIMEOUT)
+
+    if response.get('upstream_failed'):
+        return {'error': UPSTREAM_ERROR}
 
-    # Если в ответе ошибка или нет данных о треке
+    if response.get('error') == NOT_AUTHENTICATED_ERROR or response.get('status_code') == 401:
+        return {'error': NOT_AUTHENTICATED_ERROR}
+
+    # Если в ответе ошибка или нет данных о треке (204 — нет активного устройства)
     if 'error' in response or 'item' not in response or response.get('no_content'):
-        return {}
+        return {'error': NO_DEVICE_ERROR}
 
     item = response.get('item')
     # Проверка на None для item (бывает при переключении треков)
@@ -125,60 +192,227 @@ def get_current_song(user):
         'image_url': album_cover,
         'is_playing': is_playing,
         'votes': 0,
-        'id': song_id
+        'id': song_id,
+        # Поля для кэша метаданных (см. metadata_from_song)
+        'uri': item.get('uri'),
+        'album': item.get('album', {}).get('name', ''),
+        'image_url_small': _album_image(item, smallest=True),
+        'explicit': item.get('explicit', False),
     }
 
-def pause_song(host_user):
-    return execute_spotify_api_request(host_user, "me/player/pause", put_=True)
+def _on_device(endpoint, device_id):
+    """Команда конкретному устройству; без device_id Spotify берет активное."""
+    if not device_id:
+        return endpoint
+    return f"{endpoint}{'&' if '?' in endpoint else '?'}device_id={device_id}"
+
+
+def pause_song(host_user, device_id=None):
+    return execute_spotify_api_request(host_user, _on_device("me/player/pause", device_id), put_=True)
+
+
+def play_song(host_user, device_id=None):
+    return execute_spotify_api_request(host_user, _on_device("me/player/play", device_id), put_=True)
+
+
+def skip_song(host_user, device_id=None):
+    return execute_spotify_api_request(host_user, _on_device("me/player/next", device_id), post_=True)
 
 
-def play_song(host_user):
-    return execute_spotify_api_request(host_user, "me/player/play", put_=True)
+def get_devices(host_user):
+    """Устройства Spotify Connect хоста; None — Spotify не ответил."""
+    response = execute_spotify_api_request(host_user, "me/player/devices")
+    if response.get('error'):
+        return None
+    return response.get('devices') or []
 
 
-def skip_song(host_user):
-    return execute_spotify_api_request(host_user, "me/player/next", post_=True)
+def transfer_playback(host_user, device_id, play=False):
+    """Переносит воспроизведение на устройство (и включает его, если play)."""
+    return execute_spotify_api_request(host_user, "me/player", put_=True,
+                                       data={'device_ids': [device_id], 'play': play})
 
 
 # --- НОВЫЕ ФУНКЦИИ (которых не хватало для views.py) ---
 
-def search_spotify(host_user, query):
-    """Ищет треки в Spotify."""
+def search_spotify(host_user, query, timeout=None):
+    """
+    Ищет треки в Spotify. Возвращает (список TrackMetadata, stale).
+
+    Результат (список id) кэшируется по тексту запроса, а сами треки
+    берутся из общей таблицы TrackMetadata. Если Spotify не ответил
+    за таймаут горячего пути, отдаем последний удачный результат
+    (stale=True) и обновляем его в фоне.
+    """
+    cache_key = _search_cache_key(query)
+    cached = cache.get(cache_key)
+
+    if cached and time.time() - cached['at'] < settings.SEARCH_CACHE_TTL:
+        cache_hit('search')
+        return _tracks_by_ids(cached['ids']), False
+
+    cache_miss('search')
+    track_ids = _fetch_search(host_user, query, timeout or settings.SPOTIFY_HOT_TIMEOUT)
+
+    if track_ids is None:
+        if not cached:
+            return [], False
+        cache_hit('search-stale')
+        submit_once(f"search:{cache_key}", _refresh_search, host_user.pk, query)
+        return _tracks_by_ids(cached['ids']), True
+
+    return _tracks_by_ids(track_ids), False
+
+
+def _fetch_search(host_user, query, timeout=None):
+    """Запрос к Spotify + сохранение в кэш. None — Spotify недоступен."""
     # Кодируем пробелы для URL
     formatted_query = requests.utils.quote(query)
     endpoint = f"search?q={formatted_query}&type=track&limit=5"
 
-    response = execute_spotify_api_request(host_user, endpoint)
+    response = execute_spotify_api_request(host_user, endpoint, timeout=timeout)
 
+    if response.get('upstream_failed'):
+        return None
     if 'tracks' not in response:
         return []
 
-    tracks = response['tracks']['items']
-    results = []
+    items = [item for item in response['tracks']['items'] if item]
+    save_tracks_metadata([metadata_from_item(item) for item in items])
+
+    track_ids = [item['id'] for item in items]
+    cache.set(_search_cache_key(query), {'ids': track_ids, 'at': time.time()}, settings.SEARCH_STALE_TTL)
+    return track_ids
+
+
+def _refresh_search(host_id, query):
+    host_user = User.objects.filter(pk=host_id).first()
+    if host_user:
+        _fetch_search(host_user, query)
+
+
+def _tracks_by_ids(track_ids):
+    found = TrackMetadata.objects.in_bulk(track_ids)
+    return [found[track_id] for track_id in track_ids if track_id in found]
+
+
+def _search_cache_key(query):
+    normalized = ' '.join(query.lower().split())
+    return 'search:' + hashlib.md5(normalized.encode('utf-8')).hexdigest()
 
-    for track in tracks:
-        # Собираем артистов
-        artist_names = ", ".join([artist['name'] for artist in track['artists']])
 
-        results.append({
-            'title': track['name'],
-            'artist': artist_names,
-            'image_url': track['album']['images'][-1]['url'] if track['album']['images'] else '',
-            'uri': track['uri'],  # URI нужен для добавления в очередь
-            'id': track['id']
-        })
+# --- КЭШ МЕТАДАННЫХ ТРЕКОВ ---
 
-    return results
+def track_id_from_uri(uri):
+    """spotify:track:xxxx -> xxxx"""
+    return uri.split(':')[-1] if uri else None
 
 
-def add_to_queue(host_user, uri):
+def is_track_uri(uri):
+    """Только spotify:track:<base62>: эпизоды, альбомы и ссылки в очередь не попадают."""
+    return bool(TRACK_URI_RE.match(uri or ''))
+
+
+def _album_image(item, smallest=False):
+    images = item.get('album', {}).get('images') or []
+    if not images:
+        return ''
+    # Spotify отдает обложки от большой к маленькой
+    return images[-1 if smallest else 0].get('url', '')
+
+
+def metadata_from_item(item):
+    """Объект трека из Spotify API -> несохраненный TrackMetadata."""
+    return TrackMetadata(
+        spotify_id=item['id'],
+        uri=item.get('uri') or f"spotify:track:{item['id']}",
+        title=(item.get('name') or '')[:200],
+        artist=", ".join([artist.get('name') for artist in item.get('artists', [])])[:200],
+        album=(item.get('album', {}).get('name') or '')[:200],
+        image_url=_album_image(item),
+        image_url_small=_album_image(item, smallest=True),
+        duration_ms=item.get('duration_ms') or 0,
+        explicit=bool(item.get('explicit')),
+        fetched_at=timezone.now(),
+    )
+
+
+def metadata_from_song(song):
+    """Результат get_current_song -> несохраненный TrackMetadata."""
+    return TrackMetadata(
+        spotify_id=song['id'],
+        uri=song.get('uri') or f"spotify:track:{song['id']}",
+        title=(song.get('title') or '')[:200],
+        artist=(song.get('artist') or '')[:200],
+        album=(song.get('album') or '')[:200],
+        image_url=song.get('image_url') or '',
+        image_url_small=song.get('image_url_small') or '',
+        duration_ms=song.get('duration') or 0,
+        explicit=bool(song.get('explicit')),
+        fetched_at=timezone.now(),
+    )
+
+
+def save_tracks_metadata(tracks):
+    """Upsert списка TrackMetadata одним запросом. Возвращает {id: TrackMetadata}."""
+    tracks = list({track.spotify_id: track for track in tracks}.values())
+    if tracks:
+        TrackMetadata.objects.bulk_create(
+            tracks,
+            update_conflicts=True,
+            unique_fields=['spotify_id'],
+            update_fields=['uri', 'title', 'artist', 'album', 'image_url',
+                           'image_url_small', 'duration_ms', 'explicit', 'fetched_at'],
+        )
+    return {track.spotify_id: track for track in tracks}
+
+
+def get_tracks_metadata(host_user, track_ids, unknown=None):
+    """
+    Возвращает {id: TrackMetadata} для списка id.
+
+    Свежие записи берутся из БД, недостающие и устаревшие догружаются
+    пачками по 50 через GET /tracks?ids=. Если Spotify недоступен,
+    устаревшая запись лучше, чем никакая — она остается в результате.
+    В список unknown (если передан) попадают id, которых в Spotify нет:
+    так вызывающий отличает неверный трек от сбоя Spotify.
+    """
+    track_ids = list(dict.fromkeys(track_id for track_id in track_ids if track_id))
+    if not track_ids:
+        return {}
+
+    known = TrackMetadata.objects.in_bulk(track_ids)
+    missing = [track_id for track_id in track_ids
+               if track_id not in known or not known[track_id].is_fresh()]
+    if len(track_ids) > len(missing):
+        cache_hit('metadata', len(track_ids) - len(missing))
+    if missing:
+        cache_miss('metadata', len(missing))
+
+    for start in range(0, len(missing), TRACKS_BATCH_SIZE):
+        batch = missing[start:start + TRACKS_BATCH_SIZE]
+        response = execute_spotify_api_request(host_user, f"tracks?ids={','.join(batch)}")
+        if unknown is not None:
+            if 'tracks' in response:
+                # Для неизвестных id Spotify возвращает null
+                unknown.extend(track_id for track_id, item in zip(batch, response['tracks']) if not item)
+            elif response.get('status_code') == 400:
+                # Некорректный id Spotify отклоняет целиком всю пачку
+                unknown.extend(batch)
+        items = [item for item in response.get('tracks') or [] if item]
+        known.update(save_tracks_metadata([metadata_from_item(item) for item in items]))
+
+    return known
+
+
+def add_to_queue(host_user, uri, device_id=None):
     """Добавляет трек в очередь воспроизведения."""
     endpoint = f"me/player/queue?uri={uri}"
-    execute_spotify_api_request(host_user, endpoint, post_=True)
+    return execute_spotify_api_request(host_user, _on_device(endpoint, device_id), post_=True)
 
-def prev_song(host_user):
+def prev_song(host_user, device_id=None):
     # Конечная точка me/player/previous переключает на прошлый трек
-    return execute_spotify_api_request(host_user, "me/player/previous", post_=True)
+    return execute_spotify_api_request(host_user, _on_device("me/player/previous", device_id), post_=True)
 
 # Добавь это в конец твоего файла с утилитами
 def is_spotify_authenticated(user):
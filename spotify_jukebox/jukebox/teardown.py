@@ -0,0 +1,58 @@
+from django.db import transaction
+from . import events
+from .background import submit_once
+from .log import get_logger
+from .models import Room, Track, Vote
+
+# Закрытие комнат без долгого запроса.
+# Запрос только помечает комнату закрытой (один UPDATE) — с этого момента ее не видит
+# ни один поиск Room.objects. Очередь и голоса удаляются в фоне пачками по pk: на Track и Vote
+# нет ни ссылок, ни сигналов, поэтому QuerySet.delete() — один DELETE без загрузки строк.
+# Событие об удалении (events.py) уходит одно — когда удаляется сама комната.
+
+CHUNK_SIZE = 1000
+
+logger = get_logger('rooms')
+
+
+def close_rooms(rooms):
+    """Закрывает комнаты из queryset и запускает их фоновое удаление. Возвращает id."""
+    room_ids = list(rooms.values_list('pk', flat=True))
+    if room_ids:
+        Room.objects.filter(pk__in=room_ids).update(is_active=False)
+        transaction.on_commit(lambda: submit_once('teardown', purge_closed))
+    return room_ids
+
+
+def _purge_rows(model, room_id):
+    while True:
+        ids = list(model.objects.filter(room_id=room_id).values_list('pk', flat=True)[:CHUNK_SIZE])
+        if not ids:
+            return
+        model.objects.filter(pk__in=ids).delete()
+
+
+def purge_room(room_id):
+    for model in (Vote, Track):
+        _purge_rows(model, room_id)
+    # Зависимых строк уже нет — сборщику нечего загружать
+    deleted, _ = Room.all_objects.filter(pk=room_id, is_active=False).delete()
+    if deleted:
+        events.publish(room_id, 'room', 'delete')
+
+
+def purge_closed():
+    """
+    Удаляет все закрытые комнаты, в том числе оставшиеся от упавшего воркера.
+    Комната, которую удалить не удалось, пропускается до следующего запуска — остальные удаляются.
+    """
+    failed = set()
+    while True:
+        room_id = Room.all_objects.filter(is_active=False).exclude(pk__in=failed).values_list('pk', flat=True).first()
+        if room_id is None:
+            return failed
+        try:
+            purge_room(room_id)
+        except Exception:
+            logger.exception("Room teardown failed", extra={'room_id': room_id})
+            failed.add(room_id)
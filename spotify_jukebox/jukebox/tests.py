@@ -1,8 +1,36 @@
 from django.test import TestCase
 import pytest
+import time
 from django.contrib.auth.models import User
 from django.urls import reverse
-from .models import Room
+from django.core.cache import cache
+from django.utils import timezone
+from datetime import timedelta
+from .models import Room, Track, TrackMetadata, SpotifyToken
+from . import spotify_util
+from .playback import annotate_queue_etas, save_snapshot, get_snapshot, restore_snapshot
+from . import playback
+from . import presence
+from . import typeahead
+from . import votes
+from . import commands
+from . import views
+
+
+@pytest.fixture(autouse=True)
+def clear_cache(settings):
+    """Кэш (LocMem) живет весь процесс — чистим его между тестами."""
+    # Как в продакшене с Redis: кэш считаем общим для воркеров
+    settings.VOTES_IN_CACHE = True
+    cache.clear()
+    presence._written.clear()
+    typeahead.reset()
+    votes._pending.clear()
+    yield
+    cache.clear()
+    if votes._timer is not None:
+        votes._timer.cancel()
+        votes._timer = None
 
 
 # --- ТЕСТЫ МОДЕЛЕЙ (База Данных) ---
@@ -111,4 +139,1170 @@ def test_join_room_view_failure(client):
     # В контенте страницы должна быть ошибка
     assert "Комната не найдена" in response.content.decode('utf-8')
 
+
+# --- КЭШ МЕТАДАННЫХ ТРЕКОВ ---
+
+def fake_spotify_track(track_id, duration_ms=200000):
+    """Минимальный объект трека в формате Spotify API."""
+    return {
+        'id': track_id,
+        'uri': f'spotify:track:{track_id}',
+        'name': f'Song {track_id}',
+        'artists': [{'name': 'Artist'}],
+        'album': {'name': 'Album', 'images': [{'url': 'https://img/big'}, {'url': 'https://img/small'}]},
+        'duration_ms': duration_ms,
+        'explicit': False,
+    }
+
+
+@pytest.mark.django_db
+def test_tracks_metadata_fetched_in_batches(monkeypatch):
+    """
+    Недостающие треки догружаются пачками по 50 id,
+    а уже сохраненные повторно не запрашиваются.
+    """
+    endpoints = []
+
+    def fake_request(host_user, endpoint, **kwargs):
+        endpoints.append(endpoint)
+        ids = endpoint.split('ids=')[1].split(',')
+        return {'tracks': [fake_spotify_track(track_id) for track_id in ids]}
+
+    monkeypatch.setattr(spotify_util, 'execute_spotify_api_request', fake_request)
+    host = User.objects.create_user(username='host')
+
+    ids = [f'id{i}' for i in range(120)]
+    result = spotify_util.get_tracks_metadata(host, ids)
+
+    assert len(result) == 120
+    assert len(endpoints) == 3  # 50 + 50 + 20
+    assert TrackMetadata.objects.count() == 120
+
+    spotify_util.get_tracks_metadata(host, ids[:10])
+    assert len(endpoints) == 3  # Все из кэша
+
+
+@pytest.mark.django_db
+def test_add_to_queue_uses_cached_metadata(client, monkeypatch):
+    """
+    AddToQueue берет название и обложку из кэша метаданных,
+    игнорируя то, что прислал клиент.
+    """
+    monkeypatch.setattr(spotify_util, 'execute_spotify_api_request', lambda *args, **kwargs: {})
+    host = User.objects.create_user(username='host')
+    room = Room.objects.create(host=host, code='META')
+    spotify_util.save_tracks_metadata([spotify_util.metadata_from_item(fake_spotify_track('abc'))])
+
+    client.force_login(host)
+    session = client.session
+    session['room_code'] = room.code
+    session.save()
+
+    response = client.post('/api/add-to-queue/', {'uri': 'spotify:track:abc', 'title': 'Fake title'})
+
+    assert response.status_code == 204
+    track = Track.objects.get(room=room)
+    assert track.title == 'Song abc'
+    assert track.album_cover_url == 'https://img/small'
+    assert track.metadata_id == 'abc'
+
+    # Неизвестный трек при недоступном Spotify не добавляется с данными от клиента
+    response = client.post('/api/add-to-queue/', {'uri': 'spotify:track:nope', 'title': 'Fake title'})
+    assert response.status_code == 503
+    assert Track.objects.filter(room=room).count() == 1
+
+    # Spotify ответил null — трека нет, это ошибка клиента, а не сбой
+    monkeypatch.setattr(spotify_util, 'execute_spotify_api_request', lambda *args, **kwargs: {'tracks': [None]})
+    response = client.post('/api/add-to-queue/', {'uri': 'spotify:track:nope'})
+    assert response.status_code == 404
+
+    response = client.post('/api/add-to-queue/', {'uri': 'spotify:episode:abc'})
+    assert response.status_code == 400
+    assert Track.objects.filter(room=room).count() == 1
+
+
+def test_queue_eta_from_prefix_sums():
+    """
+    ETA трека = остаток текущей песни + разница префиксных сумм
+    с головой очереди (голова уже могла быть удалена из начала).
+    """
+    tracks = [
+        Track(queue_offset_ms=300000, duration_ms=120000),
+        Track(queue_offset_ms=420000, duration_ms=60000),
+        Track(queue_offset_ms=480000, duration_ms=90000),
+    ]
+    snapshot = {'id': 'now', 'duration': 200000, 'time': 150000, 'is_playing': True, 'fetched_at': 1000.0}
+
+    # Через 10 секунд после снимка до конца текущего трека 40 секунд
+    annotate_queue_etas(tracks, snapshot, now=1010.0)
+
+    assert [track.eta_ms for track in tracks] == [40000, 160000, 220000]
+    assert tracks[1].eta_display == '2:40'
+
+
+# --- КАНАЛ КОМАНД ПЛЕЕРА ---
+
+def test_fetch_delay_follows_track_position():
+    """Spotify опрашивается к концу трека и после команд, на паузе и в пустой комнате — реже."""
+    now = 1000.0
+    playing = {'id': 'a', 'duration': 200000, 'time': 195000, 'is_playing': True, 'fetched_at': now}
+
+    assert playback.fetch_delay(playing, listeners=1, now=now) == 5 + playback.TRACK_END_LAG
+    assert playback.fetch_delay(dict(playing, time=0), listeners=1, now=now) == playback.POLL_MAX_PLAYING
+    assert playback.fetch_delay(dict(playing, time=0), listeners=0, now=now) == playback.POLL_MAX_ALONE
+    assert playback.fetch_delay(dict(playing, time=0), listeners=20, now=now) == playback.POLL_MAX_BUSY
+    assert playback.fetch_delay(dict(playing, is_playing=False), listeners=1, now=now) == playback.POLL_PAUSED
+    assert playback.fetch_delay(dict(playing, time=0), recent_command=True, now=now) == playback.POLL_AFTER_COMMAND
+    assert playback.poll_after(now + 60, now=now) == playback.CLIENT_POLL_MAX
+    # После команды остальные клиенты подтягивают предсказанное состояние быстро
+    assert playback.poll_after(now + 60, recent_command=True, now=now) == playback.OPTIMISTIC_HOLD
+
+
+def host_client(client, room):
+    """Логинит хоста комнаты и кладет код комнаты в сессию."""
+    client.force_login(room.host)
+    session = client.session
+    session['room_code'] = room.code
+    session.save()
+    return client
+
+
+@pytest.mark.django_db
+def test_double_skip_is_coalesced(client, monkeypatch):
+    """Два быстрых нажатия Skip — один запрос к Spotify."""
+    calls = []
+    monkeypatch.setitem(commands.ACTIONS, 'skip', lambda host, by_host=False: calls.append('skip') or {})
+    room = Room.objects.create(host=User.objects.create_user(username='host'), code='SKIP')
+    host_client(client, room)
+
+    first = client.post('/api/skip-song/')
+    second = client.post('/api/skip-song/')
+
+    assert first.json()['status'] == 'applied'
+    assert second.json()['status'] == 'coalesced'
+    assert calls == ['skip']
+
+
+@pytest.mark.django_db
+def test_commands_of_different_kinds_are_not_folded(client, monkeypatch):
+    """
+    Skip во время отправки паузы не поглощается ею и не ждет: клиент получает 202
+    с Retry-After и повторяет с тем же ключом, повтор отправляет skip.
+    """
+    calls = []
+    monkeypatch.setitem(commands.ACTIONS, 'skip', lambda host, by_host=False: calls.append('skip') or {})
+    monkeypatch.setitem(commands.ACTIONS, 'pause', lambda host, by_host=False: calls.append('pause') or {})
+    room = Room.objects.create(host=User.objects.create_user(username='host'), code='KIND')
+    host_client(client, room)
+
+    cache.set(f'cmd-lock:{room.pk}', 'pause')
+    busy = client.post('/api/skip-song/', HTTP_IDEMPOTENCY_KEY='k1')
+    assert busy.status_code == 202 and busy['Retry-After'] == str(commands.RETRY_AFTER)
+    assert busy.json()['status'] == 'pending' and calls == []
+
+    cache.delete(f'cmd-lock:{room.pk}')
+    assert client.post('/api/skip-song/', HTTP_IDEMPOTENCY_KEY='k1').json()['status'] == 'applied'
+    # Тот же ключ у другого действия — это другое нажатие, не повтор
+    assert client.post('/api/pause-song/', HTTP_IDEMPOTENCY_KEY='k1').json()['status'] == 'applied'
+    assert calls == ['skip', 'pause']
+
+
+@pytest.mark.django_db
+def test_toggle_arriving_before_lock_release_is_applied(monkeypatch):
+    """Play, записанный уже после последней проверки намерения, применяется после снятия блокировки."""
+    calls = []
+    monkeypatch.setitem(commands.ACTIONS, 'play', lambda host, by_host=False: calls.append('play') or {})
+    monkeypatch.setitem(commands.ACTIONS, 'pause', lambda host, by_host=False: calls.append('pause') or {})
+    room = Room.objects.create(host=User.objects.create_user(username='host'), code='RACE')
+    apply_final_intent = commands._apply_final_intent
+
+    def late_play(room, action, by_host=False):
+        result = apply_final_intent(room, action, by_host)
+        # Запрос play видит занятую блокировку и получает 'pending'
+        monkeypatch.setattr(commands, '_apply_final_intent', apply_final_intent)
+        assert commands._dispatch(room, 'play')['status'] == 'pending'
+        return result
+
+    monkeypatch.setattr(commands, '_apply_final_intent', late_play)
+    result = commands.run_command(room, 'pause')
+
+    assert calls == ['pause', 'play']
+    assert result == {'action': 'play', 'status': 'applied'}
+
+
+@pytest.mark.django_db
+def test_command_idempotency_key_replays_result(client, monkeypatch):
+    """Повтор запроса с тем же Idempotency-Key не отправляет команду заново."""
+    calls = []
+    monkeypatch.setitem(commands.ACTIONS, 'pause', lambda host, by_host=False: calls.append('pause') or {})
+    room = Room.objects.create(host=User.objects.create_user(username='host'), code='IDEM')
+    host_client(client, room)
+
+    first = client.post('/api/pause-song/', HTTP_IDEMPOTENCY_KEY='k1')
+    cache.delete(f'cmd-last:{room.pk}')  # Окно схлопывания прошло
+    replay = client.post('/api/pause-song/', HTTP_IDEMPOTENCY_KEY='k1')
+
+    assert first.json() == {'action': 'pause', 'status': 'applied'}
+    assert replay.json() == {'action': 'pause', 'status': 'applied', 'replayed': True}
+    assert calls == ['pause']
+
+
+def make_host(username='host'):
+    """Пользователь с действующим токеном Spotify."""
+    user = User.objects.create_user(username=username)
+    SpotifyToken.objects.create(
+        user=user, access_token='access', refresh_token='refresh',
+        token_type='Bearer', expires_in=timezone.now() + timedelta(hours=1)
+    )
+    return user
+
+
+@pytest.mark.django_db
+def test_skip_updates_player_optimistically(client, monkeypatch):
+    """
+    После Skip плеер сразу показывает голову очереди,
+    не дожидаясь запроса currently-playing к Spotify.
+    """
+    monkeypatch.setitem(commands.ACTIONS, 'skip', lambda host, by_host=False: {})
+    room = Room.objects.create(host=make_host(), code='OPTI')
+    save_snapshot(room, {'id': 'old', 'title': 'Old song', 'duration': 200000, 'time': 1000, 'is_playing': True})
+    Track.objects.create(room=room, added_by=room.host, title='Next song', artist='Artist',
+                         spotify_uri='spotify:track:next', duration_ms=180000)
+    host_client(client, room)
+
+    response = client.post('/api/skip-song/')
+    assert response['HX-Trigger'] == 'player-updated'
+
+    def fail(*args, **kwargs):
+        raise AssertionError('Spotify не должен вызываться')
+
+    monkeypatch.setattr(playback, 'get_current_song', fail)
+    player = client.get('/api/current-song/').content.decode('utf-8')
+
+    assert 'Next song' in player
+    assert get_snapshot(room)['optimistic'] is True
+
+
+
+# --- ПРИСУТСТВИЕ ---
+
+@pytest.mark.django_db
+def test_presence_counts_sessions_and_throttles_writes(monkeypatch):
+    """Повторные опросы одной сессии не пишут в кэш; ушедшие и протухшие сессии не считаются."""
+    assert presence.touch(1, 'a') is True
+    assert presence.touch(1, 'a') is False
+    presence.touch(1, 'b')
+    presence.touch(2, 'c')
+    assert presence.counts([1, 2]) == {1: 2, 2: 1}
+
+    presence.leave(1, 'b')
+    assert presence.count(1) == 1
+
+    later = presence.time.time() + presence.PRESENCE_TTL + 1
+    monkeypatch.setattr(presence.time, 'time', lambda: later)
+    assert presence.count(1) == 0
+
+
+@pytest.mark.django_db
+def test_join_full_room_is_rejected(client, settings):
+    settings.ROOM_MAX_LISTENERS = 1
+    room = Room.objects.create(host=make_host(), code='FULL')
+    presence.touch(room.pk, 'someone-else')
+    client.force_login(User.objects.create_user(username='late_guest'))
+
+    response = client.post(reverse('join_room'), {'code': 'full'})
+
+    assert response.status_code == 200
+    assert 'Комната заполнена' in response.content.decode('utf-8')
+    assert 'room_code' not in client.session
+
+
+
+# --- АРЕНДЫ И ФОНОВЫЙ ОПРОС ---
+
+@pytest.mark.django_db
+def test_lease_fails_over_after_expiry():
+    from . import leases
+    from .models import WorkerLease
+
+    assert leases.acquire('job', 30, owner='a') is True
+    assert leases.acquire('job', 30, owner='b') is False
+    assert leases.acquire('job', 30, owner='a') is True  # Продление своей
+
+    # Воркер "a" умер и перестал продлевать
+    WorkerLease.objects.filter(key='job').update(expires_at=timezone.now() - timedelta(seconds=1))
+    assert leases.acquire('job', 30, owner='b') is True
+    assert leases.holders(['job']) == {'job': 'b'}
+
+
+@pytest.mark.django_db
+def test_poller_splits_rooms_between_workers(settings, spotify_calls):
+    """Каждую комнату опрашивает ровно один воркер; второй узел забирает половину."""
+    from . import poller
+
+    settings.BACKGROUND_TASKS_EAGER = True
+    rooms = [Room.objects.create(host=make_host(f'poll{i}'), code=f'PL{i}') for i in range(4)]
+
+    assert len(poller.tick('w1')) == 4
+    assert spotify_calls == ['currently-playing'] * 4
+
+    poller.tick('w2')  # Новый узел отметился живым
+    first = poller.tick('w1')  # Первый отдает лишнее
+    second = poller.tick('w2')  # Второй подбирает
+    assert len(first) == 2 and len(second) == 2
+    assert set(first) | set(second) == {room.pk for room in rooms}
+
+    # Снимки свежие — повторный проход в Spotify не ходит
+    spotify_calls.clear()
+    poller.tick('w1')
+    poller.tick('w2')
+    assert spotify_calls == []
+
+
+def test_poller_requires_shared_cache(settings):
+    """Без REDIS_URL снимки опросчика не видны веб-воркерам — команда не запускается."""
+    from django.core.management import call_command
+    from django.core.management.base import CommandError
+
+    settings.REDIS_URL = None
+    with pytest.raises(CommandError):
+        call_command('poll_rooms')
+
+
+@pytest.mark.django_db
+def test_expiring_host_tokens_are_refreshed_in_background(monkeypatch, django_assert_num_queries):
+    """Обновляются только скоро истекающие токены хостов активных комнат — пачкой, одним bulk_update."""
+    from . import tokens
+
+    def fake_send(method, url, endpoint, user=None, **kwargs):
+        if kwargs['data']['refresh_token'] == 'revoked':
+            return FakeResponse(400, {'error': 'invalid_grant'})
+        return FakeResponse(200, {'access_token': 'fresh', 'expires_in': 3600, 'token_type': 'Bearer'})
+
+    monkeypatch.setattr(spotify_util, '_send', fake_send)
+    soon = timezone.now() + timedelta(minutes=2)
+    hosts = [make_host(f'tok{i}') for i in range(4)]
+    SpotifyToken.objects.filter(user__in=hosts).update(expires_in=soon)
+    SpotifyToken.objects.filter(user=hosts[3]).update(refresh_token='revoked')
+    for host in hosts[:2] + hosts[3:]:
+        Room.objects.create(host=host, code=host.username)
+    Room.objects.create(host=make_host('fresh'), code='FRSH')  # Токен еще долго действует
+    Room.objects.filter(host=hosts[1]).update(last_active=timezone.now() - timedelta(hours=1))  # Комната заброшена
+    # hosts[2] — без комнаты
+
+    with django_assert_num_queries(2):  # Выборка + bulk_update
+        assert tokens.refresh_due() == (1, 1)
+
+    assert list(SpotifyToken.objects.filter(access_token='fresh').values_list('user', flat=True)) == [hosts[0].pk]
+    assert tokens.due().count() == 1  # Отозванный токен остается в метрике jukebox_expiring_host_tokens
+
+
+@pytest.mark.django_db
+def test_inline_token_refresh_uses_hot_timeout(monkeypatch, settings):
+    """Истекший токен на пути запроса обновляется с таймаутом горячего пути, а не фоновым."""
+    timeouts = {}
+
+    def fake_send(method, url, endpoint, user=None, **kwargs):
+        timeouts[endpoint] = kwargs['timeout']
+        if endpoint == 'token-refresh':
+            return FakeResponse(200, {'access_token': 'fresh', 'expires_in': 3600})
+        return FakeResponse(204)
+
+    monkeypatch.setattr(spotify_util, '_send', fake_send)
+    host = make_host('expired')
+    SpotifyToken.objects.filter(user=host).update(expires_in=timezone.now() - timedelta(minutes=1))
+
+    spotify_util.execute_spotify_api_request(host, 'me/player/pause', put_=True)
+
+    assert timeouts['token-refresh'] == settings.SPOTIFY_HOT_TIMEOUT
+    assert SpotifyToken.objects.get(user=host).access_token == 'fresh'
+
+
+# --- ЛЕНТА ИЗМЕНЕНИЙ КОМНАТ ---
+
+@pytest.mark.django_db
+def test_queue_change_is_pushed_to_player_poll(client, spotify_calls, django_capture_on_commit_callbacks):
+    """Добавление трека (в любом процессе) сдвигает версию очереди — следующий опрос плеера просит ее перечитать."""
+    room = budget_room(client, is_host=False)
+    first = client.get('/api/current-song/')
+    version = first['X-Queue-Version']
+    assert float(version) == 0  # Событий еще не было — версия одна во всех воркерах
+
+    unchanged = client.get('/api/current-song/', HTTP_X_QUEUE_VERSION=version)
+    assert 'HX-Trigger' not in unchanged
+
+    # Запись строки сама по себе (heartbeat, каскады) событий не публикует
+    with django_capture_on_commit_callbacks() as callbacks:
+        room.save()
+    assert callbacks == []
+
+    metadata = spotify_util.save_tracks_metadata([spotify_util.metadata_from_item(fake_spotify_track('new'))])['new']
+    with django_capture_on_commit_callbacks(execute=True):
+        views.enqueue_track(room, room.host, metadata.uri, metadata=metadata)
+
+    changed = client.get('/api/current-song/', HTTP_X_QUEUE_VERSION=version)
+    assert changed['HX-Trigger'] == 'queue-changed'
+    assert changed['X-Queue-Version'] != version
+
+
+def test_listener_event_sets_local_version():
+    """Событие от слушателя (изменение в другом процессе) записывает версию в кэш этого процесса."""
+    from . import events
+
+    events.dispatch('{"r":5,"k":"queue","o":"save","t":1700000000.25}')
+    assert events.version(5, 'queue') == 1700000000.25
+
+
+@pytest.mark.django_db
+def test_room_delete_event_drops_cached_state(django_capture_on_commit_callbacks):
+    from . import teardown
+
+    room = Room.objects.create(host=make_host(), code='GONE')
+    save_snapshot(room, {'id': 'a', 'duration': 1000, 'time': 0, 'is_playing': True})
+    presence.touch(room.pk, 'guest')
+    room_id = room.pk
+    Room.objects.filter(pk=room_id).update(is_active=False)
+
+    with django_capture_on_commit_callbacks(execute=True):
+        teardown.purge_room(room_id)
+
+    assert cache.get(f"playback:{room_id}") is None
+    assert presence.count(room_id) == 0
+
+
+@pytest.mark.django_db
+def test_leave_room_closes_at_once_and_purges_in_background(client, settings, monkeypatch,
+                                                              django_capture_on_commit_callbacks,
+                                                              django_assert_max_num_queries):
+    """Хост уходит: ответ не ждет удаления очереди; строки удаляются пачками, событие — одно."""
+    from . import events, teardown
+    from .models import Vote
+
+    settings.BACKGROUND_TASKS_EAGER = True
+    monkeypatch.setattr(teardown, 'CHUNK_SIZE', 10)
+    room = Room.objects.create(host=make_host(), code='BIGR')
+    host_client(client, room)
+    Track.objects.bulk_create(
+        Track(room=room, added_by=room.host, title=f't{i}', artist='A', spotify_uri=f'spotify:track:{i}')
+        for i in range(25)
+    )
+    Vote.objects.bulk_create(Vote(room=room, user=f's{i}', song_id='a') for i in range(25))
+
+    with django_assert_max_num_queries(8), django_capture_on_commit_callbacks() as callbacks:
+        assert client.post('/leave-room/').status_code == 200
+    assert not Room.objects.filter(pk=room.pk).exists()
+    assert Track.objects.filter(room_id=room.pk).count() == 25  # Еще не удалены
+
+    published = []
+    monkeypatch.setattr(events, 'publish', lambda *args: published.append(args))
+    for callback in callbacks:
+        callback()
+
+    assert not Room.all_objects.filter(pk=room.pk).exists()
+    assert not Track.objects.exists() and not Vote.objects.exists()
+    assert published == [(room.pk, 'room', 'delete')]
+
+
+
+@pytest.mark.django_db
+def test_purge_skips_room_that_fails_and_deletes_the_rest(monkeypatch):
+    from . import teardown
+
+    rooms = [Room.objects.create(host=make_host(f'purge{i}'), code=f'PU{i}') for i in range(3)]
+    Room.objects.update(is_active=False)
+    purge_room = teardown.purge_room
+
+    def flaky(room_id):
+        if room_id == rooms[0].pk:
+            raise RuntimeError('lock timeout')
+        purge_room(room_id)
+
+    monkeypatch.setattr(teardown, 'purge_room', flaky)
+
+    assert teardown.purge_closed() == {rooms[0].pk}
+    assert list(Room.all_objects.values_list('pk', flat=True)) == [rooms[0].pk]
+
+
+# --- РЕПЛИКИ БД ---
+
+@pytest.mark.django_db
+def test_replica_reads_stick_to_primary_after_write(monkeypatch):
+    """Read-only вью читает с реплики; после записи — основная БД и для этого запроса, и для следующих сессии."""
+    from django.http import HttpResponse
+    from django.test import RequestFactory
+    from . import db_router
+    from .middleware import ReplicaRoutingMiddleware
+
+    monkeypatch.setattr(db_router, 'replicas', lambda: ['replica1'])
+    router = db_router.ReplicaRouter()
+    assert router.db_for_read(Room) is None  # Вне запроса (фоновые задачи)
+
+    seen = []
+
+    def get_response(request):
+        middleware.process_view(request, views.GetQueue.as_view(), (), {})
+        seen.append((router.db_for_read(Room), router.db_for_read(User)))
+        if len(seen) == 1:
+            router.db_for_write(Track)  # Например, добавили трек
+            seen.append((router.db_for_read(Room), None))
+        return HttpResponse()
+
+    middleware = ReplicaRoutingMiddleware(get_response)
+    request = RequestFactory().get('/api/queue/')
+
+    response = middleware(request)
+    # Следующий запрос того же клиента (в любом воркере) приходит с cookie-отметкой
+    request = RequestFactory().get('/api/queue/')
+    request.COOKIES.update({key: morsel.value for key, morsel in response.cookies.items()})
+    middleware(request)
+    assert seen == [('replica1', None), (None, None), (None, None)]
+    assert not getattr(views.CurrentSong, 'replica_reads', False)  # Плеер пишет по прочитанному
+
+
+# --- ЛОГИ ---
+
+def test_async_log_handler_adds_context_and_rate_limits():
+    """Записи уходят через очередь JSON-строками с контекстом; повторы ошибок Spotify режутся."""
+    import io
+    import json
+    import logging
+    from django.test import RequestFactory
+    from . import log
+
+    stream = io.StringIO()
+    handler = log.AsyncHandler(stream=stream)
+    handler.addFilter(log.ContextFilter())
+    logger = logging.getLogger('jukebox.test_upstream')
+    logger.addHandler(handler)
+    logger.addFilter(log.RateLimitFilter(burst=3, period=60))
+    logger.propagate = False
+
+    token = log.start(RequestFactory().get('/api/current-song/'))
+    log.bind(room='ABCD', host='dj')
+    for _ in range(10):
+        logger.warning("Spotify %s returned %s", 'currently-playing', 503)
+    log.finish(token)
+    handler.stop()
+    logger.removeHandler(handler)
+
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert len(lines) == 3
+    assert lines[0]['msg'] == 'Spotify currently-playing returned 503'
+    assert lines[0]['room'] == 'ABCD' and lines[0]['host'] == 'dj'
+    assert lines[0]['path'] == '/api/current-song/'
+
+
+# --- МЕТРИКИ ---
+
+class FakeResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self._body = body or {}
+        self.text = str(self._body)
+        self.headers = {}
+
+    def json(self):
+        return self._body
+
+
+@pytest.mark.django_db
+def test_metrics_endpoint_reports_spotify_calls(client, monkeypatch, settings):
+    """Вызовы Spotify (включая 429) и активные комнаты видны на /metrics/ — только с токеном."""
+    monkeypatch.setattr(spotify_util.requests, 'request', lambda *args, **kwargs: FakeResponse(429))
+    host = make_host('metrics_host')
+    Room.objects.create(host=host, code='METR')
+
+    spotify_util.execute_spotify_api_request(host, 'me/player/currently-playing')
+    settings.METRICS_TOKEN = None
+    assert client.get('/metrics/').status_code == 403
+    settings.METRICS_TOKEN = 'secret'
+    assert client.get('/metrics/').status_code == 403
+    body = client.get('/metrics/', HTTP_AUTHORIZATION='Bearer secret').content.decode('utf-8')
+
+    assert 'jukebox_spotify_request_seconds_count{endpoint="currently-playing"}' in body
+    assert f'jukebox_spotify_rate_limited_total{{host_id="{host.pk}"}}' in body
+    assert f'jukebox_spotify_responses_total{{host_id="{host.pk}",status="429"}}' in body
+    assert f'jukebox_spotify_calls_by_host_total{{host_id="{host.pk}"}}' in body
+    assert 'metrics_host' not in body
+    assert 'jukebox_active_rooms 1.0' in body
+    assert 'jukebox_db_queries_per_request' in body
+
+
+@pytest.mark.django_db
+def test_server_timing_header(client, monkeypatch):
+    """Ответ содержит разбивку времени: БД, Spotify, шаблоны."""
+    monkeypatch.setattr(spotify_util.requests, 'request', lambda *args, **kwargs: FakeResponse(204))
+    room = Room.objects.create(host=make_host(), code='TIME')
+    host_client(client, room)
+
+    header = client.get('/api/current-song/')['Server-Timing']
+
+    assert header.startswith('db;dur=')
+    assert 'queries' in header
+    assert 'spotify;dur=' in header and 'tpl;dur=' in header and 'total;dur=' in header
+
+
+@pytest.mark.django_db
+def test_sampling_profiler_keeps_slowest(client, settings, tmp_path):
+    """Включенный профилировщик сохраняет не больше PROFILER_KEEP профилей."""
+    from .middleware import SamplingProfilerMiddleware
+    from django.http import HttpResponse
+    from django.test import RequestFactory
+
+    settings.PROFILER_ENABLED = True
+    settings.PROFILER_SAMPLE_RATE = 1.0
+    settings.PROFILER_MIN_MS = 0
+    settings.PROFILER_KEEP = 2
+    settings.PROFILER_DIR = str(tmp_path)
+    middleware = SamplingProfilerMiddleware(lambda request: HttpResponse('ok'))
+
+    for _ in range(4):
+        middleware(RequestFactory().get('/api/queue/'))
+
+    assert len(list(tmp_path.glob('*.prof'))) == 2
+
+
+# --- НАГРУЗОЧНЫЙ ТЕСТ ---
+
+@pytest.mark.django_db
+def test_fake_spotify_models_player_and_rate_limit(settings):
+    """Заглушка Spotify отдает текущий трек и 429 с Retry-After сверх лимита."""
+    import requests
+    from .fake_spotify import FakeSpotify
+
+    fake = FakeSpotify(latency_ms=0, jitter_ms=0, rate_limit=2)
+    base_url = fake.start()
+    settings.SPOTIFY_API_URL = f"{base_url}/v1/"
+    try:
+        host = make_host()
+        song = spotify_util.get_current_song(host)
+        assert song['id'].startswith('fake')
+
+        spotify_util.execute_spotify_api_request(host, 'me/player/next', post_=True)
+        limited = requests.get(f"{base_url}/v1/me/player/currently-playing",
+                               headers={'Authorization': 'Bearer access'})
+        assert limited.status_code == 429
+        assert int(limited.headers['Retry-After']) >= 1
+    finally:
+        fake.stop()
+
+
+# --- БЮДЖЕТ SQL-ЗАПРОСОВ И ВЫЗОВОВ SPOTIFY ДЛЯ ГОРЯЧИХ ЭНДПОИНТОВ ---
+# Числа зафиксированы для "установившегося" состояния (кэши прогреты).
+# Если тест упал из-за роста — скорее всего, появился N+1 или лишний вызов Spotify.
+
+PLAYING = fake_spotify_track('playing')
+
+
+@pytest.fixture
+def spotify_calls(monkeypatch):
+    """Заглушка HTTP-клиента Spotify: отвечает по эндпоинту и записывает вызовы."""
+    calls = []
+
+    def fake_send(method, url, endpoint, user=None, **kwargs):
+        calls.append(endpoint)
+        if endpoint == 'currently-playing':
+            return FakeResponse(200, {'item': PLAYING, 'progress_ms': 1000, 'is_playing': True})
+        if endpoint == 'search':
+            return FakeResponse(200, {'tracks': {'items': [fake_spotify_track(f's{i}') for i in range(5)]}})
+        if endpoint == 'tracks':
+            ids = url.split('ids=')[1].split(',')
+            return FakeResponse(200, {'tracks': [fake_spotify_track(track_id) for track_id in ids]})
+        return FakeResponse(204)
+
+    monkeypatch.setattr(spotify_util, '_send', fake_send)
+    return calls
+
+
+def budget_room(client, is_host=True, votes_to_skip=5):
+    room = Room.objects.create(host=make_host(), code='BUDG', votes_to_skip=votes_to_skip)
+    if is_host:
+        client.force_login(room.host)
+    else:
+        client.force_login(User.objects.create_user(username='guest'))
+    session = client.session
+    session['room_code'] = room.code
+    session.save()
+    return room
+
+
+def make_due(room):
+    """Снимок плеера пора обновить — следующий опрос пойдет в Spotify."""
+    restore_snapshot(room, dict(get_snapshot(room), next_fetch_at=0))
+
+
+# Сессия, пользователь, комната+хост, 2x токен, голова очереди (голоса — в кэше).
+# Heartbeat хоста пишется в БД раз в HOST_HEARTBEAT_INTERVAL, поэтому в установившемся режиме его нет.
+CURRENT_SONG_QUERIES = {True: 6, False: 6}
+# Между плановыми обновлениями: без запросов к Spotify и синхронизации очереди
+SCHEDULED_CURRENT_SONG_QUERIES = {True: 4, False: 4}
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('is_host', [True, False])
+def test_current_song_budget(client, spotify_calls, django_assert_num_queries, is_host):
+    room = budget_room(client, is_host)
+    client.get('/api/current-song/')  # Прогрев: метаданные текущего трека, current_song
+    make_due(room)
+    spotify_calls.clear()
+
+    with django_assert_num_queries(CURRENT_SONG_QUERIES[is_host]):
+        response = client.get('/api/current-song/')
+
+    assert response.status_code == 200
+    assert spotify_calls == ['currently-playing']
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('is_host', [True, False])
+def test_current_song_scheduled_budget(client, spotify_calls, django_assert_num_queries, is_host):
+    budget_room(client, is_host)
+    client.get('/api/current-song/')
+    spotify_calls.clear()
+
+    with django_assert_num_queries(SCHEDULED_CURRENT_SONG_QUERIES[is_host]):
+        response = client.get('/api/current-song/')
+
+    assert response.status_code == 200
+    assert spotify_calls == []
+
+
+@pytest.mark.django_db
+def test_current_song_sends_progress_only_when_state_unchanged(client, spotify_calls):
+    """Тот же трек и состояние — в ответе только out-of-band #player-data; голос — снова весь плеер."""
+    room = budget_room(client, is_host=False)
+    first = client.get('/api/current-song/')
+    fingerprint = first['X-Player-Fingerprint']
+    assert 'song-info' in first.content.decode('utf-8')
+
+    progress = client.get('/api/current-song/', HTTP_X_PLAYER_FINGERPRINT=fingerprint)
+    html = progress.content.decode('utf-8')
+    assert progress['HX-Reswap'] == 'none'
+    assert 'hx-swap-oob="true"' in html and 'song-info' not in html
+    assert len(html) < len(first.content) / 3
+
+    votes.cast(room, PLAYING['id'], 'other-guest')
+    changed = client.get('/api/current-song/', HTTP_X_PLAYER_FINGERPRINT=fingerprint)
+    assert 'song-info' in changed.content.decode('utf-8')
+    assert changed['X-Player-Fingerprint'] != fingerprint
+
+
+@pytest.mark.django_db
+def test_player_reads_track_details_from_metadata_table(client, spotify_calls):
+    room = budget_room(client, is_host=False)
+    client.get('/api/current-song/')  # Трек записан в room.current_song и TrackMetadata
+    TrackMetadata.objects.filter(pk=PLAYING['id']).update(title='Title from table')
+
+    response = client.get('/api/current-song/')
+
+    assert 'Title from table' in response.content.decode('utf-8')
+
+
+@pytest.mark.django_db
+def test_get_queue_budget(client, spotify_calls, django_assert_num_queries):
+    room = budget_room(client)
+    for i in range(100):
+        Track.objects.create(room=room, added_by=room.host, title=f'T{i}', artist='A',
+                             spotify_uri=f'spotify:track:t{i}', duration_ms=1000, queue_offset_ms=i * 1000)
+
+    with django_assert_num_queries(4):
+        response = client.get('/api/queue/')
+
+    assert response.content.decode('utf-8').count('list-group-item') == 100
+    assert spotify_calls == []
+
+
+@pytest.mark.django_db
+def test_get_queue_delta_sends_only_changes(client, spotify_calls, django_assert_num_queries):
+    """С курсором очередь отдает только новые треки и новую голову, размер ответа не зависит от длины очереди."""
+    room = budget_room(client)
+    tracks = [Track.objects.create(room=room, added_by=room.host, title=f'T{i}', artist='A',
+                                   spotify_uri=f'spotify:track:t{i}', duration_ms=1000, queue_offset_ms=i * 1000)
+              for i in range(100)]
+    save_snapshot(room, {'id': 'now', 'duration': 10000, 'time': 4000, 'is_playing': False})
+    cursor = tracks[-1].pk
+
+    assert client.get('/api/queue/', {'after': cursor})['HX-Reswap'] == 'none'
+
+    tracks[0].delete()  # Голова заиграла
+    added = Track.objects.create(room=room, added_by=room.host, title='New', artist='A',
+                                 spotify_uri='spotify:track:new', duration_ms=1000, queue_offset_ms=100 * 1000)
+
+    with django_assert_num_queries(5):  # + голова очереди
+        response = client.get('/api/queue/', {'after': cursor})
+
+    html = response.content.decode('utf-8')
+    assert html.count('list-group-item') == 1
+    assert f'data-cursor="{added.pk}"' in html and f'data-head="{tracks[1].pk}"' in html
+    assert 'in ~1:45' in html  # 6 с до конца текущего + 99 треков перед ним
+
+
+@pytest.mark.django_db
+def test_vote_to_skip_budget(client, spotify_calls, django_assert_num_queries):
+    budget_room(client, is_host=False)
+
+    # Сессия, пользователь, комната+хост, токен; сам голос БД не трогает
+    with django_assert_num_queries(4):
+        response = client.post('/api/vote-to-skip/')
+
+    assert response.json() == {'votes': 1, 'required': 5}
+    assert spotify_calls == ['currently-playing']
+
+
+@pytest.mark.django_db
+def test_spotify_endpoints_are_throttled_per_session_and_room(client, settings, spotify_calls,
+                                                              django_assert_num_queries):
+    """Сверх лимита сессии — 429 без запросов к БД; лимит комнаты общий для всех ее гостей."""
+    from django.test import Client
+
+    settings.REST_FRAMEWORK = {'DEFAULT_THROTTLE_RATES': {
+        'search_session': '2/min', 'search_room': '3/min', 'search_spotify_session': '1/min',
+        'spotify_host': '100/min',
+    }}
+    room = budget_room(client, is_host=False)
+    for _ in range(2):
+        assert client.get('/api/spotify/search/', {'query': ''}).status_code == 200
+
+    with django_assert_num_queries(0):
+        throttled = client.get('/api/spotify/search/', {'query': ''})
+    assert throttled.status_code == 429 and 'Retry-After' in throttled
+
+    other = Client()
+    other.force_login(User.objects.create_user(username='other'))
+    session = other.session
+    session['room_code'] = room.code
+    session.save()
+    assert other.get('/api/spotify/search/', {'query': ''}).status_code == 200
+    assert other.get('/api/spotify/search/', {'query': ''}).status_code == 429  # Бюджет комнаты исчерпан
+    # Отложенная догрузка из Spotify считается отдельно от набора текста
+    assert other.get('/api/spotify/search/', {'query': '', 'source': 'spotify'}).status_code == 200
+    assert spotify_calls == []
+
+
+@pytest.mark.django_db
+def test_vote_burst_is_counted_in_cache_and_flushed_in_batch(client, spotify_calls, monkeypatch,
+                                                            django_assert_num_queries):
+    """Залп голосов: повтор отклоняется, пропуск — по счетчику, в Vote голоса пишутся одной пачкой."""
+    from .models import Vote
+
+    monkeypatch.setattr(votes, 'VOTE_FLUSH_INTERVAL', 3600)
+    monkeypatch.setitem(commands.ACTIONS, 'skip', lambda host, by_host=False: {})
+    room = Room.objects.create(host=make_host(), code='VOTE', votes_to_skip=3)
+    save_snapshot(room, {'id': 'a', 'duration': 1000, 'time': 0, 'is_playing': True})
+
+    assert votes.cast(room, 'a', 's1') == (True, 1)
+    assert votes.cast(room, 'a', 's1') == (False, 1)
+    assert votes.cast(room, 'a', 's2') == (True, 2)
+    assert not Vote.objects.exists()
+
+    client.force_login(User.objects.create_user(username='guest'))
+    session = client.session
+    session['room_code'] = room.code
+    session.save()
+    assert client.post('/api/vote-to-skip/').json()['message'] == 'Skipped'
+    assert spotify_calls == []  # Трек взят из снимка плеера
+    assert votes.count(room.pk, 'a') == 0  # Новый раунд
+
+    with django_assert_num_queries(2):  # Проверка комнат + bulk_create
+        assert votes.flush() == 3
+    assert Vote.objects.filter(room=room, song_id='a').count() == 3
+
+
+@pytest.mark.django_db
+def test_lone_vote_is_flushed_by_timer_and_requeued_on_failure(monkeypatch):
+    from .models import Vote
+
+    flushes = []
+    monkeypatch.setattr(votes, 'VOTE_FLUSH_INTERVAL', 0.05)
+    monkeypatch.setattr(votes, 'submit_once', lambda key, fn: flushes.append(key))
+    room = Room.objects.create(host=make_host(), code='LONE')
+
+    votes.cast(room, 'a', 's1')
+    time.sleep(0.2)
+    assert len(flushes) == 1  # Записали бы, не дожидаясь следующего голоса
+
+    def broken(*args, **kwargs):
+        raise RuntimeError('db is down')
+
+    bulk_create = Vote.objects.bulk_create
+    monkeypatch.setattr(Vote.objects, 'bulk_create', broken)
+    assert votes.flush() == 0
+    assert len(votes._pending) == 1  # Пачка вернулась в буфер, повтор — снова по таймеру
+    time.sleep(0.2)
+    assert len(flushes) == 2
+
+    monkeypatch.setattr(Vote.objects, 'bulk_create', bulk_create)
+    assert votes.flush() == 1
+    assert Vote.objects.filter(room=room, user='s1').count() == 1
+
+
+@pytest.mark.django_db
+def test_votes_go_to_db_without_shared_cache(settings):
+    """С кэшем в памяти процесса проверка "уже голосовал" и счетчик — в БД, общей для воркеров."""
+    from .models import Vote
+
+    settings.VOTES_IN_CACHE = False
+    room = Room.objects.create(host=make_host(), code='DBVT')
+
+    assert votes.cast(room, 'a', 's1') == (True, 1)
+    cache.clear()  # Другой воркер — другой кэш
+    assert votes.cast(room, 'a', 's1') == (False, 1)
+    assert votes.cast(room, 'a', 's2') == (True, 2)
+    assert votes.count(room.pk, 'a') == 2 and not votes._pending
+
+    votes.clear(room.pk)
+    assert not Vote.objects.exists()
+
+
+@pytest.mark.django_db
+def test_search_warm_cache_budget(client, spotify_calls, django_assert_num_queries):
+    budget_room(client, is_host=False)
+    client.get('/api/spotify/search/', {'query': 'love'})  # Прогрев кэша поиска
+    spotify_calls.clear()
+
+    with django_assert_num_queries(5):
+        response = client.get('/api/spotify/search/', {'query': 'Love '})
+
+    assert response.content.decode('utf-8').count('hx-post="/api/add-to-queue/"') == 5
+    assert spotify_calls == []
+
+
+@pytest.mark.django_db
+def test_add_to_queue_budget(client, spotify_calls, django_assert_num_queries):
+    budget_room(client, is_host=False)
+    spotify_util.save_tracks_metadata([spotify_util.metadata_from_item(fake_spotify_track('cached'))])
+
+    # 3 из них — блокировка комнаты для смещения в очереди (SELECT FOR UPDATE + SAVEPOINT/RELEASE в тесте)
+    with django_assert_num_queries(10):
+        response = client.post('/api/add-to-queue/', {'uri': 'spotify:track:cached'})
+
+    assert response.status_code == 204
+    assert spotify_calls == ['queue']
+
+@pytest.mark.django_db
+def test_typeahead_answers_locally_before_spotify(client, spotify_calls, django_assert_num_queries):
+    """Уже известные треки находятся по префиксу без Spotify; популярные в очередях — первыми."""
+    room = budget_room(client, is_host=False)
+    spotify_util.save_tracks_metadata([
+        spotify_util.metadata_from_item(dict(fake_spotify_track('rare'), name='Love Rare')),
+        spotify_util.metadata_from_item(dict(fake_spotify_track('hit'), name='Love Hit')),
+    ])
+    Track.objects.create(room=room, added_by=room.host, title='Love Hit', artist='A',
+                         spotify_uri='spotify:track:hit', metadata_id='hit')
+    typeahead.refresh()
+
+    # Сессия, пользователь, комната+хост
+    with django_assert_num_queries(3):
+        results = client.get('/api/spotify/search/', {'query': 'lo'}).content.decode('utf-8')
+
+    assert spotify_calls == []
+    assert results.index('Love Hit') < results.index('Love Rare')
+    assert 'source=spotify&query=lo' in results  # Spotify — отложенным запросом
+
+    merged = client.get('/api/spotify/search/', {'query': 'lo', 'source': 'spotify'}).content.decode('utf-8')
+    assert spotify_calls == ['search']
+    assert merged.count('hx-post="/api/add-to-queue/"') == 7  # 2 локальных + 5 из Spotify
+
+
+@pytest.mark.django_db
+def test_typeahead_refresh_loads_every_new_track_and_stays_bounded(settings, monkeypatch):
+    """Пачка новых треков больше REFRESH_BATCH загружается целиком; индекс не растет сверх лимита."""
+    monkeypatch.setattr(typeahead, 'REFRESH_BATCH', 2)
+    settings.TYPEAHEAD_MAX_TRACKS = 4
+    spotify_util.save_tracks_metadata([spotify_util.metadata_from_item(fake_spotify_track('old'))])
+    typeahead.refresh()
+
+    spotify_util.save_tracks_metadata([
+        spotify_util.metadata_from_item(dict(fake_spotify_track(f'n{i}'), name=f'Night {i}')) for i in range(3)
+    ])
+    typeahead.refresh()
+    assert {track['id'] for track in typeahead.search('night', 10)} == {'n0', 'n1', 'n2'}
+
+    for i in range(3):
+        typeahead.add(spotify_util.metadata_from_item(dict(fake_spotify_track(f'd{i}'), name=f'Day {i}')))
+    assert len(typeahead._tracks) == 4
+    assert typeahead.search('song', 10) == []  # 'old' вытеснен, его префиксы тоже
+    assert len(typeahead.search('day', 10)) == 3
+
+
+@pytest.mark.django_db
+def test_search_and_enqueue_picks_top_hit(client, spotify_calls):
+    """Голосовая команда: один запрос — поиск (из кэша) и добавление лучшего трека."""
+    room = budget_room(client, is_host=False)
+
+    response = client.post('/api/search-and-enqueue/', {'query': 'love'}, content_type='application/json')
+
+    assert response.status_code == 201
+    assert response.json()['uri'] == 'spotify:track:s0'
+    assert Track.objects.get(room=room).title == 'Song s0'
+    assert spotify_calls == ['search', 'queue']
+
+    # Повтор: трек уже в локальном индексе — Spotify нужен только для постановки в очередь
+    spotify_calls.clear()
+    client.post('/api/search-and-enqueue/', {'query': 'song s0'}, content_type='application/json')
+    assert spotify_calls == ['queue']
+
+
+
+# --- ТАЙМАУТЫ И УСТАРЕВШИЕ ДАННЫЕ ---
+
+@pytest.fixture
+def slow_spotify(monkeypatch, settings):
+    """Spotify не отвечает: каждый запрос падает по таймауту."""
+    import requests
+
+    settings.BACKGROUND_TASKS_EAGER = True
+    calls = []
+
+    def timeout(method, url, endpoint, user=None, **kwargs):
+        calls.append((endpoint, kwargs.get('timeout')))
+        raise requests.Timeout('read timed out')
+
+    monkeypatch.setattr(spotify_util, '_send', timeout)
+    return calls
+
+
+@pytest.mark.django_db
+def test_current_song_serves_stale_snapshot_on_timeout(client, slow_spotify, settings):
+    """При таймауте плеер показывает последний снимок и запускает фоновое обновление."""
+    room = Room.objects.create(host=make_host(), code='SLOW')
+    save_snapshot(room, {'id': 'old', 'title': 'Last known song', 'duration': 200000, 'time': 1000,
+                         'is_playing': True})
+    make_due(room)
+    host_client(client, room)
+
+    player = client.get('/api/current-song/').content.decode('utf-8')
+
+    assert 'Last known song' in player
+    assert 'showing last known state' in player
+    # Первый запрос — с таймаутом горячего пути, второй — фоновое обновление с обычным
+    assert slow_spotify == [('currently-playing', settings.SPOTIFY_HOT_TIMEOUT),
+                            ('currently-playing', settings.SPOTIFY_TIMEOUT)]
+
+
+@pytest.mark.django_db
+def test_search_serves_stale_results_on_timeout(client, slow_spotify, monkeypatch):
+    """Устаревший результат поиска лучше, чем пустой список во время сбоя Spotify."""
+    room = Room.objects.create(host=make_host(), code='SRCH')
+    spotify_util.save_tracks_metadata([spotify_util.metadata_from_item(fake_spotify_track('old'))])
+    cache.set(spotify_util._search_cache_key('love'), {'ids': ['old'], 'at': 0}, 60)
+    host_client(client, room)
+
+    results = client.get('/api/spotify/search/', {'query': 'love'}).content.decode('utf-8')
+
+    assert 'Song old' in results
+    assert 'showing saved results' in results
+
+
+@pytest.mark.django_db
+def test_idle_host_backs_off_until_command(client, monkeypatch):
+    """Без активного устройства плеер не опрашивается на каждый запрос; пустой список устройств держат только гости."""
+    calls = []
+
+    def no_device(method, url, endpoint, user=None, **kwargs):
+        calls.append(endpoint)
+        return FakeResponse(204)
+
+    monkeypatch.setattr(spotify_util, '_send', no_device)
+    room = Room.objects.create(host=make_host(), code='IDLE')
+    host_client(client, room)
+
+    for _ in range(3):
+        assert 'No active device' in client.get('/api/current-song/').content.decode('utf-8')
+    assert calls == ['currently-playing']
+
+    # Устройств нет вовсе — команда не уходит в Spotify заведомо неудачной и паузу опроса не сбрасывает
+    client.post('/api/play-song/')
+    client.get('/api/current-song/')
+    assert calls == ['currently-playing', 'devices']
+
+    # Пока действует запомненный пустой список, нажатия гостей Spotify не стоят ничего
+    from django.test import Client
+
+    room.guest_can_pause = True
+    room.save(update_fields=['guest_can_pause'])
+    guest = Client()
+    session = guest.session
+    session['room_code'] = room.code
+    session.save()
+    guest.post('/api/pause-song/')
+    guest.post('/api/skip-song/')
+    assert calls == ['currently-playing', 'devices']
+
+    # Хост мог только что открыть Spotify — его нажатие список перечитывает
+    client.post('/api/play-song/')
+    assert calls == ['currently-playing', 'devices', 'devices']
+
+
+@pytest.mark.django_db
+def test_only_accepted_host_command_resets_idle(client, monkeypatch):
+    """Паузу опроса сбрасывает только принятая команда хоста; голосование идет через снимок и паузу."""
+    monkeypatch.setitem(commands.ACTIONS, 'skip', lambda host, by_host=False: {})
+    monkeypatch.setattr(playback, 'get_current_song', lambda *args, **kwargs: pytest.fail('Spotify не должен вызываться'))
+    room = Room.objects.create(host=make_host(), code='IDLR', votes_to_skip=1)
+    playback.note_idle(room.host, spotify_util.NO_DEVICE_ERROR)
+    host_client(client, room)
+
+    # Голос при хосте без устройства не спрашивает Spotify
+    assert client.post('/api/vote-to-skip/').status_code == 204
+
+    commands.run_command(room, 'skip')
+    assert playback.get_idle_backoff(room.host)
+
+    cache.delete(f'cmd-last:{room.pk}')
+    commands.run_command(room, 'skip', by_host=True)
+    assert playback.get_idle_backoff(room.host) is None
+
+
+@pytest.mark.django_db
+def test_command_without_active_device_transfers_playback(client, monkeypatch):
+    """404 'нет активного устройства' -> перенос на лучшее устройство; дальше команды идут сразу."""
+    calls = []
+    active = []
+
+    def fake_send(method, url, endpoint, user=None, **kwargs):
+        calls.append(endpoint)
+        if endpoint == 'devices':
+            return FakeResponse(200, {'devices': [
+                {'id': 'phone', 'type': 'Smartphone', 'is_active': False},
+                {'id': 'laptop', 'type': 'Computer', 'is_active': False},
+                {'id': 'web', 'type': 'Computer', 'is_active': False, 'is_restricted': True},
+            ]})
+        if endpoint == 'player':
+            active.append(kwargs['json'])
+            return FakeResponse(204)
+        if not active:
+            return FakeResponse(404, {'error': {'reason': 'NO_ACTIVE_DEVICE'}})
+        return FakeResponse(204)
+
+    monkeypatch.setattr(spotify_util, '_send', fake_send)
+    room = Room.objects.create(host=make_host(), code='DEVS')
+    host_client(client, room)
+
+    assert client.post('/api/play-song/').json()['status'] == 'applied'
+    assert calls == ['play', 'devices', 'player']
+    assert active == [{'device_ids': ['laptop'], 'play': True}]
+
+    client.post('/api/skip-song/')
+    assert calls[3:] == ['next']
+
+
+@pytest.mark.django_db
+def test_queue_404_for_bad_uri_does_not_transfer_playback(monkeypatch):
+    """404 без NO_ACTIVE_DEVICE (например, неверный uri) — не повод переносить воспроизведение."""
+    from . import devices
+
+    calls = []
+
+    def fake_send(method, url, endpoint, user=None, **kwargs):
+        calls.append(endpoint)
+        return FakeResponse(404, {'error': {'status': 404, 'message': 'Invalid track uri'}})
+
+    monkeypatch.setattr(spotify_util, '_send', fake_send)
+    response = devices.queue(make_host(), 'spotify:track:bad')
+
+    assert response['status_code'] == 404
+    assert calls == ['queue']
+
 # Create your tests here.
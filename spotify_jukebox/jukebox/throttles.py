@@ -0,0 +1,89 @@
+from django.conf import settings
+from rest_framework.settings import api_settings
+from rest_framework.throttling import SimpleRateThrottle
+from rest_framework.views import APIView
+
+# Лимиты запросов, которые расходуют квоту Spotify хоста.
+# Вью задает класс эндпоинта (throttle_scope = 'search' / 'search_spotify' / 'queue' / 'control'),
+# бюджеты берутся из REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'] по ключам
+# '<класс>_session', '<класс>_room' и общему 'spotify_host'. Счетчики — в кэше.
+# Нет ставки для уровня — этот уровень не ограничивается.
+
+
+class ScopedLevelThrottle(SimpleRateThrottle):
+    level = None
+
+    def __init__(self):
+        # Ставка зависит от вью, поэтому определяется в allow_request
+        pass
+
+    def scope_for(self, view_scope):
+        return f"{view_scope}_{self.level}"
+
+    def get_ident_for_level(self, request):
+        # Уровень без идентификатора (как и без ставки) не ограничивается
+        return None
+
+    def allow_request(self, request, view):
+        view_scope = getattr(view, 'throttle_scope', None)
+        if not view_scope:
+            return True
+        self.scope = self.scope_for(view_scope)
+        self.rate = api_settings.DEFAULT_THROTTLE_RATES.get(self.scope)
+        if not self.rate:
+            return True
+        self.num_requests, self.duration = self.parse_rate(self.rate)
+        return super().allow_request(request, view)
+
+    def get_cache_key(self, request, view):
+        ident = self.get_ident_for_level(request)
+        if ident is None:
+            return None
+        return self.cache_format % {'scope': self.scope, 'ident': ident}
+
+
+class SessionRateThrottle(ScopedLevelThrottle):
+    """Одна вкладка/гость. Ключ сессии берется из cookie — без загрузки сессии из БД."""
+    level = 'session'
+
+    def get_ident_for_level(self, request):
+        return request.COOKIES.get(settings.SESSION_COOKIE_NAME) or self.get_ident(request)
+
+
+class RoomRateThrottle(ScopedLevelThrottle):
+    """Все гости комнаты вместе, по каждому классу эндпоинтов отдельно."""
+    level = 'room'
+
+    def get_ident_for_level(self, request):
+        return request.session.get('room_code')
+
+
+class HostRateThrottle(RoomRateThrottle):
+    """
+    Общий бюджет хоста на все классы эндпоинтов. Открытая комната у хоста одна
+    (create_room закрывает прежние), поэтому считаем по коду комнаты — без запроса к БД.
+    """
+    level = 'host'
+
+    def scope_for(self, view_scope):
+        return 'spotify_host'
+
+
+class ThrottledAPIView(APIView):
+    """
+    APIView с лимитами по throttle_scope. Лимиты проверяются до аутентификации
+    и до первого отказа: отклоненный запрос не стоит запросов к БД (кроме загрузки
+    сессии для уровней room/host) и не расходует бюджет следующих уровней.
+    """
+    throttle_classes = [SessionRateThrottle, RoomRateThrottle, HostRateThrottle]
+
+    def perform_authentication(self, request):
+        # Переносится в check_throttles, после лимитов
+        pass
+
+    def check_throttles(self, request):
+        for throttle in self.get_throttles():
+            if not throttle.allow_request(request, self):
+                self.throttled(request, throttle.wait())
+        # Лимиты пройдены — аутентификация (и проверка CSRF для сессий), как обычно в DRF
+        request.user
@@ -0,0 +1,74 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from . import leases
+from .background import submit_once
+from .log import get_logger
+from .metrics import observe_token_refresh
+from .models import Room, SpotifyToken
+from .spotify_util import apply_token_refresh, request_token_refresh
+
+# Фоновое обновление токенов Spotify хостов активных комнат.
+# Токены, истекающие в ближайшие TOKEN_REFRESH_MARGIN секунд, обновляются заранее:
+# запросы к Spotify идут параллельно (не больше TOKEN_REFRESH_WORKERS), результат
+# записывается одним bulk_update. Работает внутри опросчика (poller.run_forever),
+# а аренда WorkerLease оставляет эту работу одному воркеру кластера.
+# Пользовательский запрос обновляет токен сам, только если он уже истек.
+
+LEASE_KEY = 'token-refresher'
+ACTIVE_WINDOW = 180  # Как Room.is_host_online
+REFRESH_FIELDS = ['access_token', 'refresh_token', 'expires_in', 'token_type']
+
+logger = get_logger('auth')
+
+_checked_at = 0
+
+
+def due(now=None):
+    """Токены хостов активных комнат, которые скоро истекут."""
+    now = now or timezone.now()
+    hosts = Room.objects.filter(last_active__gte=now - timedelta(seconds=ACTIVE_WINDOW)).values('host_id')
+    return SpotifyToken.objects.filter(
+        user_id__in=hosts, expires_in__lte=now + timedelta(seconds=settings.TOKEN_REFRESH_MARGIN)
+    )
+
+
+def _refresh(token):
+    # Только сеть: потоки пула не трогают БД
+    return apply_token_refresh(token, request_token_refresh(token.refresh_token))
+
+
+def refresh_due():
+    """Обновляет пачку истекающих токенов. Возвращает (обновлено, не удалось)."""
+    tokens = list(due().select_related('user').order_by('expires_in')[:settings.TOKEN_REFRESH_BATCH])
+    if not tokens:
+        return 0, 0
+
+    with ThreadPoolExecutor(max_workers=min(settings.TOKEN_REFRESH_WORKERS, len(tokens)),
+                            thread_name_prefix='jukebox-tokens') as pool:
+        results = list(pool.map(_refresh, tokens))
+
+    refreshed = [token for token, ok in zip(tokens, results) if ok]
+    if refreshed:
+        SpotifyToken.objects.bulk_update(refreshed, REFRESH_FIELDS)
+    for token, ok in zip(tokens, results):
+        if not ok:
+            logger.warning("Background token refresh failed", extra={'host': token.user.username})
+
+    failed = len(tokens) - len(refreshed)
+    observe_token_refresh(len(refreshed), failed)
+    return len(refreshed), failed
+
+
+def tick(worker_id=leases.WORKER_ID):
+    """Из цикла опросчика: раз в TOKEN_REFRESH_INTERVAL и только у держателя аренды."""
+    global _checked_at
+    if time.time() - _checked_at < settings.TOKEN_REFRESH_INTERVAL:
+        return False
+    _checked_at = time.time()
+    # Аренда на два интервала: держатель продлевает ее каждый раз, а упавшего сменят до истечения токенов
+    if not leases.acquire(LEASE_KEY, settings.TOKEN_REFRESH_INTERVAL * 2, owner=worker_id):
+        return False
+    return submit_once(LEASE_KEY, refresh_due)
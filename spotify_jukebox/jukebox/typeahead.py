@@ -0,0 +1,156 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.db.models import Count, Q
+from . import leases
+from .background import submit_once
+from .metrics import cache_hit, cache_miss
+from .models import Track, TrackMetadata
+
+# Локальный индекс подсказок поиска: треки, которые уже видели (TrackMetadata —
+# результаты поиска и добавленные в очереди), по префиксам слов названия и артиста.
+# Живет в памяти процесса: поиск — без запросов к БД и Spotify, доли миллисекунды.
+# Популярность — сколько раз трек сейчас стоит в очередях всех комнат.
+#
+# Индекс догружается инкрементально: в фоне, не чаще раза в TYPEAHEAD_REFRESH секунд,
+# читаются только метаданные новее последней загрузки (по возрастанию, пачками — ничего
+# не пропускается) и пересчитывается популярность. В индексе не больше TYPEAHEAD_MAX_TRACKS
+# треков: при переполнении вытесняются те, что дольше всего не встречались.
+
+MIN_PREFIX = 2
+MAX_PREFIX = 15
+REFRESH_BATCH = 1000
+
+_lock = threading.Lock()
+_tracks = OrderedDict()  # spotify_id -> {'id', 'uri', 'title', 'artist', 'image_url_small'}, давние — первыми
+_prefixes = {}  # префикс слова -> set(spotify_id)
+_popularity = {}  # spotify_id -> число треков в очередях
+_watermark = None  # (fetched_at, spotify_id) последней загруженной записи
+_refreshed_at = 0
+
+
+def normalize(text):
+    return re.sub(r"[^\w\s]", ' ', (text or '').lower().replace('ё', 'е')).split()
+
+
+def _track_prefixes(track):
+    words = set(normalize(track['title'])) | set(normalize(track['artist']))
+    return {word[:length] for word in words for length in range(MIN_PREFIX, min(len(word), MAX_PREFIX) + 1)}
+
+
+def _put(track):
+    """Добавляет или обновляет трек (под _lock) и вытесняет самые давние сверх лимита."""
+    old = _tracks.pop(track['id'], None)
+    if old is None or (old['title'], old['artist']) != (track['title'], track['artist']):
+        if old is not None:
+            _unindex(old)
+        for prefix in _track_prefixes(track):
+            _prefixes.setdefault(prefix, set()).add(track['id'])
+    _tracks[track['id']] = track
+    while len(_tracks) > settings.TYPEAHEAD_MAX_TRACKS:
+        _, evicted = _tracks.popitem(last=False)
+        _unindex(evicted)
+
+
+def _unindex(track):
+    for prefix in _track_prefixes(track):
+        ids = _prefixes.get(prefix)
+        if ids is not None:
+            ids.discard(track['id'])
+            if not ids:
+                del _prefixes[prefix]
+
+
+def add(metadata):
+    """Добавляет трек в индекс этого процесса сразу (например, только что добавлен в очередь)."""
+    with _lock:
+        _put({
+            'id': metadata.spotify_id, 'uri': metadata.uri, 'title': metadata.title,
+            'artist': metadata.artist, 'image_url_small': metadata.image_url_small,
+        })
+
+
+def note_queued(metadata):
+    add(metadata)
+    with _lock:
+        _popularity[metadata.spotify_id] = _popularity.get(metadata.spotify_id, 0) + 1
+
+
+def search(query, limit=5):
+    """Лучшие локальные совпадения: каждое слово запроса — префикс слова трека."""
+    words = [word[:MAX_PREFIX] for word in normalize(query)]
+    if not words or any(len(word) < MIN_PREFIX for word in words):
+        return []
+    _schedule_refresh()
+
+    with _lock:
+        candidates = None
+        for word in words:
+            ids = _prefixes.get(word, set())
+            candidates = ids if candidates is None else candidates & ids
+            if not candidates:
+                break
+        if not candidates:
+            cache_miss('typeahead')
+            return []
+        ranked = sorted(candidates, key=lambda track_id: (-_popularity.get(track_id, 0), _tracks[track_id]['title']))
+        cache_hit('typeahead')
+        return [_tracks[track_id] for track_id in ranked[:limit]]
+
+
+FIELDS = ('spotify_id', 'uri', 'title', 'artist', 'image_url_small', 'fetched_at')
+
+
+def _load_new():
+    """Метаданные новее отметки: первая загрузка — самые свежие TYPEAHEAD_MAX_TRACKS, дальше — все новые."""
+    rows = TrackMetadata.objects.values(*FIELDS)
+    if _watermark is None:
+        return list(reversed(rows.order_by('-fetched_at', '-spotify_id')[:settings.TYPEAHEAD_MAX_TRACKS]))
+    loaded = []
+    fetched_at, spotify_id = _watermark
+    while True:
+        batch = list(rows.filter(Q(fetched_at__gt=fetched_at) | Q(fetched_at=fetched_at, spotify_id__gt=spotify_id))
+                     .order_by('fetched_at', 'spotify_id')[:REFRESH_BATCH])
+        loaded += batch
+        if len(batch) < REFRESH_BATCH:
+            return loaded
+        fetched_at, spotify_id = batch[-1]['fetched_at'], batch[-1]['spotify_id']
+
+
+def refresh():
+    """Догружает новые метаданные и пересчитывает популярность (обычно одна пара запросов)."""
+    global _watermark, _refreshed_at
+    rows = _load_new()
+    popularity = dict(
+        Track.objects.filter(metadata__isnull=False).values_list('metadata_id').annotate(n=Count('id'))
+    )
+
+    with _lock:
+        for row in rows:
+            _put({'id': row['spotify_id'], 'uri': row['uri'], 'title': row['title'],
+                  'artist': row['artist'], 'image_url_small': row['image_url_small']})
+        if rows:
+            _watermark = (rows[-1]['fetched_at'], rows[-1]['spotify_id'])
+        _popularity.clear()
+        _popularity.update(popularity)
+        _refreshed_at = time.time()
+
+
+def _schedule_refresh():
+    if time.time() - _refreshed_at < settings.TYPEAHEAD_REFRESH:
+        return
+    # Ключ с id воркера: индекс у каждого процесса свой
+    submit_once(f"typeahead:{leases.WORKER_ID}", refresh)
+
+
+def reset():
+    """Пустой индекс, считающийся свежим: фоновая догрузка не начнется сама (тесты)."""
+    global _watermark, _refreshed_at
+    with _lock:
+        _tracks.clear()
+        _prefixes.clear()
+        _popularity.clear()
+        _watermark = None
+        _refreshed_at = time.time()
@@ -4,10 +4,11 @@ from .views import (
     home, create_room, join_room, room, register,
     AuthURL, IsAuthenticated, CurrentSong,
     PauseSong, PlaySong, SkipSong, SearchSong,
-    AddToQueue, VoteToSkip, LeaveRoom, UpdateRoom,
+    AddToQueue, SearchAndEnqueue, VoteToSkip, LeaveRoom, UpdateRoom,
     GetRoom, spotify_callback, PrevSong, GetQueue,
     spotify_login
 )
+from .metrics import metrics_view
 
 urlpatterns = [
     # Исправлено: убрали "views.", так как мы импортировали функции напрямую
@@ -31,6 +32,7 @@ urlpatterns = [
     path('api/prev-song/', PrevSong.as_view()),
     path('api/spotify/search/', SearchSong.as_view()),
     path('api/add-to-queue/', AddToQueue.as_view()),
+    path('api/search-and-enqueue/', SearchAndEnqueue.as_view()),
     path('api/vote-to-skip/', VoteToSkip.as_view()),
     path('api/queue/', GetQueue.as_view()),
     path('api/is-authenticated/', IsAuthenticated.as_view()),
@@ -39,4 +41,5 @@ urlpatterns = [
     path('leave-room/', LeaveRoom.as_view()),
     path('update-room/', UpdateRoom.as_view()),
     path('api/spotify/callback/', spotify_callback, name='spotify_callback'),
+    path('metrics/', metrics_view, name='metrics'),
 ]
\ No newline at end of file
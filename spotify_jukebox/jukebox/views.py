@@ -1,16 +1,32 @@
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
-from .models import Room, Vote, Track
+from .models import Room, Track, TrackMetadata
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
 from .forms import CreateRoomForm, JoinRoomForm, UserRegisterForm
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from requests import Request, post
 from django.conf import settings
-from .utils import update_or_create_user_tokens, is_spotify_authenticated, user_is_host
-# ИСПРАВЛЕНО: Добавлены search_spotify и add_to_queue в импорт
-from .spotify_util import get_current_song, pause_song, play_song, skip_song, search_spotify, add_to_queue
+from .utils import update_or_create_user_tokens, user_is_host
+from .spotify_util import search_spotify
+from .spotify_util import get_tracks_metadata, track_id_from_uri, is_track_uri
+from .spotify_util import NOT_AUTHENTICATED_ERROR
+from .playback import get_snapshot, read_playback, reset_idle
+from .playback import poll_after, sync_live_song, recently_commanded
+from .playback import annotate_queue_etas, remaining_ms
+from .commands import run_command, RETRY_AFTER
+from .throttles import ThrottledAPIView
+from . import presence
+from . import events
+from . import typeahead
+from . import devices
+from . import teardown
+from . import votes
+from .log import get_logger, bind
 import base64
+import hashlib
 import requests
 from django.http import HttpResponse
 from .serializers import RoomSerializer, CreateRoomSerializer, UpdateRoomSerializer
@@ -22,6 +38,11 @@ from django.contrib import messages
 from rest_framework.permissions import IsAuthenticated as DRF_IsAuthenticated
 from .spotify_util import is_spotify_authenticated
 
+rooms_logger = get_logger('rooms')
+auth_logger = get_logger('auth')
+queue_logger = get_logger('queue')
+
+
 def home(request):
     return render(request, 'jukebox/home.html')
 
@@ -42,7 +63,7 @@ def create_room(request):
         form = CreateRoomForm(request.POST)
         if form.is_valid():
             # Очистка старых комнат (чтобы не падал сервер, о чем говорили в начале)
-            Room.objects.filter(host=request.user).delete()
+            teardown.close_rooms(Room.objects.filter(host=request.user))
 
             room = form.save(commit=False)
             room.host = request.user
@@ -52,7 +73,7 @@ def create_room(request):
             request.session['room_code'] = room.code
             request.session.save()
 
-            print(f"DEBUG: Created room {room.code} for session {request.session.session_key}")
+            rooms_logger.info("Room created", extra={'room': room.code, 'host': request.user.username})
             return redirect('room', room_code=room.code)
     else:
         form = CreateRoomForm()
@@ -70,11 +91,17 @@ def join_room(request):
             # Очищаем код от пробелов и переводим в верхний регистр
             code = form.cleaned_data['code'].strip().upper()
 
-            if Room.objects.filter(code=code).exists():
+            room_id = Room.objects.filter(code=code).values_list('pk', flat=True).first()
+            if room_id and presence.is_full(room_id, request.session.session_key):
+                return render(request, 'jukebox/join_room.html', {
+                    'form': form,
+                    'error': 'Комната заполнена! Попробуйте позже.'
+                })
+            if room_id:
                 request.session['room_code'] = code
                 request.session.save()  # КРИТИЧНО для работы через туннель
 
-                print(f"DEBUG: Joined room {code} for session {request.session.session_key}")
+                rooms_logger.info("Guest joined room", extra={'room': code})
                 return redirect('room', room_code=code)
             else:
                 return render(request, 'jukebox/join_room.html', {
@@ -103,7 +130,7 @@ def room(request, room_code):
         }
         return render(request, 'jukebox/room.html', context)
     else:
-        print(f"DEBUG: Room {room_code} not found in DB")
+        rooms_logger.debug("Room not found", extra={'room': room_code})
         return redirect('home')
 
 class AuthURL(APIView):
@@ -163,11 +190,12 @@ def spotify_callback(request):
         response_data = response.json()
 
         if response.status_code != 200:
-            print(f"Spotify Error: {response_data}")
+            auth_logger.warning("Spotify token exchange failed (%s): %s", response.status_code,
+                                response_data.get('error'))
             return redirect('/')
 
     except Exception as e:
-        print(f"Connection Error: {e}")
+        auth_logger.warning("Spotify token exchange error: %s", e)
         return redirect('/')
 
     access_token = response_data.get('access_token')
@@ -182,6 +210,8 @@ def spotify_callback(request):
             expires_in,
             refresh_token
         )
+        # Хост переподключился — сбрасываем паузу опроса его плеера
+        reset_idle(request.user)
 
         # Возвращаем пользователя в его комнату
         room_code = request.session.get('room_code')
@@ -197,10 +227,12 @@ def spotify_callback(request):
 
 
 class IsAuthenticated(APIView):
+    replica_reads = True  # Чтения — с реплики БД (jukebox/db_router.py)
+
     def get(self, request, format=None):
         # 1. Берем код комнаты из сессии гостя
         room_code = request.session.get('room_code')
-        room = Room.objects.filter(code=room_code).first()
+        room = Room.objects.select_related('host').filter(code=room_code).first()
 
         if room:
             # 2. Проверяем авторизацию именно ХОЗЯИНА комнаты
@@ -212,15 +244,42 @@ class IsAuthenticated(APIView):
 from django.utils import timezone
 from django.http import HttpResponse
 
+# Поля плеера, которые меняются каждый опрос; остальное — "состояние" (трек, пауза, голоса, настройки)
+PROGRESS_FIELDS = ('progress_percent', 'display_time', 'progress_ms')
+
+
+def player_fingerprint(context):
+    """Короткий отпечаток всего, кроме прогресса: совпал — клиенту хватит обновить полосу и время."""
+    state = sorted((key, str(value)) for key, value in context.items() if key not in PROGRESS_FIELDS)
+    return hashlib.sha1(repr(state).encode('utf-8')).hexdigest()[:12]
+
+
+# Название, исполнитель и обложка текущего трека — из общей таблицы TrackMetadata,
+# тем же запросом, что и комната (по Room.current_song, без отдельного обращения к БД)
+SONG_METADATA_FIELDS = ('title', 'artist', 'image_url')
+
+
+def with_song_metadata(rooms):
+    song = TrackMetadata.objects.filter(pk=OuterRef('current_song'))
+    return rooms.annotate(**{f"song_{field}": Subquery(song.values(field)[:1]) for field in SONG_METADATA_FIELDS})
+
+
+def song_metadata(room, song_info):
+    """Поля плеера из TrackMetadata; пока трек не записан в room.current_song — из ответа Spotify."""
+    stored = room.current_song == song_info.get('id')
+    return {field: (getattr(room, f"song_{field}", None) if stored else None) or song_info.get(field)
+            for field in SONG_METADATA_FIELDS}
+
+
 class CurrentSong(APIView):
     def get(self, request, format=None):
         # 1. Пытаемся достать код комнаты из сессии
         room_code = request.session.get('room_code')
-        room = Room.objects.filter(code=room_code).first()
+        room = with_song_metadata(Room.objects.select_related('host')).filter(code=room_code).first()
 
         # 2. Если в сессии пусто, но юзер авторизован - ищем его как хоста
         if not room and request.user.is_authenticated:
-            room = Room.objects.filter(host=request.user).last()
+            room = with_song_metadata(Room.objects.filter(host=request.user)).last()
             if room:
                 request.session['room_code'] = room.code
                 request.session.save()
@@ -235,17 +294,22 @@ class CurrentSong(APIView):
         # --- ЛОГИКА ЖИЗНИ КОМНАТЫ (Heartbeat) ---
         host = room.host
         is_host = (request.user == host)
+        bind(room=room.code, host=host.username)
 
         if is_host:
-            # Хост активен — обновляем время "пульса"
-            # Мы используем update_fields для производительности
-            room.last_active = timezone.now()
-            room.save(update_fields=['last_active'])
+            # Хост активен — обновляем время "пульса".
+            # Пишем в БД не на каждый опрос, а раз в HOST_HEARTBEAT_INTERVAL секунд
+            now = timezone.now()
+            if (now - room.last_active).total_seconds() >= settings.HOST_HEARTBEAT_INTERVAL:
+                room.last_active = now
+                room.save(update_fields=['last_active'])
         else:
+            presence.touch(room.pk, request.session.session_key)
+
             # Зашел гость — проверяем, не "протухла" ли комната
             if not room.is_host_online():
                 # Если хост не подавал признаков жизни (запросов) больше N секунд
-                room.delete()
+                teardown.close_rooms(Room.objects.filter(pk=room.pk))
                 # HTMX поймет этот заголовок и сделает редирект на стороне браузера
                 response = HttpResponse(status=204)
                 response['HX-Redirect'] = '/'
@@ -260,112 +324,165 @@ class CurrentSong(APIView):
                 'is_host': is_host
             })
 
-        # 5. Получаем текущий трек
-        song_info = get_current_song(host)
+        # 5. Получаем текущий трек.
+        # Сразу после команды отдаем предсказанное состояние, затем сверяемся со Spotify
+        # Иначе — снимок, пока по расписанию (конец трека, пауза, недавняя команда) его рано обновлять
+        # Если комнату опрашивает фоновый опросчик (jukebox/poller.py), даем ему немного форы.
+        # Его снимки видны только через общий кэш — без REDIS_URL ждать его незачем
+        poller = settings.ROOM_POLLER_ENABLED and settings.REDIS_URL
+        grace = settings.ROOM_POLLER_GRACE if poller else 0
+        song_info = read_playback(room, grace)
+
+        # Настоящие данные Spotify, только что полученные (не предсказание, не снимок из кэша)
+        is_live = bool(song_info) and 'id' in song_info and not song_info.get('optimistic') \
+            and not song_info.get('stale') and not song_info.get('scheduled')
+
+        # Когда клиенту прийти снова: к концу удержания после команды / к плановому обновлению
+        if song_info.get('optimistic'):
+            poll_deadline = song_info['hold_until']
+        elif song_info.get('stale'):
+            poll_deadline = None
+        else:
+            poll_deadline = song_info.get('next_fetch_at')
+
+        # Трек сменился / заиграла голова очереди (только по настоящим данным Spotify)
+        if is_live:
+            sync_live_song(room, song_info)
 
-        # Синхронизация очереди
+        # 6. Формируем контекст
         if song_info and 'id' in song_info:
-            current_spotify_id = song_info['id']
-            first_track = Track.objects.filter(room=room).order_by('added_at').first()
-            if first_track:
-                queued_spotify_id = first_track.spotify_uri.split(':')[-1]
-                if queued_spotify_id == current_spotify_id:
-                    first_track.delete()
-
-                # 6. Формируем контекст
-            if song_info and 'id' in song_info:
-                current_song_id = song_info.get('id')
-                duration = song_info.get('duration', 0)
-                current_time = song_info.get('time', 0)
-                progress = (current_time / duration * 100) if duration > 0 else 0
-
-                votes_count = Vote.objects.filter(room=room, song_id=song_info.get('id')).count()
-                vote_pct = (votes_count / room.votes_to_skip * 100) if room.votes_to_skip > 0 else 0
-
-                context = {
-                    'title': song_info.get('title'),
-                    'artist': song_info.get('artist'),
-                    'image_url': song_info.get('image_url'),
-                    'is_playing': song_info.get('is_playing'),
-                    'votes': votes_count,
-                    'votes_required': room.votes_to_skip,
-                    'vote_percentage': vote_pct,
-                    'progress_percent': progress,
-                    'display_time': f"{int((current_time / 1000) // 60)}:{int((current_time / 1000) % 60):02d}",
-                    'display_duration': f"{int((duration / 1000) // 60)}:{int((duration / 1000) % 60):02d}",
-                    'is_host': is_host,
-                    'guest_can_pause': room.guest_can_pause,  # КРИТИЧЕСКИ ВАЖНО для шаблона!
-                }
-                return render(request, 'jukebox/song.html', context)
+            current_song_id = song_info.get('id')
+            duration = song_info.get('duration', 0)
+            current_time = song_info.get('time', 0)
+            progress = (current_time / duration * 100) if duration > 0 else 0
+
+            votes_count = votes.count(room.pk, song_info.get('id'))
+            vote_pct = (votes_count / room.votes_to_skip * 100) if room.votes_to_skip > 0 else 0
+
+            context = dict(song_metadata(room, song_info), **{
+                'is_playing': song_info.get('is_playing'),
+                'votes': votes_count,
+                'votes_required': room.votes_to_skip,
+                'vote_percentage': vote_pct,
+                'progress_percent': progress,
+                'display_time': f"{int((current_time / 1000) // 60)}:{int((current_time / 1000) % 60):02d}",
+                'display_duration': f"{int((duration / 1000) // 60)}:{int((duration / 1000) % 60):02d}",
+                'is_host': is_host,
+                'guest_can_pause': room.guest_can_pause,  # КРИТИЧЕСКИ ВАЖНО для шаблона!
+                'stale': song_info.get('stale', False),
+                'progress_ms': current_time,
+                'duration_ms': duration,
+            })
 
         # 7. Если Spotify открыт, но ничего не играет
-        return render(request, 'jukebox/song.html', {
-            'is_playing': False,
-            'error_message': "No active device found. Play music on Spotify!"
-        })
+        elif song_info.get('error') == NOT_AUTHENTICATED_ERROR:
+            context = {
+                'is_playing': False,
+                'needs_auth': True,
+                'is_host': is_host,
+                'error_message': "Host needs to reconnect Spotify."
+            }
+        else:
+            context = {
+                'is_playing': False,
+                'error_message': "No active device found. Play music on Spotify!"
+            }
+
+        # Обычно с прошлого опроса сдвинулся только прогресс: тогда вместо всего плеера
+        # отдаем крошечный out-of-band апдейт #player-data, разметку плеера не трогаем
+        fingerprint = player_fingerprint(context)
+        if request.headers.get('X-Player-Fingerprint') == fingerprint:
+            response = render(request, 'jukebox/partials/player_progress.html', context)
+            response['HX-Reswap'] = 'none'
+        else:
+            response = render(request, 'jukebox/song.html', context)
+        response['X-Player-Fingerprint'] = fingerprint
+        response['X-Poll-After'] = poll_after(poll_deadline, recently_commanded(room))
+        # Очередь изменилась (в любом процессе) с прошлого опроса — просим клиента ее перечитать
+        queue_version = f"{events.version(room.pk, 'queue'):.3f}"
+        seen_version = request.headers.get('X-Queue-Version')
+        if seen_version and seen_version != queue_version:
+            response['HX-Trigger'] = 'queue-changed'
+        response['X-Queue-Version'] = queue_version
+        return response
+
+class PlayerCommand(ThrottledAPIView):
+    """
+    Общая логика кнопок плеера: команда уходит через канал команд комнаты
+    (схлопывание дублей + idempotency key), в ответе — что реально применилось.
+    """
+    throttle_scope = 'control'
+    action = None
+    guest_allowed = True  # Гость может нажимать, если хост включил guest_can_pause
 
-class PauseSong(APIView):
-    def post(self, request, format=None): # ИСПРАВЛЕНО: с put на post
+    def post(self, request, format=None):
         room_code = self.request.session.get('room_code')
-        room = Room.objects.filter(code=room_code).first()
+        room = Room.objects.select_related('host').filter(code=room_code).first()
 
         if not room:
             return Response({'Error': 'Room not found'}, status=status.HTTP_404_NOT_FOUND)
+        bind(room=room.code, host=room.host.username)
 
         is_host = request.user.is_authenticated and room.host == request.user
 
-        if is_host or room.guest_can_pause:
-            pause_song(room.host)
-            return Response({}, status=status.HTTP_204_NO_CONTENT)
+        if not (is_host or (self.guest_allowed and room.guest_can_pause)):
+            return Response({'Message': 'Forbidden'}, status=status.HTTP_403_FORBIDDEN)
 
-        return Response({}, status=status.HTTP_403_FORBIDDEN)
+        idempotency_key = request.headers.get('Idempotency-Key') or request.data.get('idempotency_key')
+        result = run_command(room, self.action, idempotency_key, by_host=is_host)
+        self.on_result(room, result)
 
+        code = status.HTTP_202_ACCEPTED if result['status'] == 'pending' else status.HTTP_200_OK
+        response = Response(result, status=code)
+        if result.get('retry'):
+            response['Retry-After'] = str(RETRY_AFTER)
+        # Плеер сразу перерисуется из обновленного снимка, не дожидаясь очередного опроса
+        response['HX-Trigger'] = 'player-updated'
+        return response
 
-class PlaySong(APIView):
-    def post(self, request, format=None): # ИСПРАВЛЕНО: с put на post
-        room_code = self.request.session.get('room_code')
-        room = Room.objects.filter(code=room_code).first()
+    def on_result(self, room, result):
+        pass
 
-        if not room:
-            return Response({'Error': 'Room not found'}, status=status.HTTP_404_NOT_FOUND)
 
-        is_host = request.user.is_authenticated and room.host == request.user
+class PauseSong(PlayerCommand):
+    action = 'pause'
 
-        if is_host or room.guest_can_pause:
-            play_song(room.host)
-            return Response({}, status=status.HTTP_204_NO_CONTENT)
 
-        return Response({}, status=status.HTTP_403_FORBIDDEN)
+class PlaySong(PlayerCommand):
+    action = 'play'
 
 
-class SkipSong(APIView):
-    def post(self, request, format=None):
-        room_code = self.request.session.get('room_code')
-        room = Room.objects.filter(code=room_code).first()
+class SkipSong(PlayerCommand):
+    action = 'skip'
 
-        if not room:
-            return Response({'Error': 'Room not found'}, status=status.HTTP_404_NOT_FOUND)
+    def on_result(self, room, result):
+        # ВАЖНО: Обнуляем голоса комнаты, так как песня принудительно сменилась
+        if result['status'] == 'applied':
+            votes.clear(room.pk)
 
-        is_host = request.user.is_authenticated and room.host == request.user
 
-        # Если это хост ИЛИ гость с правами "guest_can_pause"
-        if is_host or room.guest_can_pause:
-            skip_song(room.host)
+class PrevSong(PlayerCommand):
+    action = 'prev'
+    guest_allowed = False  # Только хост может переключать назад
 
-            # ВАЖНО: Очищаем ВСЕ голоса в комнате, так как песня принудительно сменилась
-            Vote.objects.filter(room=room).delete()
 
-            return Response({}, status=status.HTTP_204_NO_CONTENT)
+SEARCH_LIMIT = 5
 
-        return Response({'Message': 'Forbidden'}, status=status.HTTP_403_FORBIDDEN)
 
-class SearchSong(APIView):
+class SearchSong(ThrottledAPIView):
     # Оставляем пустым, чтобы избежать конфликта с твоим IsAuthenticated
     permission_classes = []
+    replica_reads = True
+
+    @property
+    def throttle_scope(self):
+        # Отложенный запрос в Spotify — продолжение того же набора текста, а не новый поиск:
+        # свой бюджет, чтобы ответ из локального индекса и догрузка не делили один слот
+        return 'search_spotify' if self.request.query_params.get('source') == 'spotify' else 'search'
 
     def get(self, request, format=None):
         room_code = request.session.get('room_code')
-        room = Room.objects.filter(code=room_code).first()
+        room = Room.objects.select_related('host').filter(code=room_code).first()
 
         if not room:
             # Для HTMX лучше возвращать пустую строку или простой текст ошибки
@@ -376,6 +493,15 @@ class SearchSong(APIView):
         if not query:
             return render(request, 'jukebox/partials/search_results.html', {'songs': []})
 
+        # Сначала — мгновенные совпадения из локального индекса (треки, которые уже искали и добавляли).
+        # Spotify спрашиваем отдельным запросом, только если пользователь перестал печатать
+        local = typeahead.search(query, SEARCH_LIMIT)
+        from_spotify = request.GET.get('source') == 'spotify'
+        if local and not from_spotify:
+            return render(request, 'jukebox/partials/search_results.html', {
+                'songs': local, 'deferred_query': query,
+            })
+
         # Проверяем авторизацию ХОСТА в Spotify
         if not is_spotify_authenticated(room.host):
             return render(
@@ -388,68 +514,140 @@ class SearchSong(APIView):
                 }
             )
 
-        # Поиск от имени хоста
-        songs = search_spotify(room.host, query)
+        # Поиск от имени хоста (при сбое Spotify — последний удачный результат)
+        songs, stale = search_spotify(room.host, query)
 
-        return render(request, 'jukebox/partials/search_results.html', {'songs': songs})
+        # Локальные (популярные) совпадения первыми, затем новое из Spotify
+        seen = {song['id'] for song in local}
+        songs = local + [song for song in songs if song.spotify_id not in seen]
 
-class PrevSong(APIView):
-    def post(self, request, format=None):
-        room_code = self.request.session.get('room_code')
-        room = Room.objects.filter(code=room_code).first()
+        return render(request, 'jukebox/partials/search_results.html', {
+            'songs': songs[:SEARCH_LIMIT * 2], 'stale': stale,
+        })
 
-        # Только хост может переключать назад
-        if request.user.is_authenticated and room.host == request.user:
-            from .spotify_util import prev_song  # Импорт функции
-            prev_song(room.host)
-            return Response({}, status=status.HTTP_204_NO_CONTENT)
+def enqueue_track(room, user, uri, metadata):
+    """
+    Добавляет трек в очередь комнаты: запись в БД (гости сразу видят трек), затем в Spotify.
+    Данные трека берем только из общего кэша метаданных, клиенту не доверяем.
+    """
+    typeahead.note_queued(metadata)
+
+    # 1. Сначала сохраняем в нашу базу (чтобы гость сразу увидел песню)
+    with transaction.atomic():
+        # Строка комнаты заблокирована до вставки: одновременные добавления
+        # получают смещения по очереди, а не одно и то же
+        Room.objects.select_for_update().filter(pk=room.pk).exists()
+        # Смещение нового трека = смещение последнего + его длительность (префиксная сумма для ETA)
+        last_track = room.tracks.order_by('-added_at').values('queue_offset_ms', 'duration_ms').first()
+        queue_offset = last_track['queue_offset_ms'] + last_track['duration_ms'] if last_track else 0
 
-        return Response({}, status=status.HTTP_403_FORBIDDEN)
+        track = Track.objects.create(
+            room=room,
+            added_by=user if user.is_authenticated else room.host,
+            title=metadata.title[:150],
+            artist=metadata.artist[:150],
+            spotify_uri=uri,
+            album_cover_url=metadata.image_url_small,
+            metadata=metadata,
+            duration_ms=metadata.duration_ms,
+            queue_offset_ms=queue_offset
+        )
+    events.publish(room.pk, 'queue')
+
+    # 2. Потом отправляем в Spotify
+    try:
+        devices.queue(room.host, uri)
+    except Exception as e:
+        queue_logger.warning("Spotify queue add failed: %s", e, extra={'room': room.code, 'uri': uri})
+        # Мы не удаляем трек из базы, даже если Spotify временно недоступен
+
+    return track
+
+
+class AddToQueue(ThrottledAPIView):
+    throttle_scope = 'queue'
 
-class AddToQueue(APIView):
     def post(self, request, format=None):
         room_code = request.session.get('room_code')
-        room = Room.objects.filter(code=room_code).first()
+        room = Room.objects.select_related('host').filter(code=room_code).first()
 
         if not room:
             return Response({'error': 'Room not found'}, status=404)
+        bind(room=room.code, host=room.host.username)
 
         uri = request.data.get('uri') or request.POST.get('uri')
-        title = request.data.get('title')
-        artist = request.data.get('artist')
-        image_url = request.data.get('image_url')
 
         if not uri:
             return Response({'error': 'No URI'}, status=400)
+        if not is_track_uri(uri):
+            return Response({'error': 'Not a track URI'}, status=400)
+
+        track_id = track_id_from_uri(uri)
+        unknown = []
+        metadata = get_tracks_metadata(room.host, [track_id], unknown=unknown).get(track_id)
+        if metadata is None:
+            # Spotify ответил, что такого трека нет — повтор не поможет, в отличие от сбоя
+            if unknown:
+                return Response({'error': 'Track not found'}, status=404)
+            return Response({'error': 'Track info unavailable'}, status=503)
+
+        enqueue_track(room, request.user, uri, metadata)
+        return Response({}, status=204)
 
-        # 1. Сначала сохраняем в нашу базу (чтобы гость сразу увидел песню)
-        track = Track.objects.create(
-            room=room,
-            added_by=request.user if request.user.is_authenticated else room.host,
-            title=title,
-            artist=artist,
-            spotify_uri=uri,
-            album_cover_url=image_url
-        )
 
-        # 2. Потом отправляем в Spotify
-        try:
-            is_spotify_authenticated(room.host)
-            add_to_queue(room.host, uri)
-        except Exception as e:
-            print(f"Spotify Queue Error: {e}")
-            # Мы не удаляем трек из базы, даже если Spotify временно недоступен
+class SearchAndEnqueue(ThrottledAPIView):
+    """
+    Голосовые команды: текст запроса -> лучший трек -> в очередь, одним запросом.
+    Сначала локальный индекс (популярные треки), затем поиск Spotify (с кэшем).
+    """
+    throttle_scope = 'queue'
 
-        return Response({}, status=204)
+    def post(self, request, format=None):
+        room_code = request.session.get('room_code')
+        room = Room.objects.select_related('host').filter(code=room_code).first()
+
+        if not room:
+            return Response({'error': 'Room not found'}, status=status.HTTP_404_NOT_FOUND)
+        bind(room=room.code, host=room.host.username)
+
+        query = (request.data.get('query') or '').strip()
+        if not query:
+            return Response({'error': 'No query'}, status=status.HTTP_400_BAD_REQUEST)
+
+        metadata = None
+        local = typeahead.search(query, 1)
+        if local:
+            metadata = TrackMetadata.objects.filter(pk=local[0]['id']).first()
+        if metadata is None:
+            if not is_spotify_authenticated(room.host):
+                return Response({'error': 'Host is not connected to Spotify'}, status=status.HTTP_409_CONFLICT)
+            songs, _ = search_spotify(room.host, query)
+            metadata = songs[0] if songs else None
+        if metadata is None:
+            return Response({'error': 'Not found', 'query': query}, status=status.HTTP_404_NOT_FOUND)
+
+        track = enqueue_track(room, request.user, metadata.uri, metadata)
+        return Response({
+            'id': metadata.spotify_id,
+            'uri': track.spotify_uri,
+            'title': track.title,
+            'artist': track.artist,
+            'image_url': track.album_cover_url,
+        }, status=status.HTTP_201_CREATED)
+
+
+class VoteToSkip(ThrottledAPIView):
+    throttle_scope = 'control'
 
-class VoteToSkip(APIView):
     def post(self, request, format=None):
         room_code = self.request.session.get('room_code')
-        room = Room.objects.filter(code=room_code).first()
+        room = Room.objects.select_related('host').filter(code=room_code).first()
         if not room:
             return Response({'error': 'Комната не найдена'}, status=status.HTTP_404_NOT_FOUND)
 
-        song_info = get_current_song(room.host)
+        # Во время "залпа" голосов трек уже известен из снимка плеера — Spotify не спрашиваем;
+        # промах идет тем же путем, что и опрос плеера (пауза хоста без устройства, старый снимок)
+        song_info = read_playback(room)
         if not song_info or 'id' not in song_info:
             return Response({'message': 'Сейчас ничего не играет'}, status=status.HTTP_204_NO_CONTENT)
 
@@ -460,42 +658,34 @@ class VoteToSkip(APIView):
             self.request.session.create()
             user_session = self.request.session.session_key
 
-        # 1. Очистка: если в базе висят голоса за СТАРУЮ песню — удаляем их
-        Vote.objects.filter(room=room).exclude(song_id=current_song_id).delete()
-
-        # 2. Проверяем, не голосовал ли этот юзер уже за ЭТУ песню
-        vote_exists = Vote.objects.filter(
-            room=room,
-            user=user_session,
-            song_id=current_song_id
-        ).exists()
-
-        if not vote_exists:
-            Vote.objects.create(room=room, user=user_session, song_id=current_song_id)
-        else:
+        # Голос и проверка "уже голосовал" — в кэше; в таблицу Vote он попадет пачкой позже
+        accepted, votes_count = votes.cast(room, current_song_id, user_session)
+        if not accepted:
             return Response({'message': 'Вы уже проголосовали'}, status=status.HTTP_400_BAD_REQUEST)
 
-        # 3. Считаем актуальное кол-во голосов
-        votes_count = Vote.objects.filter(room=room, song_id=current_song_id).count()
-
-        # 4. Сравниваем с настройкой хоста
+        # Сравниваем с настройкой хоста
         if votes_count >= room.votes_to_skip:
-            skip_song(room.host)
-            Vote.objects.filter(room=room, song_id=current_song_id).delete()
-            return Response({'message': 'Skipped'}, status=status.HTTP_200_OK)
+            # Через канал команд: одновременные "решающие" голоса не пропустят два трека
+            result = run_command(room, 'skip')
+            if result['status'] == 'applied':
+                votes.clear(room.pk)
+            response = Response({'message': 'Skipped', 'result': result}, status=status.HTTP_200_OK)
+            response['HX-Trigger'] = 'player-updated'
+            return response
 
         return Response({'votes': votes_count, 'required': room.votes_to_skip}, status=status.HTTP_200_OK)
 
 class LeaveRoom(APIView):
     def post(self, request, format=None):
         if 'room_code' in request.session:
-            self.request.session.pop('room_code')
+            room_code = self.request.session.pop('room_code')
+            room_id = Room.objects.filter(code=room_code).values_list('pk', flat=True).first()
+            if room_id:
+                presence.leave(room_id, request.session.session_key)
 
             # ИСПРАВЛЕНО: Проверка на хоста через request.user (если залогинен)
             if request.user.is_authenticated:
-                room_results = Room.objects.filter(host=request.user)
-                if room_results.exists():
-                    room_results[0].delete()
+                teardown.close_rooms(Room.objects.filter(host=request.user))
 
         response = HttpResponse(status=200, content='Success')
         response['HX-Redirect'] = '/'
@@ -524,11 +714,14 @@ class UpdateRoom(APIView):
             room.guest_can_pause = guest_can_pause
             room.votes_to_skip = votes_to_skip
             room.save(update_fields=['guest_can_pause', 'votes_to_skip'])
+            events.publish(room.pk, 'room')
             return Response(UpdateRoomSerializer(room).data, status=status.HTTP_200_OK)
         return Response({'Bad Request': "Invalid Data..."}, status=status.HTTP_400_BAD_REQUEST)
 
 
 class GetRoom(APIView):
+    replica_reads = True
+
     def get(self, request, format=None):
         code = request.GET.get('code')
         if not code: code = request.session.get('room_code')
@@ -552,20 +745,54 @@ class GetRoom(APIView):
                         status=status.HTTP_400_BAD_REQUEST)
 
 class GetQueue(APIView):
+    """
+    Очередь комнаты. Без параметров — весь список.
+    С ?after=<id последнего показанного трека> — только изменения: новые треки
+    (out-of-band дописываются в #queue-list) и новая голова очереди, по которой
+    клиент сам убирает сыгранные. Треки не переставляются — очередь только
+    растет с конца и убывает с головы, так что этого достаточно.
+    """
+    replica_reads = True
+
     def get(self, request, format=None):
         room_code = request.session.get('room_code')
-        room = Room.objects.filter(code=room_code).first()
+        room = Room.objects.select_related('host').filter(code=room_code).first()
 
         if not room:
             return HttpResponse("Room not found", status=404)
 
-        tracks = room.tracks.order_by('added_at')
+        tracks = room.tracks.select_related('added_by', 'metadata').order_by('added_at')
+        # ETA считается по закэшированному снимку плеера — без запросов к Spotify
+        snapshot = get_snapshot(room)
+        remaining = remaining_ms(snapshot) if snapshot and 'id' in snapshot else None
 
-        return render(
-            request,
-            'jukebox/partials/queue.html',
-            {'tracks': tracks}
+        try:
+            after = int(request.GET['after'])
+        except (KeyError, ValueError):
+            after = None
+
+        if after is None:
+            tracks = annotate_queue_etas(tracks, snapshot)
+            return render(request, 'jukebox/partials/queue.html', {
+                'tracks': tracks,
+                'cursor': tracks[-1].pk if tracks else None,
+                'head': tracks[0].pk if tracks else None,
+                'remaining_ms': remaining,
+            })
+
+        head = room.tracks.order_by('added_at').values('pk', 'queue_offset_ms').first()
+        new_tracks = annotate_queue_etas(
+            tracks.filter(pk__gt=after), snapshot, head_offset=head and head['queue_offset_ms']
         )
+        response = render(request, 'jukebox/partials/queue_delta.html', {
+            'tracks': new_tracks,
+            'cursor': new_tracks[-1].pk if new_tracks else after,
+            'head': head and head['pk'],
+            'remaining_ms': remaining,
+        })
+        # Список на странице не заменяем — только out-of-band вставки
+        response['HX-Reswap'] = 'none'
+        return response
 
 def register(request):
     if request.method == 'POST':
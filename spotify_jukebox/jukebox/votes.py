@@ -0,0 +1,153 @@
+import atexit
+import threading
+from django.conf import settings
+from django.core.cache import cache
+from . import events, leases
+from .background import submit_once
+from .log import get_logger
+from .models import Room, Vote
+
+# Голоса за пропуск трека: сначала в кэш, в БД — потом и пачками.
+# На раунд голосования (комната + трек) — ключ на каждого проголосовавшего (cache.add:
+# атомарная проверка "уже голосовал") и счетчик (cache.incr). Решение о пропуске
+# принимается по счетчику, поэтому голос стоит пару обращений к кэшу, сколько бы
+# гостей ни голосовали одновременно.
+#
+# В таблицу Vote голоса попадают из буфера процесса одним bulk_create (для истории):
+# когда набралось VOTE_FLUSH_BATCH, по таймеру через VOTE_FLUSH_INTERVAL после первого
+# голоса в буфере или при завершении процесса. Неудачная запись возвращает пачку в буфер.
+# Пропуск трека начинает новый раунд — старые ключи просто истекают.
+#
+# Все это — только с общим кэшем (VOTES_IN_CACHE, то есть Redis). С кэшем в памяти процесса
+# голоса, как и раньше, сразу пишутся в Vote и считаются запросом к БД.
+
+VOTE_TTL = 60 * 60
+VOTE_FLUSH_BATCH = 50
+VOTE_FLUSH_INTERVAL = 5
+VOTE_BUFFER_MAX = 10000  # Если БД долго недоступна, самые старые голоса отбрасываются
+
+logger = get_logger('queue')
+
+_lock = threading.Lock()
+_pending = []  # Vote, еще не записанные в БД
+_timer = None  # Отложенная запись буфера
+
+
+def _round_key(room_id):
+    return f"vote-round:{room_id}"
+
+
+def _round(room_id):
+    return cache.get(_round_key(room_id), 0)
+
+
+def _count_key(room_id, song_id, round_):
+    return f"votes:{room_id}:{round_}:{song_id}"
+
+
+def cast(room, song_id, session_key):
+    """Голос сессии за пропуск трека. Возвращает (принят ли, голосов в раунде)."""
+    if not settings.VOTES_IN_CACHE:
+        return _cast_in_db(room, song_id, session_key)
+    round_ = _round(room.pk)
+    count_key = _count_key(room.pk, song_id, round_)
+    if not cache.add(f"{count_key}:{session_key}", True, VOTE_TTL):
+        return False, cache.get(count_key, 0)
+
+    cache.add(count_key, 0, VOTE_TTL)
+    try:
+        count = cache.incr(count_key)
+    except ValueError:
+        # Счетчик истек между add и incr
+        cache.set(count_key, 1, VOTE_TTL)
+        count = 1
+
+    _buffer(Vote(room=room, user=session_key, song_id=song_id))
+    return True, count
+
+
+def count(room_id, song_id):
+    if not settings.VOTES_IN_CACHE:
+        return Vote.objects.filter(room_id=room_id, song_id=song_id).count()
+    return cache.get(_count_key(room_id, song_id, _round(room_id)), 0)
+
+
+def clear(room_id):
+    """Трек пропущен — следующие голоса начинают новый раунд."""
+    if not settings.VOTES_IN_CACHE:
+        Vote.objects.filter(room_id=room_id).delete()
+        events.publish(room_id, 'vote', 'delete')
+        return
+    cache.add(_round_key(room_id), 0, None)
+    cache.incr(_round_key(room_id))
+
+
+def _cast_in_db(room, song_id, session_key):
+    votes = Vote.objects.filter(room=room, song_id=song_id)
+    if votes.filter(user=session_key).exists():
+        return False, votes.count()
+    Vote.objects.create(room=room, user=session_key, song_id=song_id)
+    events.publish(room.pk, 'vote')
+    return True, votes.count()
+
+
+# --- ЗАПИСЬ В БД ---
+
+def _submit_flush():
+    # Ключ с id воркера: буфер у каждого процесса свой
+    submit_once(f"votes:{leases.WORKER_ID}", flush)
+
+
+def _on_timer():
+    global _timer
+    with _lock:
+        _timer = None
+    _submit_flush()
+
+
+def _schedule():
+    """Буфер будет записан через VOTE_FLUSH_INTERVAL, даже если голосов больше не придет (под _lock)."""
+    global _timer
+    if _timer is None and _pending:
+        _timer = threading.Timer(VOTE_FLUSH_INTERVAL, _on_timer)
+        _timer.daemon = True
+        _timer.start()
+
+
+def _buffer(vote):
+    with _lock:
+        _pending.append(vote)
+        full = len(_pending) >= VOTE_FLUSH_BATCH
+        if not full:
+            _schedule()
+    if full:
+        _submit_flush()
+
+
+def flush():
+    """Записывает накопленные голоса одним bulk_create. Возвращает, сколько записано."""
+    with _lock:
+        batch = _pending[:]
+        _pending.clear()
+    if not batch:
+        return 0
+    try:
+        # Комнату могли закрыть, пока голоса ждали записи
+        open_rooms = set(Room.objects.filter(pk__in={vote.room_id for vote in batch}).values_list('pk', flat=True))
+        rows = [vote for vote in batch if vote.room_id in open_rooms]
+        Vote.objects.bulk_create(rows)
+    except Exception:
+        logger.exception("Vote flush failed", extra={'votes': len(batch)})
+        # Возвращаем пачку в буфер (перед голосами, пришедшими за это время) и попробуем снова
+        with _lock:
+            _pending[:0] = batch
+            del _pending[:-VOTE_BUFFER_MAX]
+            _schedule()
+        return 0
+    # bulk_create не шлет post_save — публикуем изменения сами, одно событие на комнату
+    for room_id in {vote.room_id for vote in rows}:
+        events.publish(room_id, 'vote')
+    return len(rows)
+
+
+atexit.register(flush)